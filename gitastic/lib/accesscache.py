@@ -0,0 +1,86 @@
+import time
+import threading
+import sqlite3
+
+#Node-local cache of (keyid, repository path) -> (repository dir, access) in a sqlite file shared by every
+#gitastic-shell on the machine.  Entries are only used while they carry the ACL version last seen in the
+#database and that version was seen less than max_age seconds ago, so a hit never has to ask the database.
+SCHEMA=(
+    """CREATE TABLE IF NOT EXISTS acl_state (
+        acl_state_id INTEGER PRIMARY KEY CHECK (acl_state_id=1),
+        version INTEGER NOT NULL,
+        refreshed REAL NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS access (
+        keyid INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        directory TEXT NOT NULL,
+        access INTEGER NOT NULL,
+        public INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        PRIMARY KEY (keyid, path))""",
+)
+
+class AccessCache(object):
+    def __init__(self, path, max_age=30, timeout=0.5):
+        self.path=path
+        self.max_age=max_age
+        self.timeout=timeout
+        #sqlite connections can't be shared between threads (gitastic-authd has several)
+        self._local=threading.local()
+
+    def _connect(self):
+        connection=getattr(self._local, "connection", None)
+        if connection is None:
+            #autocommit, every statement here stands on its own
+            connection=sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                connection.execute(statement)
+            self._local.connection=connection
+        return connection
+
+    def close(self):
+        connection=getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection=None
+
+    def get(self, keyid, path):
+        #(directory, access, public) if there's a current entry, otherwise None
+        #The cache is only ever an optimization, if it can't be read we just ask the database
+        try:
+            row=self._connect().execute(
+                "SELECT access.directory, access.access, access.public FROM access JOIN acl_state ON acl_state.acl_state_id=1 "
+                "WHERE access.keyid=? AND access.path=? AND access.version=acl_state.version AND acl_state.refreshed>=?",
+                (int(keyid), path, time.time()-self.max_age)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        return row[0], row[1], bool(row[2])
+
+    def put(self, keyid, path, directory, access, public, version):
+        try:
+            self._connect().execute("INSERT OR REPLACE INTO access (keyid, path, directory, access, public, version) VALUES (?, ?, ?, ?, ?, ?)",
+                (int(keyid), path, directory, int(access), 1 if public else 0, int(version)))
+        except sqlite3.Error:
+            pass
+
+    def setVersion(self, version):
+        #Record the ACL version just read from the database, entries from older versions are dropped
+        try:
+            connection=self._connect()
+            previous=connection.execute("SELECT version FROM acl_state WHERE acl_state_id=1").fetchone()
+            if previous is not None and previous[0]>version:
+                #Another process has already seen a newer version than the one we read
+                return
+            connection.execute("INSERT OR REPLACE INTO acl_state (acl_state_id, version, refreshed) VALUES (1, ?, ?)", (int(version), time.time()))
+            if previous is None or previous[0]!=version:
+                connection.execute("DELETE FROM access WHERE version<>?", (int(version),))
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        connection=self._connect()
+        connection.execute("DELETE FROM access")
+        connection.execute("DELETE FROM acl_state")
@@ -0,0 +1,68 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+import gitastic
+import database
+
+#For event loop front ends (smart HTTP, web) that can't block on storm.  The models still block, so every call
+#runs on one of a fixed number of worker threads, each with its own store from the pool, and returns a future:
+#a concurrent.futures.Future, or an asyncio (trollius on python 2) future when a loop is given.  Every task ends
+#by handing its store back rolled back, like a gitastic-authd request.  Keep Workers at or below Database/PoolSize
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio=None
+
+class AsyncDatabaseBusy(Exception):
+    pass
+
+class AsyncDatabase(object):
+    def __init__(self, workers=None, max_pending=None, loop=None):
+        if loop is not None and asyncio is None:
+            raise ValueError("An event loop needs asyncio or trollius")
+        self.workers=int(workers or gitastic.config.get("AsyncDatabase/Workers", default=4))
+        self.max_pending=int(max_pending if max_pending is not None else gitastic.config.get("AsyncDatabase/MaxPending", default=self.workers*16))
+        self.loop=loop
+        self._executor=ThreadPoolExecutor(max_workers=self.workers)
+        #Running and waiting tasks, past that new ones fail straight away instead of queueing without end
+        self._slots=threading.BoundedSemaphore(self.workers+self.max_pending)
+
+    def _submit(self, function, *args):
+        if self._slots.acquire(False):
+            future=self._executor.submit(self._run, function, *args)
+        else:
+            future=Future()
+            future.set_exception(AsyncDatabaseBusy("%d database calls are already waiting"%(self.max_pending,)))
+        return asyncio.wrap_future(future, loop=self.loop) if self.loop is not None else future
+
+    def _run(self, function, *args):
+        try:
+            return function(*args)
+        finally:
+            database.releaseStore()
+            self._slots.release()
+
+    def resolveAccess(self, user, path):
+        #A ResolvedAccess for user (a user, snapshot or user id) on path, None for an unknown user
+        return self._submit(database.resolveUserAccess, getattr(user, "user_id", user), path)
+
+    def resolveKeyAccess(self, keyid, path):
+        return self._submit(database.resolveAccess, keyid, path)
+
+    def authenticate(self, username, password):
+        #A snapshot of the user, None if the username or password is wrong
+        return self._submit(self._authenticate, username, password)
+
+    @staticmethod
+    def _authenticate(username, password):
+        user=database.User.authenticate(username, password)
+        return database.User._snapshot(user) if user else None
+
+    def findRepository(self, path):
+        #A snapshot of the repository, None if the path doesn't resolve
+        return self._submit(database.Repository.findCachedByPath, path)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
@@ -0,0 +1,39 @@
+import os
+import socket
+import json
+
+#Must not import database or gitastic, this module is loaded on the fast path of gitastic-shell
+DEFAULT_SOCKET="/var/run/gitastic/authd.sock"
+DEFAULT_TIMEOUT=5.0
+MAX_RESPONSE=65536
+
+class DaemonUnavailable(Exception):
+    pass
+
+def getSocketPath():
+    return os.environ.get("GITASTIC_AUTHD_SOCKET") or DEFAULT_SOCKET
+
+def authorize(keyid, original_command, path=None, timeout=DEFAULT_TIMEOUT):
+    #Ask gitastic-authd for a decision, raises DaemonUnavailable if it can't give us one
+    sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path or getSocketPath())
+        sock.sendall(json.dumps({"keyid": int(keyid), "command": original_command})+"\n")
+        fp=sock.makefile("r")
+        try:
+            line=fp.readline(MAX_RESPONSE)
+        finally:
+            fp.close()
+    except socket.error as e:
+        raise DaemonUnavailable(str(e))
+    finally:
+        sock.close()
+
+    try:
+        decision=json.loads(line)
+    except ValueError:
+        raise DaemonUnavailable("Invalid response from the daemon")
+    if not isinstance(decision, dict) or "allow" not in decision:
+        raise DaemonUnavailable("Invalid response from the daemon")
+    return decision
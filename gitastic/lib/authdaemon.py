@@ -0,0 +1,61 @@
+import os
+import json
+import threading
+import Queue
+import SocketServer
+import gitastic
+import database
+import shellauth
+from authclient import DEFAULT_SOCKET
+
+MAX_REQUEST=65536
+
+class AuthRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            request=json.loads(self.rfile.readline(MAX_REQUEST))
+            decision=shellauth.authorize(int(request["keyid"]), request["command"])
+        except shellauth.ShellAuthError as e:
+            decision={"allow": False, "message": str(e), "outcome": e.outcome}
+        except (ValueError, KeyError, TypeError):
+            decision={"allow": False, "message": "Malformed authorization request"}
+        finally:
+            #Hand the store back to the pool, rolled back so the next request doesn't answer from a stale snapshot
+            database.releaseStore()
+        self.wfile.write(json.dumps(decision)+"\n")
+
+class AuthDaemon(SocketServer.UnixStreamServer):
+    #A fixed set of worker threads sharing warm stores from the pool
+    def __init__(self, path=None, workers=None):
+        self.socket_path=path or gitastic.config.get("AuthDaemon/Socket", default=DEFAULT_SOCKET)
+        self.workers=int(workers or gitastic.config.get("AuthDaemon/Workers", default=4))
+        self._requests=Queue.Queue(self.workers*16)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        oldmask=os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, self.socket_path, AuthRequestHandler)
+        finally:
+            os.umask(oldmask)
+        for i in range(self.workers):
+            worker=threading.Thread(target=self._work, name="gitastic-authd-%d"%(i,))
+            worker.daemon=True
+            worker.start()
+
+    def _work(self):
+        while True:
+            request, client_address=self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
@@ -0,0 +1,111 @@
+import os
+import time
+import tempfile
+from storm.expr import Select, Count, Max
+import gitastic
+import database
+import sshkeys
+
+MARKER_PREFIX="# gitastic-authkeys "
+BATCH_SIZE=1000
+
+def getShell():
+    return gitastic.config.get("AuthorizedKeys/Shell", default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gitastic-shell"))
+
+def getAuthorizedKeysFile():
+    return gitastic.config.get("AuthorizedKeys/File", default=os.path.expanduser("~/.ssh/authorized_keys"))
+
+def getMarker():
+    #Changes whenever a key is added or removed: row count, highest id and newest timestamp
+    count, max_id, max_timestamp=database.getStore().execute(Select(
+        (Count(), Max(database.UserSSHKey.user_ssh_key_id), Max(database.UserSSHKey.timestamp)),
+        tables=database.UserSSHKey)).get_one()
+    return "%d:%d:%s"%(count, max_id or 0, max_timestamp or "-")
+
+def readMarker(path):
+    #The marker of the keys a file was generated from, stored as its first line (sshd ignores comments)
+    try:
+        with open(path, "r") as fp:
+            line=fp.readline()
+    except IOError:
+        return None
+    if not line.startswith(MARKER_PREFIX):
+        return None
+    return line[len(MARKER_PREFIX):].strip()
+
+def iterKeys(batch_size=BATCH_SIZE):
+    #Stream (user_ssh_key_id, key) in id order without loading every key object into the store
+    last_id=0
+    while True:
+        rows=list(database.getStore().find(database.UserSSHKey, database.UserSSHKey.user_ssh_key_id>last_id)
+            .order_by(database.UserSSHKey.user_ssh_key_id)[:batch_size]
+            .values(database.UserSSHKey.user_ssh_key_id, database.UserSSHKey.key))
+        for row in rows:
+            yield row
+        if len(rows)<batch_size:
+            break
+        last_id=rows[-1][0]
+
+def lookup(fingerprint):
+    #The single authorized_keys line for sshd's AuthorizedKeysCommand, None if no key has this fingerprint
+    try:
+        key=database.UserSSHKey.findByFingerprint(fingerprint)
+        if key is None:
+            return None
+        return sshkeys.formatKeyLine(key.user_ssh_key_id, key.key, getShell(),
+            gitastic.config.get("AuthorizedKeys/Options", default=sshkeys.DEFAULT_OPTIONS))
+    finally:
+        database.getStore().rollback()
+
+def writeAuthorizedKeys(path, lines, marker):
+    #Write next to the target and rename over it so sshd never sees a partial file
+    directory=os.path.dirname(os.path.abspath(path))
+    fd, temp_path=tempfile.mkstemp(prefix=".authorized_keys.", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write("%s%s\n"%(MARKER_PREFIX, marker))
+            for line in lines:
+                fp.write(line)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.chmod(temp_path, 0600)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+def sync(path=None, force=False, batch_size=BATCH_SIZE):
+    #Regenerate path from user_ssh_key if the keys changed since it was written, returns True if it was written
+    path=path or getAuthorizedKeysFile()
+    shell=getShell()
+    options=gitastic.config.get("AuthorizedKeys/Options", default=sshkeys.DEFAULT_OPTIONS)
+    try:
+        marker=getMarker()
+        if not force and readMarker(path)==marker:
+            return False
+        lines=(sshkeys.formatKeyLine(keyid, key, shell, options) for keyid, key in iterKeys(batch_size))
+        writeAuthorizedKeys(path, (line for line in lines if line), marker)
+        return True
+    finally:
+        #Release the snapshot, the next sync has to see new keys
+        database.getStore().rollback()
+
+def watch(path=None, interval=5.0, settle=2.0, max_delay=30.0):
+    #Keep path in sync, a burst of key changes is written once it has been quiet for settle seconds
+    #(or max_delay seconds after it started, whichever comes first)
+    path=path or getAuthorizedKeysFile()
+    while True:
+        marker=getMarker()
+        database.getStore().rollback()
+        if marker!=readMarker(path):
+            started=time.time()
+            while time.time()-started<max_delay:
+                time.sleep(settle)
+                latest=getMarker()
+                database.getStore().rollback()
+                if latest==marker:
+                    break
+                marker=latest
+            sync(path)
+        time.sleep(interval)
@@ -0,0 +1,261 @@
+import os
+import re
+import sys
+import csv
+import json
+import time
+import itertools
+import multiprocessing
+from datetime import datetime
+from storm.expr import Insert
+import sshkeys
+import database
+
+#Loading users and their keys from another setup (gitastic-admin import) without going through the models a row
+#at a time.  A reader streams (username, email, key name, key) records from the source, a pool of processes
+#checks the keys, and every batch_size records go in as multi-row inserts in one transaction of their own.
+#Keys already stored (by fingerprint, so by key blob) are skipped and users already there get the new keys,
+#which makes it safe to run the same source again.  After each transaction the number of records done is
+#written to a state file, a run that stopped part way carries on after them
+
+class BulkImportError(Exception):
+    pass
+
+_KEY=re.compile(r"(?:^|\s)((?:ssh|ecdsa|sk)-\S+)\s+([A-Za-z0-9+/=]+)(?:\s+(.*))?$")
+_COMMAND=re.compile(r'command="([^"]*)"')
+
+def _splitKeyLine(line):
+    #(options, key) for an authorized_keys or .pub line, None if there's no key in it
+    match=_KEY.search(line)
+    if match is None:
+        return None
+    return line[:match.start()].strip(), match.group(0).strip()
+
+def _commentUser(key):
+    parts=key.split(None, 2)
+    return parts[2].split("@")[0] if len(parts)>2 else None
+
+def readAuthorizedKeys(path):
+    #The user is the last argument of the forced command, which is how gitolite writes them, or else the part of
+    #the key comment before the @
+    with open(path, "r") as fp:
+        for line in fp:
+            line=line.strip()
+            if not line or line.startswith("#"):
+                continue
+            split=_splitKeyLine(line)
+            if split is None:
+                yield None, u"", None, line
+                continue
+            options, key=split
+            command=_COMMAND.search(options)
+            username=command.group(1).split()[-1] if command and command.group(1).split() else _commentUser(key)
+            yield username, u"", None, key
+
+def _keydirUser(filename):
+    #gitolite: keydir/alice.pub and keydir/alice@laptop.pub are both alice, keydir/alice@example.com.pub is
+    #alice@example.com
+    name=filename[:-len(".pub")]
+    if "@" in name and "." not in name.rsplit("@", 1)[1]:
+        name=name.rsplit("@", 1)[0]
+    return name
+
+def readKeydir(path):
+    if not os.path.isdir(path):
+        raise BulkImportError("%s is not a directory"%(path,))
+    for directory, directories, files in os.walk(path):
+        #The same order every time, a resumed run counts the same records
+        directories.sort()
+        for filename in sorted(files):
+            if not filename.endswith(".pub"):
+                continue
+            with open(os.path.join(directory, filename), "r") as fp:
+                for line in fp:
+                    line=line.strip()
+                    if line and not line.startswith("#"):
+                        split=_splitKeyLine(line)
+                        yield _keydirUser(filename), u"", filename, split[1] if split else line
+
+def readCSV(path):
+    #A header row naming at least username and key, email and name are optional
+    with open(path, "rb") as fp:
+        reader=csv.DictReader(fp)
+        if not reader.fieldnames or "username" not in reader.fieldnames or "key" not in reader.fieldnames:
+            raise BulkImportError("%s needs a header row with username and key columns"%(path,))
+        for row in reader:
+            yield row["username"], (row.get("email") or "").decode("utf-8"), row.get("name") or None, row["key"] or ""
+
+readers={
+    "authorized-keys": readAuthorizedKeys,
+    "gitolite": readKeydir,
+    "csv": readCSV,
+}
+
+def _checkRecord(record):
+    #Runs in the pool: the record with the key rebuilt from its parsed parts and its fingerprint, or the reason
+    #it can't be imported
+    position, username, email, name, key=record
+    username=username.decode("utf-8") if isinstance(username, str) else username
+    key=key.strip()
+    if len(key.split())==2:
+        #sshkeys wants a comment
+        key="%s %s"%(key, (username or u"imported").encode("utf-8"))
+    fingerprint=sshkeys.getFingerprint(key)
+    if fingerprint is None:
+        return position, None, "not a valid public key"
+    if not username:
+        return position, None, "no user name"
+    key_type, key_data, comment=sshkeys.parseKey(key)
+    key=u"%s %s %s"%(key_type, key.split()[1], comment.decode("utf-8", "replace"))
+    name=name.decode("utf-8", "replace") if isinstance(name, str) else name
+    return position, (username, email, name or u"imported", key, unicode(fingerprint)), None
+
+class BulkImport(object):
+    def __init__(self, format, source, batch_size=1000, workers=None, state_file=None, out=sys.stdout, errors=sys.stderr, clock=time.time):
+        if format not in readers:
+            raise BulkImportError("Unknown format %s, one of %s"%(format, ", ".join(sorted(readers))))
+        self.format=format
+        self.source=os.path.abspath(source)
+        self.batch_size=int(batch_size)
+        self.workers=multiprocessing.cpu_count() if workers is None else int(workers)
+        self.state_file=state_file or self.source.rstrip("/")+".import-state"
+        self.out=out
+        #Every record that's left out, and why
+        self.errors=errors
+        self.clock=clock
+        self.counts=dict(records=0, users=0, keys=0, duplicates=0, invalid=0)
+
+    def loadState(self):
+        #Records already done in an earlier run, 0 without a state file
+        if not os.path.exists(self.state_file):
+            return 0
+        with open(self.state_file, "r") as fp:
+            state=json.load(fp)
+        if state.get("source")!=self.source or state.get("format")!=self.format:
+            raise BulkImportError("%s belongs to an import of %s (%s)"%(self.state_file, state.get("source"), state.get("format")))
+        return int(state["position"])
+
+    def _saveState(self, position):
+        temp=self.state_file+".tmp"
+        with open(temp, "w") as fp:
+            json.dump(dict(source=self.source, format=self.format, position=position, updated=datetime.utcnow().isoformat()), fp)
+        os.rename(temp, self.state_file)
+
+    def _records(self, done):
+        for position, record in enumerate(readers[self.format](self.source), 1):
+            if position>done:
+                yield (position,)+tuple(record)
+
+    def _insertBatch(self, store, batch):
+        #batch is [(username, email, name, key, fingerprint)], in one transaction with the caller committing
+        fingerprints=set()
+        for chunk in database._chunks([row[4] for row in batch]):
+            fingerprints.update(store.find(database.UserSSHKey.fingerprint, database.UserSSHKey.fingerprint.is_in(chunk)))
+        rows=[]
+        for row in batch:
+            if row[4] in fingerprints:
+                self.counts["duplicates"]+=1
+            else:
+                fingerprints.add(row[4])
+                rows.append(row)
+
+        lowers=dict()
+        for row in rows:
+            lowers.setdefault(database.User.normalizeUsername(row[0]), row)
+        user_ids=self._userIds(store, lowers.keys())
+        new_users=[]
+        for lower, row in lowers.items():
+            if lower in user_ids:
+                continue
+            try:
+                database.User.validateUsername(row[0])
+            except database.ValidationError:
+                continue
+            new_users.append((row[0], lower, row[1], u""))
+        for chunk in database._chunks(new_users):
+            store.execute(Insert((database.User.username, database.User.username_lower, database.User.email, database.User.password), values=chunk), noresult=True)
+        self.counts["users"]+=len(new_users)
+        if new_users:
+            user_ids.update(self._userIds(store, [user[1] for user in new_users]))
+
+        now=datetime.utcnow()
+        keys=[]
+        for username, email, name, key, fingerprint in rows:
+            user_id=user_ids.get(database.User.normalizeUsername(username))
+            if user_id is None:
+                self._reject(username, "not a valid user name")
+                continue
+            keys.append((user_id, name, key, now, u"0.0.0.0", fingerprint))
+        for chunk in database._chunks(keys):
+            store.execute(Insert((database.UserSSHKey.user_id, database.UserSSHKey.name, database.UserSSHKey.key,
+                database.UserSSHKey.timestamp, database.UserSSHKey.added_from_ip, database.UserSSHKey.fingerprint), values=chunk), noresult=True)
+        self.counts["keys"]+=len(keys)
+
+    def _userIds(self, store, lowers):
+        user_ids=dict()
+        for chunk in database._chunks(list(lowers)):
+            user_ids.update((lower, user_id) for user_id, lower in store.find((database.User.user_id, database.User.username_lower), database.User.username_lower.is_in(chunk)))
+        return user_ids
+
+    def _reject(self, where, reason):
+        self.counts["invalid"]+=1
+        self.errors.write("%s: %s\n"%(where, reason))
+
+    def _report(self, began, done):
+        elapsed=max(self.clock()-began, 0.001)
+        self.out.write("%d records done, %d users and %d keys added, %d duplicate keys, %d invalid, %.0f records/s\n"%(
+            done, self.counts["users"], self.counts["keys"], self.counts["duplicates"], self.counts["invalid"], self.counts["records"]/elapsed))
+        self.out.flush()
+
+    def _submit(self, pool, records):
+        #The next batch_size records checked, as a result for get() so the pool works on one batch while the
+        #previous one is inserted; None once the source is used up
+        batch=list(itertools.islice(records, self.batch_size))
+        if not batch:
+            return None
+        if pool is None:
+            return _Checked(map(_checkRecord, batch))
+        return pool.map_async(_checkRecord, batch, chunksize=max(1, len(batch)//(self.workers*4)))
+
+    def run(self):
+        done=self.loadState()
+        if done:
+            self.out.write("Resuming %s after %d records\n"%(self.source, done))
+        #Before the store, so the processes don't inherit its connection
+        pool=multiprocessing.Pool(self.workers) if self.workers>1 else None
+        store=database.getStore()
+        try:
+            records=self._records(done)
+            began=self.clock()
+            pending=self._submit(pool, records)
+            while pending is not None:
+                checked=pending.get()
+                pending=self._submit(pool, records)
+                batch=[]
+                for position, row, reason in checked:
+                    self.counts["records"]+=1
+                    if row is None:
+                        self._reject("Record %d"%(position,), reason)
+                    else:
+                        batch.append(row)
+                self._insertBatch(store, batch)
+                store.commit()
+                self._saveState(position)
+                self._report(began, position)
+        except:
+            store.rollback()
+            raise
+        finally:
+            if pool:
+                pool.terminate()
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+        return self.counts
+
+class _Checked(object):
+    #The results of checking a batch without a pool, looks like the AsyncResult of map_async
+    def __init__(self, results):
+        self.results=results
+
+    def get(self):
+        return self.results
@@ -1,48 +1,474 @@
 import threading
-import base64
-import binascii
-import struct
-import tempfile
-import shutil
 import os
-import pwd
-import subprocess
 import re
+import time
+from thread import get_ident
+from contextlib import contextmanager
 from datetime import datetime
-from storm.locals import *
-from storm.expr import *
+from storm.database import create_database
+from storm.uri import URI
+from storm.variables import Variable
+from storm.tracer import install_tracer
+from storm.store import Store
+from storm.properties import Int, Unicode, Bool, DateTime
+from storm.references import Reference, ReferenceSet
+from storm.info import ClassAlias, get_cls_info
+from storm.expr import And, Or, LeftJoin, Insert, Update
 from storm.exceptions import NotOneError
-import bcrypt
 import gitastic
+import sshkeys
+import objectcache
+#passwords (bcrypt and its process pool), pwd and the repository creation helpers (subprocess, tempfile, shutil) are imported where they are
+#used, gitastic-shell only needs the models to check access and shouldn't pay to load them
 
 class DatabaseError(Exception):
     pass
 
 database=None
-stores=dict()
-stores_lock=threading.RLock()
+pool=None
+#Snapshots of users, teams and repositories shared by every thread, None unless ObjectCache/Size is set
+objects=None
+#(file, seconds) from Database/SlowQueryLog and Database/SlowQueryThreshold, None when there's no log
+slow_query_log=None
+_tracer=None
+_local=threading.local()
+
+class _Store(Store):
+    #Keys of cached snapshots this store changed are dropped again when the transaction ends, another thread may
+    #have cached the old row in between the flush and the commit
+    def __init__(self, database):
+        super(_Store, self).__init__(database)
+        self._gitastic_flushed=set()
+
+    def _forgetFlushed(self):
+        flushed, self._gitastic_flushed=self._gitastic_flushed, set()
+        if objects is not None:
+            for key in flushed:
+                objects.invalidate(key)
+
+    def commit(self):
+        super(_Store, self).commit()
+        self._forgetFlushed()
+
+    def rollback(self):
+        super(_Store, self).rollback()
+        self._forgetFlushed()
+
+class StorePool(object):
+    #A bounded set of stores shared by every thread.  Idle stores are reused most recently used first, closed
+    #once idle for longer than max_idle and checked with a trivial query if idle for longer than check_after
+    def __init__(self, database, size=10, timeout=30, max_idle=300, check_after=30, on_connect=None):
+        self.database=database
+        #Called with every new store, before anyone gets to use it
+        self.on_connect=on_connect
+        self.size=size
+        self.timeout=timeout
+        self.max_idle=max_idle
+        self.check_after=check_after
+        #sqlite connections can only be used by the thread that opened them
+        self.thread_bound=database.__class__.__name__=="SQLite"
+        self.closed=False
+        self._idle=[]
+        self._open=dict()
+        self._condition=threading.Condition(threading.Lock())
+        self.metrics=dict(created=0, checkouts=0, waits=0, timeouts=0, reaped=0, discarded=0)
+
+    def _take(self):
+        #The most recently used idle store this thread may use, None if there isn't one
+        tid=get_ident()
+        for i in range(len(self._idle)-1, -1, -1):
+            store, owner, last_used=self._idle[i]
+            if not self.thread_bound or owner==tid:
+                del self._idle[i]
+                return store, last_used
+        return None, None
+
+    def _discard(self, store):
+        #Forget a store, sqlite stores from other threads can't even be closed so they're left to the garbage collector
+        self._open.pop(id(store), None)
+        if self.thread_bound and getattr(store, "_gitastic_thread", None)!=get_ident():
+            return
+        try:
+            store.close()
+        except Exception:
+            pass
+
+    def checkout(self, timeout=None):
+        #Waits up to timeout seconds (the pool's timeout by default, 0 doesn't wait) for a store
+        timeout=self.timeout if timeout is None else timeout
+        deadline=time.time()+timeout
+        self._condition.acquire()
+        try:
+            while True:
+                if self.closed:
+                    raise DatabaseError("The database connection has been closed")
+                now=time.time()
+                self._reap(now)
+                store, last_used=self._take()
+                if store is None and len(self._open)>=self.size and self.thread_bound and self._idle:
+                    #Make room by dropping a store only another thread could use
+                    self._discard(self._idle.pop(0)[0])
+                    self.metrics["discarded"]+=1
+                if store is not None or len(self._open)<self.size:
+                    break
+                if now>=deadline:
+                    self.metrics["timeouts"]+=1
+                    raise DatabaseError("No database connection became available within %d seconds"%(timeout,))
+                self.metrics["waits"]+=1
+                self._condition.wait(deadline-now)
+            self.metrics["checkouts"]+=1
+            if store is None:
+                #Reserve the slot before connecting outside the lock
+                store=_PendingStore()
+                self._open[id(store)]=store
+        finally:
+            self._condition.release()
+
+        if isinstance(store, _PendingStore):
+            return self._create(store)
+        if now-last_used>self.check_after and not self._healthy(store):
+            #Connect again in the same slot
+            pending=_PendingStore()
+            self._condition.acquire()
+            try:
+                self._discard(store)
+                self.metrics["discarded"]+=1
+                self._open[id(pending)]=pending
+            finally:
+                self._condition.release()
+            return self._create(pending)
+        return store
+
+    def _create(self, pending):
+        try:
+            store=_Store(self.database)
+            if self.on_connect:
+                self.on_connect(store)
+        except:
+            self._condition.acquire()
+            try:
+                self._open.pop(id(pending), None)
+                self._condition.notify()
+            finally:
+                self._condition.release()
+            raise
+        store._gitastic_thread=get_ident()
+        self._condition.acquire()
+        try:
+            self._open.pop(id(pending), None)
+            self._open[id(store)]=store
+            self.metrics["created"]+=1
+        finally:
+            self._condition.release()
+        return store
+
+    def _healthy(self, store):
+        try:
+            store.execute("SELECT 1")
+            store.rollback()
+            return True
+        except Exception:
+            return False
+
+    def checkin(self, store):
+        #Give a store back, whatever transaction it has open is rolled back
+        healthy=True
+        if not self.thread_bound or getattr(store, "_gitastic_thread", None)==get_ident():
+            try:
+                store.rollback()
+            except Exception:
+                healthy=False
+        else:
+            healthy=False
+        self._condition.acquire()
+        try:
+            if id(store) not in self._open:
+                #Already closed by close() or disconnect()
+                return
+            if healthy and not self.closed:
+                self._idle.append((store, store._gitastic_thread, time.time()))
+            else:
+                self._discard(store)
+                self.metrics["discarded"]+=1
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        store=self.checkout(timeout)
+        try:
+            yield store
+        finally:
+            self.checkin(store)
+
+    def _reap(self, now):
+        while self._idle and now-self._idle[0][2]>self.max_idle:
+            self._discard(self._idle.pop(0)[0])
+            self.metrics["reaped"]+=1
+
+    def reap(self):
+        self._condition.acquire()
+        try:
+            self._reap(time.time())
+        finally:
+            self._condition.release()
+
+    def close(self):
+        #Close every store, including ones still checked out
+        self._condition.acquire()
+        try:
+            self.closed=True
+            for store in self._open.values():
+                if not isinstance(store, _PendingStore):
+                    self._discard(store)
+            self._open.clear()
+            self._idle=[]
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+
+    def getMetrics(self):
+        self._condition.acquire()
+        try:
+            metrics=dict(self.metrics)
+            metrics.update(size=self.size, open=len(self._open), idle=len(self._idle), in_use=len(self._open)-len(self._idle))
+            return metrics
+        finally:
+            self._condition.release()
+
+class _PendingStore(object):
+    #Holds a slot in the pool while a new store connects
+    pass
+
+class _StoreHolder(object):
+    #A thread's store from getStore(), handed back to the pool when the thread ends and its locals go away
+    def __init__(self, pool):
+        self.pool=pool
+        self.store=pool.checkout()
+
+    def release(self):
+        if self.store is not None:
+            store, self.store=self.store, None
+            self.pool.checkin(store)
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass
 
 def getStore():
-    global database, stores, stores_lock
-    if database is None:
+    #The store for this thread, checked out of the pool on first use and kept until releaseStore() or the thread ends
+    if database is None or pool is None:
         raise DatabaseError("The database connection has not yet been established")
-    tid=threading.current_thread().ident
-    stores_lock.acquire(blocking=1)
-    if tid not in stores:
-        stores[tid]=Store(database)
-    stores_lock.release()
-    return stores[tid]
+    holder=getattr(_local, "holder", None)
+    if holder is None or holder.pool is not pool or holder.store is None:
+        holder=_StoreHolder(pool)
+        _local.holder=holder
+    return holder.store
+
+def releaseStore():
+    #Return this thread's store to the pool early, a worker that's done with the database for a while should
+    holder=getattr(_local, "holder", None)
+    if holder is not None:
+        _local.holder=None
+        holder.release()
+
+def getPoolMetrics():
+    return pool.getMetrics() if pool else None
+
+class QueryProfile(object):
+    #The statements a unit of work (a shell session, a request, a test) sent, see profile()
+    def __init__(self):
+        self.queries=0
+        self.time=0.0
+        self.statements=[]
+
+    def start(self):
+        _installTracer()
+        if getattr(_local, "profiles", None) is None:
+            _local.profiles=[]
+        _local.profiles.append(self)
+
+    def stop(self):
+        if self in getattr(_local, "profiles", ()):
+            _local.profiles.remove(self)
+
+    def record(self, statement, params, elapsed):
+        self.queries+=1
+        self.time+=elapsed
+        self.statements.append((statement, params, elapsed))
+
+    def getDuplicates(self):
+        #[(statement, params, times run)] for everything sent more than once with the same parameters, most
+        #repeated first.  A lookup repeated per row of an earlier result (N+1) shows up here
+        counts={}
+        for statement, params, elapsed in self.statements:
+            counts[(statement, params)]=counts.get((statement, params), 0)+1
+        return sorted(((statement, params, count) for (statement, params), count in counts.items() if count>1), key=lambda duplicate: -duplicate[2])
+
+    def report(self):
+        out=["%d queries in %.2fms"%(self.queries, self.time*1000)]
+        for statement, params, elapsed in self.statements:
+            out.append("  %8.2fms %s %r"%(elapsed*1000, _oneLine(statement), params))
+        for statement, params, count in self.getDuplicates():
+            out.append("  %dx duplicate: %s %r"%(count, _oneLine(statement), params))
+        return "\n".join(out)
+
+@contextmanager
+def profile():
+    #Count the statements this thread sends in the block, how long they took and which were repeated:
+    #  with database.profile() as queries:
+    #      repo.getAccess(user)
+    #  print queries.report()
+    current=QueryProfile()
+    current.start()
+    try:
+        yield current
+    finally:
+        current.stop()
+
+def _oneLine(statement):
+    return " ".join(statement.split())
+
+class _QueryTracer(object):
+    #Installed once, times every statement for the profiles running in the same thread and the slow query log
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        _local.query_started=time.time()
+
+    def connection_raw_execute_success(self, connection, raw_cursor, statement, params):
+        self._done(statement, params)
+
+    def connection_raw_execute_error(self, connection, raw_cursor, statement, params, error):
+        self._done(statement, params)
+
+    def _done(self, statement, params):
+        started=getattr(_local, "query_started", None)
+        if started is None:
+            return
+        _local.query_started=None
+        elapsed=time.time()-started
+        profiles=getattr(_local, "profiles", None)
+        log=slow_query_log
+        if not profiles and not (log and elapsed>=log[1]):
+            return
+        params=tuple(param.get() if isinstance(param, Variable) else param for param in params)
+        for current in profiles or ():
+            current.record(statement, params, elapsed)
+        if log and elapsed>=log[1]:
+            _writeSlowQuery(log[0], statement, params, elapsed)
+
+def _writeSlowQuery(path, statement, params, elapsed):
+    #One O_APPEND write per statement like the shell timing log, lines from concurrent processes don't interleave
+    line="%.3f %d %.2fms %s %r\n"%(time.time(), os.getpid(), elapsed*1000, _oneLine(statement), params)
+    try:
+        fd=os.open(path, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0640)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def _installTracer():
+    global _tracer
+    if _tracer is None:
+        _tracer=_QueryTracer()
+        install_tracer(_tracer)
+
+def getCacheMetrics():
+    return objects.getMetrics() if objects else None
+
+def _createDatabase(uri):
+    uri=URI(uri)
+    if uri.scheme=="sqlite":
+        #Settings storm applies to every new sqlite connection, tuned for lots of short concurrent reads.
+        #Anything already given in the URI (sqlite:/path?timeout=10) wins
+        for option, key, default in (
+                ("journal_mode", "Database/SQLite/JournalMode", "WAL"),
+                ("synchronous", "Database/SQLite/Synchronous", "NORMAL"),
+                ("timeout", "Database/SQLite/BusyTimeout", 5),
+                ("foreign_keys", "Database/SQLite/ForeignKeys", "ON")):
+            if option not in uri.options:
+                uri.options[option]=str(gitastic.config.get(key, default=default))
+    return create_database(uri)
+
+def _tuneSQLite(store):
+    #Per connection settings storm has no URI option for
+    store.execute("PRAGMA mmap_size=%d"%(int(gitastic.config.get("Database/SQLite/MmapSize", default=256*1024*1024)),))
+    store.execute("PRAGMA cache_size=%d"%(int(gitastic.config.get("Database/SQLite/CacheSize", default=-64*1024)),))
+    store.commit()
 
 def connect():
-    global database
+    global database, pool, objects, slow_query_log
     if database is None:
-        database=create_database(gitastic.config.get("DatabaseURI", do_except=True))
+        database=_createDatabase(gitastic.config.get("DatabaseURI", do_except=True))
+        pool=StorePool(database,
+            size=int(gitastic.config.get("Database/PoolSize", default=10)),
+            timeout=float(gitastic.config.get("Database/PoolTimeout", default=30)),
+            max_idle=float(gitastic.config.get("Database/PoolMaxIdle", default=300)),
+            check_after=float(gitastic.config.get("Database/PoolCheckAfter", default=30)),
+            on_connect=_tuneSQLite if database.__class__.__name__=="SQLite" else None)
+        size=int(gitastic.config.get("ObjectCache/Size", default=0))
+        objects=objectcache.ObjectCache(size=size, ttl=float(gitastic.config.get("ObjectCache/TTL", default=30))) if size else None
+        path=gitastic.config.get("Database/SlowQueryLog", default=None)
+        slow_query_log=(path, float(gitastic.config.get("Database/SlowQueryThreshold", default=1))) if path else None
+        if slow_query_log:
+            _installTracer()
+
+def disconnect():
+    #Close every store and forget the database, the next connect() starts over
+    global database, pool, objects
+    if pool is not None:
+        pool.close()
+    _local.holder=None
+    database=None
+    pool=None
+    objects=None
 
 class Model(object):
     def __init__(self, **kwargs):
         for k,v in kwargs.items():
             setattr(self, k, v)
 
+class AclVersion(Model):
+    #A single row counting changes to who can access what, cached access decisions are only good for one version
+    __storm_table__="acl_version"
+    acl_version_id=Int(primary=True)
+    version=Int()
+
+def getAclVersion():
+    #Always asks the database, a cached AclVersion object would happily report an old version
+    versions=list(getStore().find(AclVersion, AclVersion.acl_version_id==1).values(AclVersion.version))
+    return versions[0] if versions else None
+
+def bumpAclVersion():
+    #Call from anything that changes access, in the same transaction as the change
+    getStore().find(AclVersion, AclVersion.acl_version_id==1).set(version=AclVersion.version+1)
+
+#Rows per multi-row INSERT and ids per IN (...) in bulk access changes
+ACCESS_CHUNK=500
+
+def _chunks(items, size=ACCESS_CHUNK):
+    items=list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start+size]
+
+def _userIds(users):
+    #Users or user ids -> user ids, in the same order
+    return [user.user_id if isinstance(user, User) else int(user) for user in users]
+
+def _accessByUserId(accesses, valid):
+    #{user or user_id: access} -> {user_id: access}, every level checked before anything is changed
+    getStore().flush()
+    by_user_id={}
+    for user, access in accesses.items():
+        if access not in valid:
+            raise RepositoryError("Access must be a valid access level")
+        by_user_id[user.user_id if isinstance(user, User) else int(user)]=access
+    return by_user_id
+
 class ModelError(Exception):
     pass
 
@@ -58,32 +484,274 @@ class FilesystemPathValidationMixin(object):
         if not re.match(ur"^[\w\d_-]+$", value):
             raise ValidationError(message or "validation failed")
 
-class User(Model, FilesystemPathValidationMixin):
+class Snapshot(object):
+    #Read-only copy of a row's columns that any thread may use, load() returns the live object in this thread's store
+    def __init__(self, cls, values):
+        self.__dict__["_cls"]=cls
+        self.__dict__.update(values)
+
+    def __setattr__(self, name, value):
+        raise ModelError("Snapshots are read-only, change the object from load() instead")
+
+    def load(self):
+        return getStore().get(self._cls, getattr(self, self._cls._primaryName()))
+
+class CachedModelMixin(object):
+    #Read-through lookups in the objects cache, used for rows that are read much more often than they change.
+    #Anything flushed through storm drops its snapshot, bulk statements (find().set()) don't and are only
+    #caught by ObjectCache/TTL, as are changes made by other processes
+    #Columns looked up through _findCached/_findLive, a flushed row drops the cached mapping for its value so
+    #that a second row taking the value makes the lookup ambiguous again
+    _cachedBy=()
+
+    @classmethod
+    def _primaryName(self):
+        info=get_cls_info(self)
+        return [name for name, column in info.attributes.items() if column is info.primary_key[0]][0]
+
+    @classmethod
+    def _snapshot(self, obj):
+        snapshot=Snapshot(self, dict((name, getattr(obj, name)) for name in get_cls_info(self).attributes))
+        key=(self.__name__, getattr(obj, self._primaryName()))
+        #Not before this store's own changes to it are committed
+        if objects is not None and key not in getattr(Store.of(obj), "_gitastic_flushed", ()):
+            objects.put(key, snapshot)
+        return snapshot
+
+    @classmethod
+    def getCached(self, primary):
+        snapshot=objects.get((self.__name__, int(primary))) if objects is not None else None
+        if snapshot is None:
+            obj=getStore().get(self, int(primary))
+            snapshot=self._snapshot(obj) if obj is not None else None
+        return snapshot
+
+    @classmethod
+    def _findCached(self, attribute, value):
+        #attribute must be unique, the cache maps its value to the primary key
+        if objects is not None:
+            primary=objects.get((self.__name__, attribute, value))
+            snapshot=objects.get((self.__name__, primary), count=False) if primary is not None else None
+            if snapshot is not None and getattr(snapshot, attribute)==value:
+                return snapshot
+        try:
+            obj=getStore().find(self, getattr(self, attribute)==value).one()
+        except NotOneError:
+            return None
+        if obj is None:
+            return None
+        snapshot=self._snapshot(obj)
+        if objects is not None:
+            objects.put((self.__name__, attribute, value), getattr(obj, self._primaryName()))
+        return snapshot
+
+    @classmethod
+    def _findLive(self, attribute, value):
+        #_findCached for the live object in this thread's store: the cached value -> primary key turns the lookup
+        #into store.get(), no query at all for an object the store already holds and a primary key lookup for one
+        #it has to reload.  The mapping can be ObjectCache/TTL old, so the object is checked against value
+        store=getStore()
+        if objects is not None:
+            primary=objects.get((self.__name__, attribute, value))
+            if primary is not None:
+                #Pending renames first, as find() would
+                store.flush()
+                obj=store.get(self, primary)
+                if obj is not None and getattr(obj, attribute)==value:
+                    return obj
+        try:
+            obj=store.find(self, getattr(self, attribute)==value).one()
+        except NotOneError:
+            return None
+        if obj is not None and objects is not None:
+            objects.put((self.__name__, attribute, value), getattr(obj, self._primaryName()))
+        return obj
+
+    def _forgetCached(self):
+        keys=[(self.__class__.__name__, getattr(self, self._primaryName()))]
+        keys.extend((self.__class__.__name__, attribute, getattr(self, attribute)) for attribute in self._cachedBy)
+        flushed=getattr(Store.of(self), "_gitastic_flushed", None)
+        for key in keys:
+            if objects is not None:
+                objects.invalidate(key)
+            if flushed is not None:
+                flushed.add(key)
+
+    def __storm_flushed__(self):
+        self._forgetCached()
+
+class User(Model, FilesystemPathValidationMixin, CachedModelMixin):
     __storm_table__="user"
+    _cachedBy=("username_lower",)
     user_id=Int(primary=True)
     username=Unicode(default=u"")
+    #Kept up to date from username on every flush, the unique index every lookup by name goes through
+    username_lower=Unicode(default=u"")
     email=Unicode(default=u"")
     password=Unicode(default=u"")
 
+    @staticmethod
+    def normalizeUsername(username):
+        return unicode(username).lower()
+
+    def __storm_pre_flush__(self):
+        self.username_lower=self.normalizeUsername(self.username)
+
+    #bcrypt runs in the passwords module's process pool, which raises passwords.HashingBusy when it's swamped
     def setPassword(self, newPassword):
-        self.password=unicode(bcrypt.hashpw(newPassword, bcrypt.gensalt(gitastic.config.get("User/BcryptRounds", default=12))))
+        import passwords
+        if self.password:
+            passwords.getCredentialCache().forgetHash(self.password)
+        self.password=unicode(passwords.getHasher().hash(newPassword))
+
+    def hasPassword(self):
+        #False for users without a usable bcrypt hash, such as imported ones, no password matches those
+        import passwords
+        return passwords.getRounds(self.password) is not None
 
     def checkPassword(self, otherPassword):
-        otherHash=bcrypt.hashpw(otherPassword, self.password)
-        return otherHash==self.password
+        import passwords
+        if not self.hasPassword():
+            return False
+        return passwords.getHasher().check(otherPassword, self.password)
+
+    def checkPasswordFuture(self, otherPassword):
+        import passwords
+        from concurrent.futures import Future
+        if not self.hasPassword():
+            future=Future()
+            future.set_result(False)
+            return future
+        return passwords.getHasher().checkFuture(otherPassword, self.password)
+
+    def issueToken(self, ttl=None):
+        #A signed session token for authenticateToken, good for ttl seconds (User/TokenTTL) or until the password changes
+        import passwords
+        return passwords.issueToken(self.user_id, self.password, ttl)
 
     @classmethod
-    def authenticate(self, username, password):
+    def authenticateToken(self, token):
+        import passwords
+        parsed=passwords.parseToken(token)
+        if parsed is None:
+            return None
+        user=getStore().get(self, parsed[0])
+        return user if user and passwords.checkToken(token, user.password) else None
+
+    @classmethod
+    def findByUsername(self, username):
+        #Without regard to case, an exact match on username_lower so nothing in username acts as a wildcard
+        return self._findLive("username_lower", self.normalizeUsername(username))
+
+    def _rehash(self, password):
+        #Store the password again at the current User/BcryptRounds, in a transaction of its own since whoever
+        #authenticated may never commit, and only if the hash is still the one just checked.  The store comes
+        #from the pool without waiting: with every store in use, or bcrypt swamped, the old hash is kept for the
+        #next login to try again rather than holding this one up
+        import passwords
+        old=self.password
         try:
-            user=getStore().find(self, self.username.like(unicode(username))).one()
-        except NotOneError:
+            store=pool.checkout(timeout=0)
+        except DatabaseError:
+            return
+        try:
+            new=unicode(passwords.getHasher().hash(password))
+            store.execute(Update({User.password: new}, And(User.user_id==self.user_id, User.password==old)))
+            store.commit()
+        except passwords.HashingBusy:
+            return
+        finally:
+            pool.checkin(store)
+        passwords.getCredentialCache().forgetHash(old)
+        #Read back from the database next time it's used
+        Store.of(self).invalidate(self)
+
+    @classmethod
+    def authenticate(self, username, password):
+        import passwords
+        user=self.findByUsername(username)
+        if user is None:
             return None
-        return user if user and user.checkPassword(password) else None
+        credentials=passwords.getCredentialCache()
+        if not credentials.check(username, password, user.password):
+            if not user.checkPassword(password):
+                return None
+            credentials.put(username, password, user.password)
+        if passwords.needsRehash(user.password):
+            user._rehash(password)
+            credentials.put(username, password, user.password)
+        return user
+
+    @classmethod
+    def authenticateFuture(self, username, password):
+        #The user is looked up right away, a future of the user or None once the password has been checked.  The
+        #check finishes on another thread, which can't use this one's store, so hashes are only upgraded by authenticate
+        from concurrent.futures import Future
+        import passwords
+        user=self.findByUsername(username)
+        result=Future()
+        credentials=passwords.getCredentialCache()
+        if user is None or credentials.check(username, password, user.password):
+            result.set_result(user)
+            return result
+        hashed=user.password
+        def checked(future):
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+            elif future.result():
+                credentials.put(username, password, hashed)
+                result.set_result(user)
+            else:
+                result.set_result(None)
+        user.checkPasswordFuture(password).add_done_callback(checked)
+        return result
+
+    def visibleRepositories(self, after=None, limit=100, repositories=None):
+        #[(repository, access)] for the repositories this user can at least view, in repository_id order, with the
+        #same rules as Repository.getAccess and in one statement.  For the next page pass after=the last repository_id,
+        #repositories (objects or ids) only considers those
+        where=[Or(
+            And(Team.team_id!=None, Or(TeamMembership.access>Team.ACC_NONE, RepositoryAccess.access>Repository.ACC_NONE)),
+            And(Team.team_id==None, Or(Repository.public==True, Repository.owner_user_id==self.user_id, RepositoryAccess.access>Repository.ACC_NONE)))]
+        if after is not None:
+            where.append(Repository.repository_id>int(after))
+        if repositories is not None:
+            repository_ids=[repo.repository_id if isinstance(repo, Repository) else int(repo) for repo in repositories]
+            if not repository_ids:
+                return []
+            where.append(Repository.repository_id.is_in(repository_ids))
+        result=getStore().using(
+            Repository,
+            LeftJoin(Team, Team.team_id==Repository.owner_team_id),
+            LeftJoin(RepositoryAccess, And(RepositoryAccess.repository_id==Repository.repository_id, RepositoryAccess.user_id==self.user_id)),
+            LeftJoin(TeamMembership, And(TeamMembership.team_id==Team.team_id, TeamMembership.user_id==self.user_id)),
+        ).find((Repository, Team, RepositoryAccess, TeamMembership), *where).order_by(Repository.repository_id)
+        if limit is not None:
+            result=result[:limit]
+        visible=[]
+        for repo, team, grant, membership in result:
+            visible.append((repo, Repository._computeAccess(
+                grant.access if grant else Repository.ACC_NONE,
+                repo.public,
+                team_owned=team is not None,
+                team_access=membership.access if membership else Team.ACC_NONE,
+                is_owner=team is None and repo.owner_user_id==self.user_id)))
+        return visible
+
+    @classmethod
+    def findCachedByUsername(self, username):
+        return self._findCached("username_lower", self.normalizeUsername(username))
 
     @classmethod
     def validateUsername(self, otherUsername):
         self._validateFilesystemPathComponent(value=otherUsername, message="Your desired username contains invalid characters")
 
+    def setUsername(self, username):
+        #The repository directories it owns are named after it, so cached access decisions (which carry the
+        #directory) go too.  Call setPath on its repositories to go with it
+        self.username=unicode(username)
+        bumpAclVersion()
+
 class UserSSHKey(Model):
     __storm_table__="user_ssh_key"
     user_ssh_key_id=Int(primary=True)
@@ -93,30 +761,33 @@ class UserSSHKey(Model):
     key=Unicode()
     timestamp=DateTime()
     added_from_ip=Unicode(default=u"0.0.0.0")
+    fingerprint=Unicode()
 
     def __init__(self, **kwargs):
         self.timestamp=datetime.utcnow()
         super(UserSSHKey, self).__init__(**kwargs)
 
+    def __storm_pre_flush__(self):
+        #Always follows key, sshd's AuthorizedKeysCommand finds keys by it
+        fingerprint=sshkeys.getFingerprint(self.key) if self.key else None
+        self.fingerprint=unicode(fingerprint) if fingerprint else None
+
+    @classmethod
+    def findByFingerprint(self, fingerprint):
+        return getStore().find(self, self.fingerprint==unicode(fingerprint)).one()
+
+    def delete(self):
+        getStore().remove(self)
+        bumpAclVersion()
+        getStore().commit()
+
     @staticmethod
     def validateKey(keystr):
-        try:
-            keyType, keyData_encoded, keyComment=keystr.split()
-            keyData=base64.decodestring(keyData_encoded)
-            if keyData=="":
-                return False
-        except ValueError:
-            return False
-        except binascii.Error:
-            return False
-
-        typeStrLen=struct.unpack(">I", keyData[:4])[0]
-        typeStr=keyData[4:4+typeStrLen]
-        return typeStr==keyType
+        return sshkeys.validateKey(keystr)
 
 User.keys=ReferenceSet(User.user_id, UserSSHKey.user_id)
 
-class Team(Model, FilesystemPathValidationMixin):
+class Team(Model, FilesystemPathValidationMixin, CachedModelMixin):
     ACC_SUPERADMIN=8
     ACC_ADMIN=4
     ACC_MODERATE=2
@@ -132,6 +803,11 @@ class Team(Model, FilesystemPathValidationMixin):
     def validateName(self, otherName):
         self._validateFilesystemPathComponent(value=otherName, message="Your desired team name contains invalid characters")
 
+    def setName(self, name):
+        #As User.setUsername
+        self.name=unicode(name)
+        bumpAclVersion()
+
     def getAccess(self, other_user):
         acc=None
         try:
@@ -140,14 +816,41 @@ class Team(Model, FilesystemPathValidationMixin):
             return self.ACC_NONE
         return acc.access if acc else self.ACC_NONE
 
+    def getAccessForUsers(self, users):
+        #{user_id: access} for users (objects or ids), one statement per ACCESS_CHUNK users
+        user_ids=_userIds(users)
+        found={}
+        for chunk in _chunks(user_ids):
+            found.update(getStore().find(TeamMembership, TeamMembership.team_id==self.team_id, TeamMembership.user_id.is_in(chunk)).values(TeamMembership.user_id, TeamMembership.access))
+        return dict((user_id, found.get(user_id, self.ACC_NONE)) for user_id in user_ids)
+
     def setAccess(self, other_user, access):
         if access not in (self.ACC_SUPERADMIN, self.ACC_ADMIN, self.ACC_MODERATE, self.ACC_VIEW, self.ACC_NONE):
             raise RepositoryError("Access must be a valid access level")
         getStore().find(TeamMembership, And(TeamMembership.team==self, TeamMembership.user==other_user)).remove()
         if access!=self.ACC_NONE:
             getStore().add(TeamMembership(team=self, user=other_user, access=access))
+        for repo in self.repositories:
+            repo._refreshEffectiveAccess([other_user.user_id])
+        bumpAclVersion()
         getStore().commit()
 
+    def setAccessMany(self, accesses):
+        #setAccess for {user: access} with a few statements and a single commit
+        accesses=_accessByUserId(accesses, (self.ACC_SUPERADMIN, self.ACC_ADMIN, self.ACC_MODERATE, self.ACC_VIEW, self.ACC_NONE))
+        store=getStore()
+        for user_ids in _chunks(accesses):
+            store.find(TeamMembership, TeamMembership.team_id==self.team_id, TeamMembership.user_id.is_in(user_ids)).remove()
+        rows=[(self.team_id, user_id, access) for user_id, access in sorted(accesses.items()) if access!=self.ACC_NONE]
+        for chunk in _chunks(rows):
+            store.execute(Insert((TeamMembership.team_id, TeamMembership.user_id, TeamMembership.access), values=chunk), noresult=True)
+        #The statements above went around storm's cache
+        store.invalidate()
+        for repo in self.repositories:
+            repo._refreshEffectiveAccess(accesses.keys())
+        bumpAclVersion()
+        store.commit()
+
 class TeamMembership(Model):
     __storm_table__="team_membership"
     __storm_primary__=("team_id", "user_id")
@@ -157,7 +860,7 @@ class TeamMembership(Model):
     user=Reference(user_id, User.user_id)
     access=Int()
 
-class Repository(Model, FilesystemPathValidationMixin):
+class Repository(Model, FilesystemPathValidationMixin, CachedModelMixin):
     ACC_OWNER=8
     ACC_ADMIN=4
     ACC_PUSH=2
@@ -170,6 +873,7 @@ class Repository(Model, FilesystemPathValidationMixin):
     PERM_VIEW=PERM_CLONE
 
     __storm_table__="repository"
+    _cachedBy=("path",)
     repository_id=Int(primary=True)
     name=Unicode(default=u"")
     path=Unicode(default=u"")
@@ -186,15 +890,22 @@ class Repository(Model, FilesystemPathValidationMixin):
 
     def setPath(self):
         self.path=unicode(u"/".join((self.getOwnerName(), self.name)))
+        #The old path mustn't find it any more, even before the next flush, and access decisions cached under a
+        #path are only good for the repository that had it then
+        self._forgetCached()
+        bumpAclVersion()
+
+    @staticmethod
+    def _normalizePath(path):
+        return unicode(path[:-4] if path.endswith(".git") else path)
 
     @classmethod
     def findByPath(self, path):
-        repo=None
-        try:
-            repo=getStore().find(self, self.path==unicode(path[:-4] if path.endswith(".git") else path)).one()
-        except NotOneError:
-            pass
-        return repo
+        return self._findLive("path", self._normalizePath(path))
+
+    @classmethod
+    def findCachedByPath(self, path):
+        return self._findCached("path", self._normalizePath(path))
 
     def getOwner(self):
         #Teams take precedence over users
@@ -216,11 +927,10 @@ class Repository(Model, FilesystemPathValidationMixin):
             return self.ACC_NONE
         return acc.access if acc else self.ACC_NONE
 
-    def getAccess(self, other_user):
-        owner=self.getOwner()
-        access=self._getAccess(other_user)
-        if isinstance(owner, Team):
-            team_access=owner.getAccess(other_user)
+    @classmethod
+    def _computeAccess(self, access, public, team_owned=False, team_access=Team.ACC_NONE, is_owner=False):
+        #The one place repository access rules live, shared by getAccess and resolveAccess
+        if team_owned:
             return max(
                 self.ACC_OWNER if team_access==Team.ACC_SUPERADMIN else self.ACC_NONE,
                 self.ACC_ADMIN if team_access==Team.ACC_ADMIN else self.ACC_NONE,
@@ -231,12 +941,36 @@ class Repository(Model, FilesystemPathValidationMixin):
             )
         else:
             return max(
-                self.ACC_OWNER if owner==other_user else self.ACC_NONE,
+                self.ACC_OWNER if is_owner else self.ACC_NONE,
                 access,
-                self.ACC_VIEW if self.public else self.ACC_NONE,
+                self.ACC_VIEW if public else self.ACC_NONE,
                 self.ACC_NONE
             )
 
+    def getAccess(self, other_user):
+        owner=self.getOwner()
+        access=self._getAccess(other_user)
+        if isinstance(owner, Team):
+            return self._computeAccess(access, self.public, team_owned=True, team_access=owner.getAccess(other_user))
+        else:
+            return self._computeAccess(access, self.public, is_owner=owner==other_user)
+
+    def getAccessForUsers(self, users):
+        #{user_id: access} for users (objects or ids), same answers as getAccess with one statement per ACCESS_CHUNK users
+        #for grants and another for team membership
+        user_ids=_userIds(users)
+        owner=self.getOwner()
+        grants={}
+        for chunk in _chunks(user_ids):
+            grants.update(getStore().find(RepositoryAccess, RepositoryAccess.repository_id==self.repository_id, RepositoryAccess.user_id.is_in(chunk)).values(RepositoryAccess.user_id, RepositoryAccess.access))
+        team_grants=owner.getAccessForUsers(user_ids) if isinstance(owner, Team) else {}
+        return dict((user_id, self._computeAccess(
+            grants.get(user_id, self.ACC_NONE),
+            self.public,
+            team_owned=isinstance(owner, Team),
+            team_access=team_grants.get(user_id, Team.ACC_NONE),
+            is_owner=isinstance(owner, User) and owner.user_id==user_id)) for user_id in user_ids)
+
     def setAccess(self, other_user, access):
         if access==self.ACC_OWNER:
             raise RepositoryError("Owner access must be set by changing the repository owner")
@@ -244,19 +978,132 @@ class Repository(Model, FilesystemPathValidationMixin):
             getStore().find(RepositoryAccess, And(RepositoryAccess.repository==self, RepositoryAccess.user==other_user)).remove()
             if access!=self.ACC_NONE:
                 getStore().add(RepositoryAccess(repository=self, user=other_user, access=access))
+            self._refreshEffectiveAccess([other_user.user_id])
+            bumpAclVersion()
             getStore().commit()
         else:
             raise RepositoryError("Access must be a valid access level")
 
+    def setAccessMany(self, accesses):
+        #setAccess for {user: access} with a few statements and a single commit
+        self.setAccessAcross([self], accesses)
+
+    @classmethod
+    def setAccessAcross(self, repositories, accesses):
+        #Give every user in {user: access} that access to every one of repositories, a single commit for all of it
+        if self.ACC_OWNER in accesses.values():
+            raise RepositoryError("Owner access must be set by changing the repository owner")
+        accesses=_accessByUserId(accesses, (self.ACC_ADMIN, self.ACC_PUSH, self.ACC_VIEW, self.ACC_NONE))
+        repositories=list(repositories)
+        store=getStore()
+        repository_ids=[repo.repository_id for repo in repositories]
+        for chunk in _chunks(repository_ids):
+            for user_ids in _chunks(accesses):
+                store.find(RepositoryAccess, RepositoryAccess.repository_id.is_in(chunk), RepositoryAccess.user_id.is_in(user_ids)).remove()
+        rows=[(repository_id, user_id, access) for repository_id in repository_ids for user_id, access in sorted(accesses.items()) if access!=self.ACC_NONE]
+        for chunk in _chunks(rows):
+            store.execute(Insert((RepositoryAccess.repository_id, RepositoryAccess.user_id, RepositoryAccess.access), values=chunk), noresult=True)
+        #The statements above went around storm's cache
+        store.invalidate()
+        for repo in repositories:
+            repo._refreshEffectiveAccess(accesses.keys())
+        bumpAclVersion()
+        store.commit()
+
+    def setOwner(self, owner):
+        #Ownership decides access, so change it here rather than through User/Team.repositories
+        #The path is left alone, call setPath (and move the repository directory) to go with it
+        if isinstance(owner, Team):
+            self.owner_team=owner
+            self.owner_user_id=0
+        elif isinstance(owner, User):
+            self.owner_user=owner
+            self.owner_team_id=0
+        else:
+            raise RepositoryError("The owner of a repository must be a user or a team")
+        self._forgetCached()
+        self._refreshEffectiveAccess()
+        bumpAclVersion()
+        getStore().commit()
+
+    def setPublic(self, public):
+        #Public view access is read from the repository itself, effective_access doesn't change
+        self.public=bool(public)
+        bumpAclVersion()
+        getStore().commit()
+
+    def _refreshEffectiveAccess(self, user_ids=None):
+        #Recompute this repository's rows in effective_access, for some users or all of them.  The rows hold
+        #what grants and team membership give, ownership by a user and the public flag are applied when reading
+        store=Store.of(self) or getStore()
+        store.flush()
+        if user_ids is not None and not user_ids:
+            return
+        if user_ids is not None and len(user_ids)>ACCESS_CHUNK:
+            for chunk in _chunks(user_ids):
+                self._refreshEffectiveAccess(chunk)
+            return
+        grants_where=[RepositoryAccess.repository_id==self.repository_id]
+        effective_where=[EffectiveAccess.repository_id==self.repository_id]
+        if user_ids is not None:
+            grants_where.append(RepositoryAccess.user_id.is_in(user_ids))
+            effective_where.append(EffectiveAccess.user_id.is_in(user_ids))
+        grants=dict(store.find(RepositoryAccess, *grants_where).values(RepositoryAccess.user_id, RepositoryAccess.access))
+
+        owner=self.getOwner()
+        team_grants={}
+        if isinstance(owner, Team):
+            team_where=[TeamMembership.team_id==owner.team_id]
+            if user_ids is not None:
+                team_where.append(TeamMembership.user_id.is_in(user_ids))
+            team_grants=dict(store.find(TeamMembership, *team_where).values(TeamMembership.user_id, TeamMembership.access))
+
+        store.find(EffectiveAccess, *effective_where).remove()
+        rows=[]
+        for user_id in sorted(set(grants)|set(team_grants)):
+            access=self._computeAccess(
+                grants.get(user_id, self.ACC_NONE),
+                False,
+                team_owned=isinstance(owner, Team),
+                team_access=team_grants.get(user_id, Team.ACC_NONE))
+            if access!=self.ACC_NONE:
+                rows.append((self.repository_id, user_id, access))
+        for chunk in _chunks(rows):
+            store.execute(Insert((EffectiveAccess.repository_id, EffectiveAccess.user_id, EffectiveAccess.access), values=chunk), noresult=True)
+
+    def getEffectiveAccess(self, other_user):
+        #Same answer as getAccess from one primary key lookup in effective_access
+        stored=list(getStore().find(EffectiveAccess, EffectiveAccess.repository_id==self.repository_id, EffectiveAccess.user_id==other_user.user_id).values(EffectiveAccess.access))
+        return self._applyOwnerAccess(stored[0] if stored else self.ACC_NONE, self.public,
+            team_owned=self.owner_team is not None,
+            is_owner=self.owner_user_id==other_user.user_id and self.owner_user is not None)
+
+    @classmethod
+    def _applyOwnerAccess(self, effective, public, team_owned=False, is_owner=False):
+        #effective_access rows + what the repository row itself gives
+        if team_owned:
+            return effective
+        return max(
+            self.ACC_OWNER if is_owner else self.ACC_NONE,
+            effective,
+            self.ACC_VIEW if public else self.ACC_NONE,
+            self.ACC_NONE
+        )
+
+    @staticmethod
+    def _buildRepositoryDir(owner_name, name):
+        repobase=gitastic.config.get("Repository/BaseDirectory", do_except=True)
+        return os.path.join(repobase, owner_name, name+".git")
+
     def _getRepositoryShortPath(self):
         return os.path.join(self.getOwnerName(), self.name+".git")
 
     def getRepositoryDir(self):
-        repobase=gitastic.config.get("Repository/BaseDirectory", do_except=True)
-        return os.path.join(repobase, self._getRepositoryShortPath())
+        return self._buildRepositoryDir(self.getOwnerName(), self.name)
 
     def getRepositoryCloneURI(self, proto="ssh"):
         if proto=="ssh":
+            import pwd
             return "%s@%s:%s"%(
                 pwd.getpwuid(os.getuid())[0],
                 gitastic.getWebHost(),
@@ -265,6 +1112,7 @@ class Repository(Model, FilesystemPathValidationMixin):
             raise RepositoryError("Invalid clone protocol: %s"%(proto,))
 
     def create(self, add_readme=False):
+        import subprocess, tempfile, shutil
         repodir=self.getRepositoryDir()
         if os.path.exists(repodir):
             raise RepositoryError("The repository directory already exists: %s"%(repodir,))
@@ -299,6 +1147,10 @@ class Repository(Model, FilesystemPathValidationMixin):
                 raise RepositoryError("Failed to create readme for %s: %s"%(self.getRepositoryDir(), str(e)))
             finally:
                 shutil.rmtree(temp)
+        #A new team owned repository is visible to the team straight away, and may take over a path that access
+        #decisions were cached under
+        self._refreshEffectiveAccess()
+        bumpAclVersion()
 
 User.repositories=ReferenceSet(User.user_id, Repository.owner_user_id)
 Team.repositories=ReferenceSet(Team.team_id, Repository.owner_team_id)
@@ -310,4 +1162,88 @@ class RepositoryAccess(Model):
     repository=Reference(repository_id, Repository.repository_id)
     user_id=Int()
     user=Reference(user_id, User.user_id)
-    access=Int()
\ No newline at end of file
+    access=Int()
+
+class EffectiveAccess(Model):
+    #Materialized by Repository._refreshEffectiveAccess, rebuild with rebuildEffectiveAccess if it's ever in doubt
+    __storm_table__="effective_access"
+    __storm_primary__=("repository_id", "user_id")
+    repository_id=Int()
+    user_id=Int()
+    access=Int()
+
+def rebuildEffectiveAccess(store=None):
+    store=store or getStore()
+    store.find(EffectiveAccess).remove()
+    for repo in store.find(Repository).order_by(Repository.repository_id):
+        repo._refreshEffectiveAccess()
+    store.commit()
+
+class ResolvedAccess(object):
+    def __init__(self, user_id, repository_id=None, repository_name=None, owner_name=None, public=False, access=Repository.ACC_NONE, acl_version=None):
+        self.user_id=user_id
+        self.acl_version=acl_version
+        self.repository_id=repository_id
+        self.repository_name=repository_name
+        self.owner_name=owner_name
+        self.public=public
+        self.access=access
+
+    def getRepositoryDir(self):
+        if self.owner_name is None:
+            raise RepositoryError("The owner of repository %s #%d does not exist"%(self.repository_name, self.repository_id))
+        return Repository._buildRepositoryDir(self.owner_name, self.repository_name)
+
+def resolveAccess(keyid, path):
+    #key -> user -> repository -> effective access in a single statement, same rules as Repository.getAccess
+    #Returns None for an unknown key, and a ResolvedAccess with no repository_id if the path doesn't resolve
+    #With Repository/UseEffectiveAccess grants come from one primary key lookup in effective_access
+    return _resolveAccess(UserSSHKey, UserSSHKey.user_id, UserSSHKey.user_ssh_key_id==int(keyid), path)
+
+def resolveUserAccess(user_id, path):
+    #resolveAccess for a user who logged in some other way than with a key, None for an unknown user
+    return _resolveAccess(User, User.user_id, User.user_id==int(user_id), path)
+
+def _resolveAccess(source, user_id_column, where, path):
+    use_effective=gitastic.config.get("Repository/UseEffectiveAccess", default=False)
+    OwnerUser=ClassAlias(User, "owner_user")
+    tables=[
+        source,
+        LeftJoin(Repository, Repository.path==Repository._normalizePath(path)),
+        LeftJoin(Team, Team.team_id==Repository.owner_team_id),
+        LeftJoin(OwnerUser, OwnerUser.user_id==Repository.owner_user_id),
+        LeftJoin(AclVersion, AclVersion.acl_version_id==1),
+    ]
+    if use_effective:
+        tables.append(LeftJoin(EffectiveAccess, And(EffectiveAccess.repository_id==Repository.repository_id, EffectiveAccess.user_id==user_id_column)))
+        grant_columns=(EffectiveAccess.access,)
+    else:
+        tables.append(LeftJoin(RepositoryAccess, And(RepositoryAccess.repository_id==Repository.repository_id, RepositoryAccess.user_id==user_id_column)))
+        tables.append(LeftJoin(TeamMembership, And(TeamMembership.team_id==Team.team_id, TeamMembership.user_id==user_id_column)))
+        grant_columns=(RepositoryAccess.access, TeamMembership.access)
+    result=getStore().using(*tables).find(source, where)
+    rows=list(result.values(
+        user_id_column, Repository.repository_id, Repository.name, Repository.public, Repository.owner_user_id,
+        Team.team_id, Team.name, OwnerUser.username, AclVersion.version, *grant_columns))
+    if not rows:
+        return None
+    user_id, repository_id, name, public, owner_user_id, team_id, team_name, owner_username, acl_version=rows[0][:9]
+    if len(rows)!=1 or repository_id is None:
+        #Same as findByPath, an ambiguous path doesn't resolve
+        return ResolvedAccess(user_id, acl_version=acl_version)
+
+    grants=[grant or Repository.ACC_NONE for grant in rows[0][9:]]
+    team_owned=team_id is not None
+    is_owner=owner_username is not None and owner_user_id==user_id
+    if use_effective:
+        access=Repository._applyOwnerAccess(grants[0], public, team_owned=team_owned, is_owner=is_owner)
+    else:
+        access=Repository._computeAccess(grants[0], public, team_owned=team_owned, team_access=grants[1], is_owner=is_owner)
+    return ResolvedAccess(
+        user_id,
+        repository_id=repository_id,
+        repository_name=name,
+        owner_name=team_name if team_owned else owner_username,
+        public=public,
+        acl_version=acl_version,
+        access=access)
@@ -0,0 +1,73 @@
+import time
+import threading
+from collections import OrderedDict
+
+#Process wide least recently used cache with a time to live, shared by every thread.  database.py keeps read-only
+#snapshots of users, teams and repositories in it, which unlike storm objects aren't tied to one thread's store.
+#Must not import database, database imports this
+class ObjectCache(object):
+    def __init__(self, size=10000, ttl=30, clock=time.time):
+        self.size=size
+        self.ttl=ttl
+        self.clock=clock
+        self._entries=OrderedDict()
+        self._lock=threading.Lock()
+        self.hits=0
+        self.misses=0
+        self.expired=0
+        self.evicted=0
+        self.invalidated=0
+
+    def get(self, key, count=True):
+        #The value, or None if it isn't there or is older than ttl.  count=False leaves hits and misses alone, for
+        #the second step of a lookup that was already counted
+        with self._lock:
+            entry=self._entries.pop(key, None)
+            if entry is None:
+                self.misses+=1 if count else 0
+                return None
+            stored, value=entry
+            if self.clock()-stored>self.ttl:
+                self.expired+=1
+                self.misses+=1 if count else 0
+                return None
+            #Back to the most recently used end
+            self._entries[key]=entry
+            self.hits+=1 if count else 0
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key]=(self.clock(), value)
+            while len(self._entries)>self.size:
+                self._entries.popitem(last=False)
+                self.evicted+=1
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidated+=1
+
+    def invalidateMatching(self, predicate):
+        #Drop every entry predicate(key) is true for, a full scan so only for things that change rarely
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+                self.invalidated+=1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def getMetrics(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "invalidated": self.invalidated,
+                "entries": len(self._entries),
+                "size": self.size,
+            }
@@ -0,0 +1,182 @@
+import os
+import time
+import hmac
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
+import gitastic
+import objectcache
+
+#bcrypt off the calling thread: hashing and checking run in a pool of User/HashWorkers processes (one per core by
+#default, 0 hashes inline) so a burst of logins is spread over every core instead of pinning request threads.
+#At most User/HashQueue calls wait for a process, more are turned away at once with HashingBusy rather than
+#queueing up behind a password spray.  Every call has a blocking form and one returning a concurrent.futures.Future
+
+class HashingBusy(Exception):
+    pass
+
+class TokenError(Exception):
+    pass
+
+def _hashpw(password, salt):
+    #Module level so the pool can pickle it
+    import bcrypt
+    return bcrypt.hashpw(password, salt)
+
+def _checkpw(password, hashed):
+    return hmac.compare_digest(str(_hashpw(password, hashed)), str(hashed))
+
+def getRounds(hashed):
+    #The cost factor a bcrypt hash ("$2b$12$...") was made with, None if it doesn't look like one
+    try:
+        return int(str(hashed).split("$")[2])
+    except (IndexError, ValueError, UnicodeError):
+        return None
+
+def needsRehash(hashed, rounds=None):
+    return getRounds(hashed)!=int(rounds or gitastic.config.get("User/BcryptRounds", default=12))
+
+def calibrate(target, min_rounds=4, max_rounds=16, samples=3, clock=time.time):
+    #[(rounds, seconds)] hashing one password takes on this host at each cost from min_rounds, the best of samples
+    #tries, stopping after the first cost slower than target seconds since every step up doubles the work
+    import bcrypt
+    results=[]
+    for rounds in range(min_rounds, max_rounds+1):
+        salt=bcrypt.gensalt(rounds)
+        timings=[]
+        for i in range(samples):
+            started=clock()
+            _hashpw("calibration password", salt)
+            timings.append(clock()-started)
+        results.append((rounds, min(timings)))
+        if min(timings)>target:
+            break
+    return results
+
+def recommend(results, target):
+    #The highest cost from calibrate() within target seconds, None if even the lowest is too slow
+    within=[rounds for rounds, seconds in results if seconds<=target]
+    return max(within) if within else None
+
+class PasswordHasher(object):
+    def __init__(self, workers=None, max_pending=None):
+        self.workers=int(workers if workers is not None else gitastic.config.get("User/HashWorkers", default=multiprocessing.cpu_count()))
+        self.max_pending=int(max_pending if max_pending is not None else gitastic.config.get("User/HashQueue", default=self.workers*8))
+        self._executor=ProcessPoolExecutor(max_workers=self.workers) if self.workers else None
+        self._slots=threading.BoundedSemaphore(self.workers+self.max_pending) if self.workers else None
+
+    def _submit(self, function, *args):
+        if self._executor is None:
+            future=Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        if not self._slots.acquire(False):
+            future=Future()
+            future.set_exception(HashingBusy("%d password checks are already waiting"%(self.max_pending,)))
+            return future
+        future=self._executor.submit(function, *args)
+        future.add_done_callback(lambda done: self._slots.release())
+        return future
+
+    def hashFuture(self, password, rounds=None):
+        import bcrypt
+        rounds=int(rounds or gitastic.config.get("User/BcryptRounds", default=12))
+        return self._submit(_hashpw, password, bcrypt.gensalt(rounds))
+
+    def checkFuture(self, password, hashed):
+        return self._submit(_checkpw, password, hashed)
+
+    def hash(self, password, rounds=None):
+        return self.hashFuture(password, rounds).result()
+
+    def check(self, password, hashed):
+        return self.checkFuture(password, hashed).result()
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait)
+
+_hasher=None
+_hasher_lock=threading.Lock()
+
+def getHasher():
+    global _hasher
+    with _hasher_lock:
+        if _hasher is None:
+            _hasher=PasswordHasher()
+        return _hasher
+
+class CredentialCache(object):
+    #Passwords that checked out recently, so a client sending the same credentials with every request (git over
+    #HTTP does) pays for bcrypt once per ttl.  Entries are HMACs under a key that never leaves the process, of the
+    #username, the password and the stored hash: a changed hash never matches, and setPassword drops the old ones
+    def __init__(self, size=None, ttl=None):
+        self.size=int(size if size is not None else gitastic.config.get("User/CredentialCacheSize", default=10000))
+        self.ttl=float(ttl if ttl is not None else gitastic.config.get("User/CredentialCacheTTL", default=60))
+        self._key=os.urandom(32)
+        self._cache=objectcache.ObjectCache(size=self.size, ttl=self.ttl) if self.size else None
+
+    def _digest(self, *parts):
+        return hmac.new(self._key, "\0".join(unicode(part).encode("utf-8") for part in parts), hashlib.sha256).digest()
+
+    def _cacheKey(self, username, password, hashed):
+        return (self._digest(hashed), self._digest(username, password, hashed))
+
+    def check(self, username, password, hashed):
+        #True if these credentials were verified against this hash less than ttl seconds ago
+        return self._cache is not None and self._cache.get(self._cacheKey(username, password, hashed)) is not None
+
+    def put(self, username, password, hashed):
+        if self._cache is not None:
+            self._cache.put(self._cacheKey(username, password, hashed), True)
+
+    def forgetHash(self, hashed):
+        if self._cache is not None and hashed:
+            digest=self._digest(hashed)
+            self._cache.invalidateMatching(lambda key: key[0]==digest)
+
+    def getMetrics(self):
+        return self._cache.getMetrics() if self._cache is not None else None
+
+_credentials=None
+
+def getCredentialCache():
+    global _credentials
+    with _hasher_lock:
+        if _credentials is None:
+            _credentials=CredentialCache()
+        return _credentials
+
+#Session tokens: "<user id>.<expiry>.<signature>", signed with User/TokenSecret over the user id, the expiry and
+#the user's stored password hash, so changing the password revokes every token issued before
+def _tokenSignature(secret, user_id, expires, hashed):
+    return hmac.new(str(secret), "%d.%d.%s"%(user_id, expires, hashed), hashlib.sha256).hexdigest()
+
+def issueToken(user_id, hashed, ttl=None, now=None):
+    secret=gitastic.config.get("User/TokenSecret", default=None)
+    if not secret:
+        raise TokenError("User/TokenSecret is not configured")
+    expires=int((now or time.time())+float(ttl or gitastic.config.get("User/TokenTTL", default=3600)))
+    return "%d.%d.%s"%(user_id, expires, _tokenSignature(secret, user_id, expires, hashed))
+
+def parseToken(token):
+    #(user id, expiry) without checking anything, None if it isn't shaped like a token
+    try:
+        user_id, expires, signature=str(token).split(".")
+        return int(user_id), int(expires)
+    except (ValueError, UnicodeError):
+        return None
+
+def checkToken(token, hashed, now=None):
+    secret=gitastic.config.get("User/TokenSecret", default=None)
+    parsed=parseToken(token)
+    if not secret or parsed is None:
+        return False
+    user_id, expires=parsed
+    if expires<(now or time.time()):
+        return False
+    return hmac.compare_digest(str(token).split(".")[2], _tokenSignature(secret, user_id, expires, hashed))
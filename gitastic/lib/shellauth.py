@@ -0,0 +1,80 @@
+import os
+import shlex
+import gitastic
+import database
+import accesscache
+
+ACTIONS=("git-receive-pack", "git-upload-pack")
+
+_access_cache=None
+
+class ShellAuthError(Exception):
+    outcome="denied"
+
+class UnknownKeyError(ShellAuthError):
+    outcome="unknown_key"
+
+def authorize(keyid, original_command):
+    #Decide whether key #keyid may run original_command (as found in SSH_ORIGINAL_COMMAND)
+    #Returns a decision dict shared by gitastic-shell and gitastic-authd, raises ShellAuthError on deny
+    try:
+        command=shlex.split(original_command)
+    except ValueError:
+        raise ShellAuthError("Could not parse the command: %s"%(original_command,))
+    if not command or command[0] not in ACTIONS:
+        raise ShellAuthError("Command must be one of %s (%s was given)"%(", ".join(ACTIONS), command[0] if command else ""))
+
+    path=database.Repository._normalizePath(command[-1])
+    cache=getAccessCache()
+    cached=cache.get(keyid, path) if cache else None
+    if cached:
+        directory, access, public=cached
+    else:
+        resolved=database.resolveAccess(keyid, path)
+        if resolved is None:
+            raise UnknownKeyError("Your SSH key is not recognized")
+        if resolved.repository_id is None:
+            raise ShellAuthError("Repository does not exist: %s"%(command[-1],))
+        directory, access, public=resolved.getRepositoryDir(), resolved.access, resolved.public
+        if cache and resolved.acl_version is not None:
+            cache.setVersion(resolved.acl_version)
+            cache.put(keyid, path, directory, access, public, resolved.acl_version)
+
+    if not access&database.Repository.PERM_CLONE:
+        if not public:
+            #This is the more common scenario, if a repo is public you should be able to clone
+            raise ShellAuthError("Repository does not exist: %s"%(command[-1],))
+        else:
+            raise ShellAuthError("You do not have permission to clone this repository")
+
+    if command[0]=="git-receive-pack" and not access&database.Repository.PERM_PUSH:
+        raise ShellAuthError("You do not have permission to push to this repository")
+
+    git=gitastic.config.get("Repository/Git", do_except=True)
+    return {
+        "allow": True,
+        "command": command,
+        "directory": validateRepositoryDir(directory, command[-1]),
+        "git": git,
+        #What gitastic-shell replaces itself with when handing off with exec
+        "program": os.path.join(gitastic.config.get("Repository/GitExecPath", default=os.path.dirname(git)), command[0]),
+        "handoff": gitastic.config.get("Shell/Handoff", default="exec"),
+    }
+
+def getAccessCache():
+    #None unless AccessCache/File is configured
+    global _access_cache
+    if _access_cache is None and gitastic.config.get("AccessCache/File"):
+        _access_cache=accesscache.AccessCache(
+            gitastic.config.get("AccessCache/File"),
+            max_age=float(gitastic.config.get("AccessCache/MaxAge", default=30)))
+    return _access_cache
+
+def validateRepositoryDir(directory, requested):
+    #The directory is handed straight to git-upload-pack/git-receive-pack, make sure it can't point anywhere else
+    #requested is the path the client asked for, the only one the message may show since it goes back to them
+    base=os.path.realpath(gitastic.config.get("Repository/BaseDirectory", do_except=True))
+    realdir=os.path.realpath(directory)
+    if not realdir.startswith(base+os.sep):
+        raise ShellAuthError("Repository does not exist: %s"%(requested,))
+    return realdir
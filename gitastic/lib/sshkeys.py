@@ -0,0 +1,48 @@
+import base64
+import hashlib
+import binascii
+import struct
+
+#Plain functions on public key strings, no database or config so they can be used anywhere (and pickled)
+DEFAULT_OPTIONS="no-port-forwarding,no-X11-forwarding,no-agent-forwarding,no-pty"
+
+def parseKey(keystr):
+    #Returns (keyType, keyData, keyComment) with keyData decoded, or None if this isn't a public key
+    try:
+        keyType, keyData_encoded, keyComment=keystr.split()
+        keyData=base64.decodestring(keyData_encoded)
+        if keyData=="":
+            return None
+        typeStrLen=struct.unpack(">I", keyData[:4])[0]
+    except ValueError:
+        return None
+    except binascii.Error:
+        return None
+    except struct.error:
+        return None
+
+    typeStr=keyData[4:4+typeStrLen]
+    if typeStr!=keyType:
+        return None
+    return keyType, keyData, keyComment
+
+def validateKey(keystr):
+    return parseKey(keystr) is not None
+
+def getFingerprint(keystr):
+    #SHA256 fingerprint in the form sshd passes as %f with its default FingerprintHash
+    parsed=parseKey(keystr)
+    if parsed is None:
+        return None
+    return "SHA256:"+base64.b64encode(hashlib.sha256(parsed[1]).digest()).rstrip("=")
+
+def formatKeyLine(keyid, keystr, shell, options=DEFAULT_OPTIONS):
+    #An authorized_keys line forcing gitastic-shell for this key, or None if the key is invalid
+    #The key is rebuilt from its parsed parts so nothing in the stored string can inject options of its own
+    parsed=parseKey(keystr)
+    if parsed is None:
+        return None
+    if '"' in shell or "\n" in shell:
+        raise ValueError("The shell path can't contain quotes or newlines: %s"%(shell,))
+    keyType, keyData, keyComment=parsed
+    return "command=\"%s %d\",%s %s %s %s\n"%(shell, int(keyid), options, keyType, base64.b64encode(keyData), keyComment)
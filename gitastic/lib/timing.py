@@ -0,0 +1,134 @@
+import os
+import time
+import math
+
+#Per-phase wall time of gitastic-shell runs, one line per run appended to the file in $GITASTIC_TIMING_LOG:
+#  <unix time> <pid> <outcome> q=<queries> <phase>=<ms> <phase>=<ms> ...
+#Must not import database or gitastic up front, this module is loaded on the fast path of gitastic-shell.  Without
+#$GITASTIC_TIMING_LOG every call is a no-op on a shared NullTimer
+ENVIRONMENT="GITASTIC_TIMING_LOG"
+PERCENTILES=(50, 95, 99)
+
+class NullTimer(object):
+    enabled=False
+
+    def phase(self, name):
+        pass
+
+    def countQueries(self):
+        pass
+
+    def write(self, outcome):
+        pass
+
+class PhaseTimer(object):
+    enabled=True
+
+    def __init__(self, path):
+        self.path=path
+        self.phases=[]
+        self.queries=0
+        self._profile=None
+        self._last=time.time()
+        startup=getProcessAge()
+        if startup is not None:
+            self.phases.append(("startup", startup))
+
+    def phase(self, name):
+        #Charge the time since the previous phase ended to name
+        now=time.time()
+        self.phases.append((name, now-self._last))
+        self._last=now
+
+    def countQueries(self):
+        #Count this thread's statements from here on, only once the caller has paid to import the models anyway
+        if self._profile is None:
+            import database
+            self._profile=database.QueryProfile()
+            self._profile.start()
+
+    def write(self, outcome):
+        if self._profile is not None:
+            self.queries=self._profile.queries
+        #A single short O_APPEND write, lines from concurrent shells don't interleave
+        line="%.3f %d %s q=%d %s total=%.2f\n"%(time.time(), os.getpid(), outcome, self.queries,
+            " ".join("%s=%.2f"%(name, elapsed*1000) for name, elapsed in self.phases),
+            sum(elapsed for name, elapsed in self.phases)*1000)
+        try:
+            fd=os.open(self.path, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0640)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except OSError:
+            #Timing is never a reason to fail a clone
+            pass
+
+_null_timer=NullTimer()
+
+def getTimer():
+    path=os.environ.get(ENVIRONMENT)
+    return PhaseTimer(path) if path else _null_timer
+
+def getProcessAge():
+    #Seconds since this process was started (interpreter startup, imports), from /proc with clock tick resolution
+    try:
+        with open("/proc/self/stat", "r") as fp:
+            #The command name may contain spaces, the fields we want come after its closing parenthesis
+            started=int(fp.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", "r") as fp:
+            uptime=float(fp.read().split()[0])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return max(0.0, uptime-float(started)/os.sysconf("SC_CLK_TCK"))
+
+def parseLine(line):
+    #(outcome, queries, {phase: ms}) or None for a line that isn't ours
+    fields=line.split()
+    if len(fields)<4 or not fields[3].startswith("q="):
+        return None
+    try:
+        phases=dict((name, float(value)) for name, value in (field.split("=", 1) for field in fields[4:]))
+        return fields[2], int(fields[3][2:]), phases
+    except ValueError:
+        return None
+
+def percentile(values, pct):
+    #Nearest rank on an already sorted list
+    if not values:
+        return None
+    rank=int(math.ceil(pct/100.0*len(values)))
+    return values[min(max(rank, 1), len(values))-1]
+
+def summarize(lines):
+    #{"runs": n, "outcomes": {outcome: n}, "queries": [...], "phases": {phase: [sorted ms]}}
+    summary={"runs": 0, "outcomes": {}, "queries": [], "phases": {}}
+    for line in lines:
+        parsed=parseLine(line)
+        if parsed is None:
+            continue
+        outcome, queries, phases=parsed
+        summary["runs"]+=1
+        summary["outcomes"][outcome]=summary["outcomes"].get(outcome, 0)+1
+        summary["queries"].append(queries)
+        for name, elapsed in phases.items():
+            summary["phases"].setdefault(name, []).append(elapsed)
+    summary["queries"].sort()
+    for values in summary["phases"].values():
+        values.sort()
+    return summary
+
+def formatSummary(summary, percentiles=PERCENTILES):
+    out=["%d runs: %s"%(summary["runs"], ", ".join("%s %d"%(outcome, count) for outcome, count in sorted(summary["outcomes"].items())))]
+    out.append("%-10s %8s "%("phase", "count")+" ".join("%9s"%("p%d"%(pct,)) for pct in percentiles))
+    #Phases in the order they happen, total last
+    order=["startup", "daemon", "config", "connect", "authorize", "handoff", "git"]
+    names=[name for name in order if name in summary["phases"]]
+    names+=sorted(name for name in summary["phases"] if name not in order and name!="total")
+    names+=["total"] if "total" in summary["phases"] else []
+    for name in names:
+        values=summary["phases"][name]
+        out.append("%-10s %8d "%(name, len(values))+" ".join("%9.2f"%(percentile(values, pct),) for pct in percentiles))
+    if summary["queries"]:
+        out.append("%-10s %8d "%("queries", len(summary["queries"]))+" ".join("%9d"%(percentile(summary["queries"], pct),) for pct in percentiles))
+    return "\n".join(out)
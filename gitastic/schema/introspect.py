@@ -0,0 +1,64 @@
+#What a database's tables look like, read back from the database itself, so update-db --verify can check that the
+#baseline of a schema builds the same tables as replaying every version:
+#  {table: {"columns": [...], "indexes": [...], "foreign_keys": [...], "rows": n}}
+#Index and foreign key lists are sorted, column order is kept since it's part of the schema
+def describeSQLite(store):
+    tables={}
+    for (table,) in list(store.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")):
+        indexes=[]
+        for row in list(store.execute("PRAGMA index_list(\"%s\")"%(table,))):
+            name, unique=row[1], row[2]
+            columns=tuple(column[2] for column in store.execute("PRAGMA index_info(\"%s\")"%(name,)))
+            indexes.append((name, bool(unique), columns))
+        tables[table]={
+            "columns": [tuple(row[1:]) for row in store.execute("PRAGMA table_info(\"%s\")"%(table,))],
+            "indexes": sorted(indexes),
+            "foreign_keys": sorted(tuple(row[2:7]) for row in store.execute("PRAGMA foreign_key_list(\"%s\")"%(table,))),
+            "rows": store.execute("SELECT COUNT(*) FROM \"%s\""%(table,)).get_one()[0],
+        }
+    return tables
+
+def describeMySQL(store):
+    tables={}
+    for table, engine, comment in list(store.execute("SELECT TABLE_NAME, ENGINE, TABLE_COMMENT FROM information_schema.TABLES WHERE TABLE_SCHEMA=DATABASE() ORDER BY TABLE_NAME")):
+        columns=list(store.execute("""SELECT COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE, COLUMN_DEFAULT, EXTRA, COLUMN_COMMENT
+            FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=? ORDER BY ORDINAL_POSITION""", (table,)))
+        indexes={}
+        for name, non_unique, column in store.execute("""SELECT INDEX_NAME, NON_UNIQUE, COLUMN_NAME
+                FROM information_schema.STATISTICS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=? ORDER BY INDEX_NAME, SEQ_IN_INDEX""", (table,)):
+            indexes.setdefault((name, not non_unique), []).append(column)
+        foreign_keys=list(store.execute("""SELECT k.CONSTRAINT_NAME, k.COLUMN_NAME, k.REFERENCED_TABLE_NAME, k.REFERENCED_COLUMN_NAME, r.UPDATE_RULE, r.DELETE_RULE
+            FROM information_schema.KEY_COLUMN_USAGE k JOIN information_schema.REFERENTIAL_CONSTRAINTS r
+                ON r.CONSTRAINT_SCHEMA=k.CONSTRAINT_SCHEMA AND r.CONSTRAINT_NAME=k.CONSTRAINT_NAME
+            WHERE k.TABLE_SCHEMA=DATABASE() AND k.TABLE_NAME=?""", (table,)))
+        tables[table]={
+            "engine": engine,
+            "comment": comment,
+            "columns": [tuple(row) for row in columns],
+            "indexes": sorted((name, unique, tuple(columns)) for (name, unique), columns in indexes.items()),
+            "foreign_keys": sorted(tuple(row) for row in foreign_keys),
+            "rows": store.execute("SELECT COUNT(*) FROM `%s`"%(table,)).get_one()[0],
+        }
+    return tables
+
+describe={
+    "sqlite": describeSQLite,
+    "mysql": describeMySQL,
+}
+
+def compare(one, other, ignore_rows=("schema_change",)):
+    #Human readable differences between two descriptions, empty if they match.  schema_change has a row per
+    #version applied, which is exactly what differs between the two ways of getting there
+    differences=[]
+    for table in sorted(set(one)|set(other)):
+        if table not in other:
+            differences.append("%s: only in the first"%(table,))
+        elif table not in one:
+            differences.append("%s: only in the second"%(table,))
+        else:
+            for key in sorted(set(one[table])|set(other[table])):
+                if key=="rows" and table in ignore_rows:
+                    continue
+                if one[table].get(key)!=other[table].get(key):
+                    differences.append("%s %s:\n    %r\n    %r"%(table, key, one[table].get(key), other[table].get(key)))
+    return differences
@@ -0,0 +1,119 @@
+#Schema versions that can't be expressed as a single query, shared by every database
+#Each is called with the Storm store, update-db commits afterwards
+import time
+from datetime import datetime
+from storm.expr import Select, Insert, Update, Column, Table, LeftJoin, Undef
+from lib import sshkeys, database
+
+class ChunkedMigration(object):
+    #A migration over a big table that mustn't hold locks for long: batch(store, keys) is called with batch_size
+    #primary keys at a time in key order, each batch is committed on its own and followed by throttle seconds of
+    #rest.  Progress is kept in schema_change_progress under name, a run that was interrupted carries on after
+    #the last committed batch.  update-db passes --batch-size and --throttle
+    chunked=True
+
+    def __init__(self, name, table, key, batch, batch_size=1000, throttle=0):
+        self.__name__=name
+        self.table=table
+        self.key=key
+        self.batch=batch
+        self.batch_size=batch_size
+        self.throttle=throttle
+
+    def getProgress(self, store):
+        #(last key done, rows done), (None, 0) if it hasn't started
+        progress=Table("schema_change_progress")
+        row=store.execute(Select((Column("last_key", progress), Column("rows_done", progress)), Column("name", progress)==unicode(self.__name__), tables=progress)).get_one()
+        return row if row else (None, 0)
+
+    def _saveProgress(self, store, started, last_key, rows_done):
+        progress=Table("schema_change_progress")
+        values={Column("last_key"): last_key, Column("rows_done"): rows_done, Column("updated_date"): datetime.utcnow().replace(microsecond=0)}
+        if started:
+            store.execute(Update(values, Column("name")==unicode(self.__name__), table=progress))
+        else:
+            values[Column("name")]=unicode(self.__name__)
+            store.execute(Insert(values, table=progress))
+
+    def __call__(self, store, batch_size=None, throttle=None):
+        batch_size=batch_size or self.batch_size
+        throttle=self.throttle if throttle is None else throttle
+        table=Table(self.table)
+        key=Column(self.key, table)
+        last_key, rows_done=self.getProgress(store)
+        started=last_key is not None
+        if started:
+            print "Resuming %s after %s=%d, %d rows done"%(self.__name__, self.key, last_key, rows_done)
+        began, rows_now=time.time(), 0
+        while True:
+            where=key>last_key if last_key is not None else Undef
+            keys=[row[0] for row in store.execute(Select(key, where, tables=table, order_by=key, limit=batch_size))]
+            if not keys:
+                break
+            self.batch(store, keys)
+            last_key=keys[-1]
+            rows_done+=len(keys)
+            rows_now+=len(keys)
+            self._saveProgress(store, started, last_key, rows_done)
+            started=True
+            store.commit()
+            print "%s: %d rows, %.0f rows/s"%(self.__name__, rows_done, rows_now/max(time.time()-began, 0.001))
+            if throttle:
+                time.sleep(throttle)
+
+def backfillKeyFingerprints(store):
+    #Duplicate keys keep the fingerprint on the oldest row only, the unique index goes on next
+    table=Table("user_ssh_key")
+    seen=set()
+    rows=list(store.execute(Select((Column("user_ssh_key_id", table), Column("key", table)), tables=table,
+        order_by=Column("user_ssh_key_id", table))))
+    for keyid, key in rows:
+        fingerprint=sshkeys.getFingerprint(key)
+        if fingerprint is None or fingerprint in seen:
+            continue
+        seen.add(fingerprint)
+        store.execute(Update({Column("fingerprint"): unicode(fingerprint)}, Column("user_ssh_key_id")==keyid, table=table))
+
+def lowerUsernames(store, keys):
+    #The batch for user.username_lower, normalized the same way as User.__storm_pre_flush__
+    table=Table("user")
+    rows=list(store.execute(Select((Column("user_id", table), Column("username", table)), Column("user_id", table).is_in(keys), tables=table)))
+    for user_id, username in rows:
+        store.execute(Update({Column("username_lower"): database.User.normalizeUsername(username)}, Column("user_id")==user_id, table=table))
+
+def rebuildEffectiveAccess(store, chunk_size=500):
+    #Fills effective_access the way database.rebuildEffectiveAccess does, but only names the columns these tables
+    #had at version 19 so models that gained columns since can't break the upgrade.  Only the access rules
+    #(Repository._computeAccess, which touches no table) are shared with the models
+    repository, team=Table("repository"), Table("team")
+    grants, memberships, effective=Table("repository_access"), Table("team_membership"), Table("effective_access")
+    store.execute("DELETE FROM effective_access")
+    repositories=list(store.execute(Select((Column("repository_id", repository), Column("team_id", team)),
+        tables=[repository, LeftJoin(team, Column("team_id", team)==Column("owner_team_id", repository))],
+        order_by=Column("repository_id", repository))))
+    for start in range(0, len(repositories), chunk_size):
+        chunk=dict(repositories[start:start+chunk_size])
+        repository_grants={}
+        for repository_id, user_id, access in store.execute(Select((Column("repository_id", grants), Column("user_id", grants), Column("access", grants)),
+                Column("repository_id", grants).is_in(chunk.keys()), tables=grants)):
+            repository_grants.setdefault(repository_id, {})[user_id]=access
+        team_ids=set(team_id for team_id in chunk.values() if team_id is not None)
+        team_grants={}
+        if team_ids:
+            for team_id, user_id, access in store.execute(Select((Column("team_id", memberships), Column("user_id", memberships), Column("access", memberships)),
+                    Column("team_id", memberships).is_in(team_ids), tables=memberships)):
+                team_grants.setdefault(team_id, {})[user_id]=access
+        rows=[]
+        for repository_id, team_id in sorted(chunk.items()):
+            user_grants=repository_grants.get(repository_id, {})
+            members=team_grants.get(team_id, {})
+            for user_id in sorted(set(user_grants)|set(members)):
+                access=database.Repository._computeAccess(
+                    user_grants.get(user_id, database.Repository.ACC_NONE),
+                    False,
+                    team_owned=team_id is not None,
+                    team_access=members.get(user_id, database.Team.ACC_NONE))
+                if access!=database.Repository.ACC_NONE:
+                    rows.append((repository_id, user_id, access))
+        if rows:
+            store.execute(Insert((Column("repository_id", effective), Column("user_id", effective), Column("access", effective)), values=rows, table=effective), noresult=True)
@@ -1,3 +1,5 @@
+import migrations
+
 schema={
 	0: """
 		CREATE  TABLE `schema_change` (
@@ -101,4 +103,182 @@ schema={
 		ON DELETE CASCADE
 		ON UPDATE CASCADE)
 		ENGINE = InnoDB;""",
-}
\ No newline at end of file
+	13: """
+		ALTER TABLE `user_ssh_key`
+			ADD COLUMN `fingerprint` VARCHAR(64) NULL DEFAULT NULL  AFTER `added_from_ip` ;""",
+	14: migrations.backfillKeyFingerprints,
+	15: """
+		ALTER TABLE `user_ssh_key`
+			ADD UNIQUE INDEX `fingerprint_UNIQUE` (`fingerprint` ASC) ;""",
+	16: """
+		CREATE  TABLE `acl_version` (
+		`acl_version_id` INT NOT NULL ,
+		`version` BIGINT NOT NULL DEFAULT 0 ,
+		PRIMARY KEY (`acl_version_id`) )
+		ENGINE = InnoDB;""",
+	17: """INSERT INTO `acl_version` (`acl_version_id`, `version`) VALUES (1, 0) ;""",
+	18: """
+		CREATE  TABLE `effective_access` (
+		`repository_id` BIGINT NOT NULL ,
+		`user_id` BIGINT NOT NULL ,
+		`access` INT NOT NULL DEFAULT 0 ,
+		PRIMARY KEY (`repository_id`, `user_id`) ,
+		INDEX `fk_effective_access_user` (`user_id` ASC) ,
+		CONSTRAINT `fk_effective_access_repo`
+		FOREIGN KEY (`repository_id` )
+		REFERENCES `repository` (`repository_id` )
+		ON DELETE CASCADE
+		ON UPDATE CASCADE,
+		CONSTRAINT `fk_effective_access_user`
+		FOREIGN KEY (`user_id` )
+		REFERENCES `user` (`user_id` )
+		ON DELETE CASCADE
+		ON UPDATE CASCADE)
+		ENGINE = InnoDB;""",
+	19: migrations.rebuildEffectiveAccess,
+	20: """ALTER TABLE `repository` ADD INDEX `path_INDEX` (`path` ASC) ;""",
+	21: """ALTER TABLE `repository` ADD INDEX `owner_team_INDEX` (`owner_team_id` ASC) ;""",
+	22: """ALTER TABLE `repository` ADD INDEX `owner_user_INDEX` (`owner_user_id` ASC) ;""",
+	23: """
+		CREATE  TABLE `schema_change_progress` (
+		`name` VARCHAR(128) NOT NULL ,
+		`last_key` BIGINT NOT NULL ,
+		`rows_done` BIGINT NOT NULL DEFAULT 0 ,
+		`updated_date` DATETIME NOT NULL ,
+		PRIMARY KEY (`name`) )
+		ENGINE = InnoDB;""",
+	24: """ALTER TABLE `user` ADD COLUMN `username_lower` VARCHAR(128) NULL DEFAULT NULL AFTER `username` ;""",
+	25: migrations.ChunkedMigration("backfillUsernameLower", "user", "user_id", migrations.lowerUsernames),
+	#username_UNIQUE already compares without case under the default collations, so this can't find duplicates
+	26: """ALTER TABLE `user` MODIFY COLUMN `username_lower` VARCHAR(128) NOT NULL , ADD UNIQUE INDEX `username_lower_UNIQUE` (`username_lower` ASC) ;""",
+}
+#The tables as of baseline_version, created in their final shape.  update-db builds new databases from this in
+#one pass and continues with any versions after it; "update-db --verify" checks it against replaying the history.
+#Migrations have nothing to do on empty tables and are left out.  Move it forward now and then, never edit a
+#version that's already in schema
+baseline_version=22
+baseline=[
+	"""
+		CREATE  TABLE `schema_change` (
+		`schema_change_id` BIGINT NOT NULL AUTO_INCREMENT ,
+		`applied_date` DATETIME NOT NULL ,
+		`schema_version` BIGINT NOT NULL ,
+		PRIMARY KEY (`schema_change_id`) ,
+		UNIQUE INDEX `schema_version_UNIQUE` (`schema_version` ASC) ,
+		INDEX `applied_date` (`applied_date` ASC) )
+		ENGINE = InnoDB;""",
+	"""
+		CREATE  TABLE `user` (
+		`user_id` BIGINT NOT NULL AUTO_INCREMENT ,
+		`username` VARCHAR(128) NOT NULL ,
+		`email` TEXT NOT NULL ,
+		`password` TEXT NOT NULL ,
+		PRIMARY KEY (`user_id`) ,
+		UNIQUE INDEX `username_UNIQUE` (`username` ASC) )
+		ENGINE = InnoDB;""",
+	"""
+		CREATE  TABLE `user_ssh_key` (
+		`user_ssh_key_id` BIGINT NOT NULL AUTO_INCREMENT ,
+		`user_id` BIGINT NOT NULL ,
+		`name` TEXT NOT NULL ,
+		`key` TEXT NOT NULL ,
+		`timestamp` DATETIME NOT NULL ,
+		`added_from_ip` VARCHAR(64) NOT NULL DEFAULT '0.0.0.0' ,
+		`fingerprint` VARCHAR(64) NULL DEFAULT NULL ,
+		PRIMARY KEY (`user_ssh_key_id`) ,
+		INDEX `fk_user_ssh_key_user` (`user_id` ASC) ,
+		UNIQUE INDEX `fingerprint_UNIQUE` (`fingerprint` ASC) ,
+		CONSTRAINT `fk_user_ssh_key_user`
+		FOREIGN KEY (`user_id` )
+		REFERENCES `user` (`user_id` )
+		ON DELETE CASCADE
+		ON UPDATE CASCADE)
+		ENGINE = InnoDB;""",
+	"""
+		CREATE  TABLE `repository` (
+		`repository_id` BIGINT NOT NULL AUTO_INCREMENT ,
+		`name` VARCHAR(128) NOT NULL ,
+		`path` VARCHAR(128) NOT NULL ,
+		`description` TEXT NOT NULL ,
+		`public` TINYINT(1) NOT NULL DEFAULT 1 ,
+		`owner_user_id` BIGINT NOT NULL ,
+		`owner_team_id` BIGINT NOT NULL ,
+		PRIMARY KEY (`repository_id`) ,
+		UNIQUE INDEX `path_UNIQUE` (`name` ASC, `owner_user_id` ASC) ,
+		INDEX `path_INDEX` (`path` ASC) ,
+		INDEX `owner_team_INDEX` (`owner_team_id` ASC) ,
+		INDEX `owner_user_INDEX` (`owner_user_id` ASC) )
+		ENGINE = InnoDB
+		COMMENT = 'owner_user_id should be fk to user.user_id';""",
+	"""
+		CREATE  TABLE `repository_access` (
+		`repository_id` BIGINT NOT NULL ,
+		`user_id` BIGINT NOT NULL ,
+		`access` INT NOT NULL DEFAULT 0 ,
+		PRIMARY KEY (`repository_id`, `user_id`) ,
+		INDEX `fk_repository_access_repo` (`repository_id` ASC) ,
+		INDEX `fk_repository_access_user` (`user_id` ASC) ,
+		CONSTRAINT `fk_repository_access_repo`
+		FOREIGN KEY (`repository_id` )
+		REFERENCES `repository` (`repository_id` )
+		ON DELETE CASCADE
+		ON UPDATE CASCADE,
+		CONSTRAINT `fk_repository_access_user`
+		FOREIGN KEY (`user_id` )
+		REFERENCES `user` (`user_id` )
+		ON DELETE CASCADE
+		ON UPDATE CASCADE)
+		ENGINE = InnoDB;""",
+	"""
+		CREATE  TABLE `team` (
+		`team_id` BIGINT NOT NULL AUTO_INCREMENT ,
+		`name` VARCHAR(128) NOT NULL ,
+		`description` TEXT NOT NULL DEFAULT '' ,
+		PRIMARY KEY (`team_id`) ,
+		UNIQUE INDEX `name_UNIQUE` (`name` ASC) )
+		ENGINE = InnoDB;""",
+	"""
+		CREATE  TABLE `team_membership` (
+		`team_id` BIGINT NOT NULL ,
+		`user_id` BIGINT NOT NULL ,
+		`access` INT NOT NULL DEFAULT 0 ,
+		PRIMARY KEY (`team_id`, `user_id`) ,
+		INDEX `fk_team_membership_team` (`team_id` ASC) ,
+		INDEX `fk_team_membership_user` (`user_id` ASC) ,
+		CONSTRAINT `fk_team_membership_team`
+		FOREIGN KEY (`team_id` )
+		REFERENCES `team` (`team_id` )
+		ON DELETE CASCADE
+		ON UPDATE CASCADE,
+		CONSTRAINT `fk_team_membership_user`
+		FOREIGN KEY (`user_id` )
+		REFERENCES `user` (`user_id` )
+		ON DELETE CASCADE
+		ON UPDATE CASCADE)
+		ENGINE = InnoDB;""",
+	"""
+		CREATE  TABLE `acl_version` (
+		`acl_version_id` INT NOT NULL ,
+		`version` BIGINT NOT NULL DEFAULT 0 ,
+		PRIMARY KEY (`acl_version_id`) )
+		ENGINE = InnoDB;""",
+	"""INSERT INTO `acl_version` (`acl_version_id`, `version`) VALUES (1, 0) ;""",
+	"""
+		CREATE  TABLE `effective_access` (
+		`repository_id` BIGINT NOT NULL ,
+		`user_id` BIGINT NOT NULL ,
+		`access` INT NOT NULL DEFAULT 0 ,
+		PRIMARY KEY (`repository_id`, `user_id`) ,
+		INDEX `fk_effective_access_user` (`user_id` ASC) ,
+		CONSTRAINT `fk_effective_access_repo`
+		FOREIGN KEY (`repository_id` )
+		REFERENCES `repository` (`repository_id` )
+		ON DELETE CASCADE
+		ON UPDATE CASCADE,
+		CONSTRAINT `fk_effective_access_user`
+		FOREIGN KEY (`user_id` )
+		REFERENCES `user` (`user_id` )
+		ON DELETE CASCADE
+		ON UPDATE CASCADE)
+		ENGINE = InnoDB;""",
+]
@@ -0,0 +1,101 @@
+#The tables of mysql.py as they stand after all of its versions, created directly in their final shape since
+#sqlite can't alter or drop most of what the mysql history changes.  Owner columns default to 0 (no owner),
+#which is what mysql stores when an insert leaves them out.  From 21 on versions are added the way mysql.py adds
+#them, as far as sqlite can: user.username_lower stays nullable since a column can't be changed once added
+import migrations
+
+schema={
+	0: """
+		CREATE TABLE "schema_change" (
+		"schema_change_id" INTEGER PRIMARY KEY AUTOINCREMENT ,
+		"applied_date" DATETIME NOT NULL ,
+		"schema_version" INTEGER NOT NULL ,
+		CONSTRAINT "schema_version_UNIQUE" UNIQUE ("schema_version") );""",
+	1: """CREATE INDEX "applied_date" ON "schema_change" ("applied_date") ;""",
+	2: """
+		CREATE TABLE "user" (
+		"user_id" INTEGER PRIMARY KEY AUTOINCREMENT ,
+		"username" VARCHAR(128) NOT NULL ,
+		"email" TEXT NOT NULL ,
+		"password" TEXT NOT NULL ,
+		CONSTRAINT "username_UNIQUE" UNIQUE ("username") );""",
+	3: """
+		CREATE TABLE "user_ssh_key" (
+		"user_ssh_key_id" INTEGER PRIMARY KEY AUTOINCREMENT ,
+		"user_id" INTEGER NOT NULL
+			CONSTRAINT "fk_user_ssh_key_user" REFERENCES "user" ("user_id") ON DELETE CASCADE ON UPDATE CASCADE ,
+		"name" TEXT NOT NULL ,
+		"key" TEXT NOT NULL ,
+		"timestamp" DATETIME NOT NULL ,
+		"added_from_ip" VARCHAR(64) NOT NULL DEFAULT '0.0.0.0' ,
+		"fingerprint" VARCHAR(64) NULL DEFAULT NULL );""",
+	4: """CREATE INDEX "fk_user_ssh_key_user" ON "user_ssh_key" ("user_id") ;""",
+	5: """CREATE UNIQUE INDEX "fingerprint_UNIQUE" ON "user_ssh_key" ("fingerprint") ;""",
+	6: """
+		CREATE TABLE "repository" (
+		"repository_id" INTEGER PRIMARY KEY AUTOINCREMENT ,
+		"name" VARCHAR(128) NOT NULL ,
+		"path" VARCHAR(128) NOT NULL ,
+		"description" TEXT NOT NULL ,
+		"public" BOOLEAN NOT NULL DEFAULT 1 ,
+		"owner_user_id" INTEGER NOT NULL DEFAULT 0 ,
+		"owner_team_id" INTEGER NOT NULL DEFAULT 0 );""",
+	7: """CREATE UNIQUE INDEX "path_UNIQUE" ON "repository" ("name", "owner_user_id") ;""",
+	8: """
+		CREATE TABLE "repository_access" (
+		"repository_id" INTEGER NOT NULL
+			CONSTRAINT "fk_repository_access_repo" REFERENCES "repository" ("repository_id") ON DELETE CASCADE ON UPDATE CASCADE ,
+		"user_id" INTEGER NOT NULL
+			CONSTRAINT "fk_repository_access_user" REFERENCES "user" ("user_id") ON DELETE CASCADE ON UPDATE CASCADE ,
+		"access" INTEGER NOT NULL DEFAULT 0 ,
+		PRIMARY KEY ("repository_id", "user_id") );""",
+	9: """CREATE INDEX "fk_repository_access_user" ON "repository_access" ("user_id") ;""",
+	10: """
+		CREATE TABLE "team" (
+		"team_id" INTEGER PRIMARY KEY AUTOINCREMENT ,
+		"name" VARCHAR(128) NOT NULL ,
+		"description" TEXT NOT NULL DEFAULT '' ,
+		CONSTRAINT "name_UNIQUE" UNIQUE ("name") );""",
+	11: """
+		CREATE TABLE "team_membership" (
+		"team_id" INTEGER NOT NULL
+			CONSTRAINT "fk_team_membership_team" REFERENCES "team" ("team_id") ON DELETE CASCADE ON UPDATE CASCADE ,
+		"user_id" INTEGER NOT NULL
+			CONSTRAINT "fk_team_membership_user" REFERENCES "user" ("user_id") ON DELETE CASCADE ON UPDATE CASCADE ,
+		"access" INTEGER NOT NULL DEFAULT 0 ,
+		PRIMARY KEY ("team_id", "user_id") );""",
+	12: """CREATE INDEX "fk_team_membership_user" ON "team_membership" ("user_id") ;""",
+	13: """
+		CREATE TABLE "acl_version" (
+		"acl_version_id" INTEGER NOT NULL ,
+		"version" INTEGER NOT NULL DEFAULT 0 ,
+		PRIMARY KEY ("acl_version_id") );""",
+	14: """INSERT INTO "acl_version" ("acl_version_id", "version") VALUES (1, 0) ;""",
+	15: """
+		CREATE TABLE "effective_access" (
+		"repository_id" INTEGER NOT NULL
+			CONSTRAINT "fk_effective_access_repo" REFERENCES "repository" ("repository_id") ON DELETE CASCADE ON UPDATE CASCADE ,
+		"user_id" INTEGER NOT NULL
+			CONSTRAINT "fk_effective_access_user" REFERENCES "user" ("user_id") ON DELETE CASCADE ON UPDATE CASCADE ,
+		"access" INTEGER NOT NULL DEFAULT 0 ,
+		PRIMARY KEY ("repository_id", "user_id") );""",
+	16: """CREATE INDEX "fk_effective_access_user" ON "effective_access" ("user_id") ;""",
+	17: """CREATE INDEX "path_INDEX" ON "repository" ("path") ;""",
+	18: """CREATE INDEX "owner_team_INDEX" ON "repository" ("owner_team_id") ;""",
+	19: """CREATE INDEX "owner_user_INDEX" ON "repository" ("owner_user_id") ;""",
+	20: """
+		CREATE TABLE "schema_change_progress" (
+		"name" VARCHAR(128) NOT NULL ,
+		"last_key" INTEGER NOT NULL ,
+		"rows_done" INTEGER NOT NULL DEFAULT 0 ,
+		"updated_date" DATETIME NOT NULL ,
+		PRIMARY KEY ("name") );""",
+	21: """ALTER TABLE "user" ADD COLUMN "username_lower" VARCHAR(128) NULL DEFAULT NULL ;""",
+	22: migrations.ChunkedMigration("backfillUsernameLower", "user", "user_id", migrations.lowerUsernames),
+	#Usernames that only differ in case stop it here, rename one of them and run update-db again
+	23: """CREATE UNIQUE INDEX "username_lower_UNIQUE" ON "user" ("username_lower") ;""",
+}
+
+#A new database gets every statement in one pass, migrations have nothing to do on empty tables and are left out
+baseline_version=max(schema)
+baseline=[schema[version] for version in sorted(schema) if not callable(schema[version])]
@@ -16,6 +16,6 @@ setup (
     url="http://github.com/basementcat/gitastic",
     packages=["gitastic", "tests"],
     test_suite="nose.collector",
-    install_requires=["storm", "furl", "multiconfig", "bcrypt"],
+    install_requires=["storm", "furl", "multiconfig", "bcrypt", "futures"],
     tests_require=["nose"]
 )
\ No newline at end of file
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+#Throughput and latency of gitastic-shell's authorization path against a generated dataset, without sshd.
+#Not collected by "python setup.py test", run it by hand before deploying changes to database.py:
+#  python tests/benchmark_shell.py [--database URI] [--users N] [--repositories M] [--concurrency 1,2,4,...]
+#The database is wiped and reloaded, point it at a scratch database (it defaults to the one the tests use)
+import sys
+import os
+import time
+import random
+import struct
+import base64
+import argparse
+import subprocess
+import threading
+import tempfile
+import shutil
+import yaml
+import furl
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gitastic"))
+from lib import gitastic, database, shellauth, timing
+
+GITASTIC_DIR=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gitastic")
+CONCURRENCY=(1, 2, 4, 8, 16, 32, 64)
+BATCH_SIZE=500
+
+def makeKey(index, rng):
+    #A syntactically valid ssh-rsa public key with a unique modulus, sshd never sees it
+    blob="".join(struct.pack(">I", len(part))+part for part in ("ssh-rsa", "\x01\x00\x01", "\x00"+struct.pack(">I", index)+"".join(chr(rng.randint(0, 255)) for i in range(124))))
+    return u"ssh-rsa %s bench-%d"%(base64.b64encode(blob), index)
+
+def resetDatabase(uri):
+    parsed=furl.furl(uri)
+    if parsed.scheme=="sqlite":
+        path=str(parsed.host or "")+str(parsed.path or "")
+        if path and path!=":memory:" and os.path.exists(path):
+            os.unlink(path)
+    else:
+        store=database.getStore()
+        store.execute("SET FOREIGN_KEY_CHECKS = 0;")
+        for table in store.execute("show tables;"):
+            store.execute("drop table %s;"%(table[0],))
+        store.execute("SET FOREIGN_KEY_CHECKS = 1;")
+        store.commit()
+    database.disconnect()
+    subprocess.check_call([os.path.join(GITASTIC_DIR, "update-db"), uri], stdout=open(os.devnull, "w"))
+    database.connect()
+
+def generateDataset(users, repositories, teams, grants, team_share, seed):
+    #Returns (key ids, repository paths), every user has one key and the repositories are split between users and teams
+    rng=random.Random(seed)
+    store=database.getStore()
+    keys=[]
+    user_ids=[]
+    for start in range(0, users, BATCH_SIZE):
+        batch=[]
+        for i in range(start, min(start+BATCH_SIZE, users)):
+            user=database.User(username=u"bench%d"%(i,), email=u"bench%d@example.com"%(i,), password=u"")
+            key=database.UserSSHKey(user=user, name=u"bench", key=makeKey(i, rng))
+            store.add(key)
+            batch.append(key)
+        store.commit()
+        keys.extend(key.user_ssh_key_id for key in batch)
+        user_ids.extend(key.user_id for key in batch)
+
+    team_ids=[]
+    for i in range(teams):
+        team=database.Team(name=u"bench-team%d"%(i,))
+        store.add(team)
+        store.flush()
+        team_ids.append(team.team_id)
+        for user_id in rng.sample(user_ids, min(grants, len(user_ids))):
+            store.add(database.TeamMembership(team_id=team.team_id, user_id=user_id,
+                access=rng.choice((database.Team.ACC_VIEW, database.Team.ACC_MODERATE, database.Team.ACC_ADMIN))))
+        store.commit()
+
+    owners=dict(store.find(database.User).values(database.User.user_id, database.User.username))
+    team_names=dict(store.find(database.Team).values(database.Team.team_id, database.Team.name))
+    paths=[]
+    for start in range(0, repositories, BATCH_SIZE):
+        for i in range(start, min(start+BATCH_SIZE, repositories)):
+            repo=database.Repository(name=u"repo%d"%(i,), description=u"", public=rng.random()<0.1)
+            if team_ids and rng.random()<team_share:
+                repo.owner_team_id=rng.choice(team_ids)
+                repo.owner_user_id=0
+                repo.path=u"%s/%s"%(team_names[repo.owner_team_id], repo.name)
+            else:
+                repo.owner_user_id=rng.choice(user_ids)
+                repo.owner_team_id=0
+                repo.path=u"%s/%s"%(owners[repo.owner_user_id], repo.name)
+            store.add(repo)
+            store.flush()
+            paths.append(repo.path)
+            for user_id in rng.sample(user_ids, min(grants, len(user_ids))):
+                store.add(database.RepositoryAccess(repository_id=repo.repository_id, user_id=user_id,
+                    access=rng.choice((database.Repository.ACC_VIEW, database.Repository.ACC_PUSH, database.Repository.ACC_ADMIN))))
+        store.commit()
+    database.rebuildEffectiveAccess()
+    return keys, paths
+
+def makeSessions(keys, paths, count, push_share, seed):
+    rng=random.Random(seed)
+    return [(rng.choice(keys), "%s '%s.git'"%("git-receive-pack" if rng.random()<push_share else "git-upload-pack", rng.choice(paths)))
+        for i in range(count)]
+
+def runShell(config_dir, keyid, command):
+    #One gitastic-shell process, as sshd would start it.  True if access was granted
+    env=dict(os.environ, SSH_ORIGINAL_COMMAND=command)
+    with open(os.devnull, "w") as devnull:
+        return subprocess.call([os.path.join(GITASTIC_DIR, "gitastic-shell"), str(keyid), config_dir],
+            env=env, stdout=devnull, stderr=devnull)==0
+
+def runInProcess(config_dir, keyid, command):
+    #Only the authorization logic, what gitastic-authd does per request
+    try:
+        shellauth.authorize(keyid, command)
+        return True
+    except shellauth.ShellAuthError:
+        return False
+    finally:
+        database.releaseStore()
+
+def runLevel(run, config_dir, sessions, concurrency):
+    #Returns (wall seconds, sorted latencies in ms, allowed count)
+    pending=list(reversed(sessions))
+    lock=threading.Lock()
+    latencies=[]
+    allowed=[0]
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                keyid, command=pending.pop()
+            started=time.time()
+            result=run(config_dir, keyid, command)
+            elapsed=(time.time()-started)*1000
+            with lock:
+                latencies.append(elapsed)
+                allowed[0]+=1 if result else 0
+
+    workers=[threading.Thread(target=worker) for i in range(concurrency)]
+    started=time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.time()-started, sorted(latencies), allowed[0]
+
+def main():
+    parser=argparse.ArgumentParser(description="Benchmark gitastic-shell's authorization path")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "config"), help="Config directory to start from")
+    parser.add_argument("--database", help="Database URI to load the dataset into, defaults to the config's DatabaseURI")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--repositories", type=int, default=2000)
+    parser.add_argument("--teams", type=int, default=20)
+    parser.add_argument("--team-share", type=float, default=0.3, help="Fraction of repositories owned by teams")
+    parser.add_argument("--grants", type=int, default=25, help="repository_access rows per repository (and members per team)")
+    parser.add_argument("--sessions", type=int, default=500, help="Sessions per concurrency level")
+    parser.add_argument("--push-share", type=float, default=0.2)
+    parser.add_argument("--concurrency", default=",".join(str(level) for level in CONCURRENCY))
+    parser.add_argument("--in-process", action="store_true", help="Call the authorization logic directly instead of starting gitastic-shell")
+    parser.add_argument("--effective-access", action="store_true", help="Set Repository/UseEffectiveAccess")
+    parser.add_argument("--seed", type=int, default=1)
+    args=parser.parse_args()
+
+    temp_dir=tempfile.mkdtemp()
+    try:
+        #gitastic-shell gets the same configuration, with the dataset's database and git programs that exit as
+        #soon as they're handed off to
+        config_dir=os.path.join(temp_dir, "config")
+        shutil.copytree(args.config, config_dir)
+        exec_path=os.path.join(temp_dir, "git-exec")
+        os.mkdir(exec_path)
+        for program in shellauth.ACTIONS:
+            with open(os.path.join(exec_path, program), "w") as fp:
+                fp.write("#!/bin/sh\nexit 0\n")
+            os.chmod(os.path.join(exec_path, program), 0755)
+        overrides={"Repository": {"BaseDirectory": os.path.join(temp_dir, "repositories"), "UseEffectiveAccess": args.effective_access,
+            "GitExecPath": exec_path}}
+        if args.database:
+            overrides["DatabaseURI"]=args.database
+        with open(os.path.join(config_dir, "testing_config.yml"), "w") as fp:
+            fp.write(yaml.dump(overrides))
+        gitastic.configDir=config_dir
+        gitastic.init()
+
+        started=time.time()
+        resetDatabase(gitastic.config.get("DatabaseURI", do_except=True))
+        keys, paths=generateDataset(args.users, args.repositories, args.teams, args.grants, args.team_share, args.seed)
+        print "Loaded %d users, %d repositories, %d teams in %.1fs"%(len(keys), len(paths), args.teams, time.time()-started)
+
+        run=runInProcess if args.in_process else runShell
+        print "%11s %10s %9s %9s %9s %9s %8s"%("concurrency", "sessions/s", "p50 ms", "p95 ms", "p99 ms", "max ms", "allowed")
+        for level in [int(level) for level in args.concurrency.split(",")]:
+            sessions=makeSessions(keys, paths, args.sessions, args.push_share, args.seed+level)
+            elapsed, latencies, allowed=runLevel(run, config_dir, sessions, level)
+            print "%11d %10.1f %9.2f %9.2f %9.2f %9.2f %8d"%(level, len(sessions)/elapsed,
+                timing.percentile(latencies, 50), timing.percentile(latencies, 95), timing.percentile(latencies, 99), latencies[-1], allowed)
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,73 @@
+import sys
+import os
+from contextlib import contextmanager
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "gitastic"))
+
+from lib import database
+
+#Catch queries on hot paths that read a whole table because no index fits, used by test_queryplan.py:
+#  self.assertNoFullScans(lambda: database.Repository.findByPath(u"Tester/test-repo"))
+#MySQL plans are rejected when a table is read with type=ALL and no index was even considered (with a handful of
+#rows MySQL scans anyway, that's fine as long as the index is there for when the table grows).  sqlite plans are
+#rejected on any SCAN that isn't through an index.  QueryBudgetAssertions pins down how many statements they send
+CHECKED=("SELECT", "UPDATE", "DELETE")
+
+def captureStatements(function):
+    #Run function, returns the statements it ran as [(statement, params)]
+    with database.profile() as profile:
+        function()
+    return [(statement, params) for statement, params, elapsed in profile.statements if statement.lstrip().upper().startswith(CHECKED)]
+
+def explain(store, statement, params):
+    #Returns a list of problems with the plan of one statement, empty if it's fine
+    if database.database.__class__.__name__=="SQLite":
+        problems=[]
+        for row in store.execute("EXPLAIN QUERY PLAN "+statement, params):
+            detail=row[-1]
+            if detail.startswith("SCAN") and " USING " not in detail:
+                problems.append(detail)
+        return problems
+    result=store.execute("EXPLAIN "+statement, params)
+    columns=[column[0].lower() for column in result._raw_cursor.description]
+    problems=[]
+    for row in result:
+        plan=dict(zip(columns, row))
+        if plan.get("type")=="ALL" and plan.get("possible_keys") is None:
+            problems.append("full scan of %s"%(plan.get("table"),))
+    return problems
+
+def findFullScans(function):
+    #[(statement, [problems])] for every statement function ran with a bad plan
+    statements=captureStatements(function)
+    store=database.getStore()
+    found=[]
+    for statement, params in statements:
+        problems=explain(store, statement, params)
+        if problems:
+            found.append((statement, problems))
+    return found
+
+class QueryPlanAssertions(object):
+    #Mix into a TestCase
+    def assertNoFullScans(self, function, msg=None):
+        found=findFullScans(function)
+        if found:
+            self.fail(msg or "Full table scans:\n"+"\n".join("%s\n    %s"%(statement, "; ".join(problems)) for statement, problems in found))
+
+class QueryBudgetAssertions(object):
+    #Mix into a TestCase to pin down how many statements a hot path may send:
+    #  with self.assertMaxQueries(2):
+    #      repo.getAccess(user)
+    @contextmanager
+    def assertMaxQueries(self, maximum, msg=None):
+        with database.profile() as profile:
+            yield profile
+        if profile.queries>maximum:
+            self.fail(msg or "%d queries, at most %d expected\n%s"%(profile.queries, maximum, profile.report()))
+
+    @contextmanager
+    def assertNoDuplicateQueries(self, msg=None):
+        with database.profile() as profile:
+            yield profile
+        if profile.getDuplicates():
+            self.fail(msg or "Statements repeated with the same parameters\n%s"%(profile.report(),))
@@ -0,0 +1,150 @@
+import unittest
+import sys
+import os
+import tempfile
+import shutil
+from storm.tracer import install_tracer, remove_tracer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "gitastic"))
+
+from lib import gitastic, database, accesscache, shellauth
+from test_models import _ModelTestBase
+
+class QueryCounter(object):
+    def __init__(self):
+        self.count=0
+
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        self.count+=1
+
+class TestAccessCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir=tempfile.mkdtemp()
+        self.cache=accesscache.AccessCache(os.path.join(self.temp_dir, "access.db"))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_hit(self):
+        self.cache.setVersion(3)
+        self.cache.put(1, u"Tester/test-repo", u"/repos/Tester/test-repo.git", 2, False, 3)
+        self.assertEqual(self.cache.get(1, u"Tester/test-repo"), (u"/repos/Tester/test-repo.git", 2, False))
+        self.assertIsNone(self.cache.get(2, u"Tester/test-repo"))
+
+    def test_old_version(self):
+        self.cache.setVersion(3)
+        self.cache.put(1, u"Tester/test-repo", u"/repos/Tester/test-repo.git", 2, False, 3)
+        self.cache.setVersion(4)
+        self.assertIsNone(self.cache.get(1, u"Tester/test-repo"))
+        #Versions only go forward, a slow reader can't bring old entries back
+        self.cache.setVersion(3)
+        self.cache.put(1, u"Tester/test-repo", u"/repos/Tester/test-repo.git", 2, False, 3)
+        self.assertIsNone(self.cache.get(1, u"Tester/test-repo"))
+
+    def test_expired(self):
+        self.cache.max_age=-1
+        self.cache.setVersion(3)
+        self.cache.put(1, u"Tester/test-repo", u"/repos/Tester/test-repo.git", 2, False, 3)
+        self.assertIsNone(self.cache.get(1, u"Tester/test-repo"))
+
+    def test_unreadable(self):
+        cache=accesscache.AccessCache(os.path.join(self.temp_dir, "missing", "access.db"))
+        self.assertIsNone(cache.get(1, u"Tester/test-repo"))
+        cache.setVersion(3)
+        cache.put(1, u"Tester/test-repo", u"/repos/Tester/test-repo.git", 2, False, 3)
+
+class TestAclVersion(_ModelTestBase):
+    def setUp(self):
+        super(TestAclVersion, self).setUp()
+        self.temp_dir=tempfile.mkdtemp()
+        self.original_configuration=gitastic.config.configuration
+        gitastic.config.configuration=gitastic.config._merged(gitastic.config.configuration, {
+            "Repository": {"BaseDirectory": self.temp_dir},
+            "AccessCache": {"File": os.path.join(self.temp_dir, "access.db"), "MaxAge": 60},
+        })
+        shellauth._access_cache=None
+
+        with open(os.path.join(os.path.dirname(__file__), "ssh", "TESTING_ONLY_client_rsa.pub"), "r") as fp:
+            keydata=unicode(fp.readline())
+        self.repo_owner=database.User(username=u"Tester", email=u"tester@example.com", password=u"")
+        self.repo_user=database.User(username=u"Tester2", email=u"tester2@example.com", password=u"")
+        self.user_key=database.UserSSHKey(user=self.repo_user, name=u"user", key=keydata)
+        self.team=database.Team(name=u"Test-team")
+        database.getStore().add(self.repo_owner)
+        database.getStore().add(self.user_key)
+        database.getStore().add(self.team)
+        database.getStore().commit()
+        self.repo=database.Repository(name=u"test-repo", description=u"Testing repo", public=False)
+        self.repo_owner.repositories.add(self.repo)
+        self.repo.setPath()
+        database.getStore().commit()
+        self.command="git-upload-pack 'Tester/test-repo.git'"
+
+    def tearDown(self):
+        if shellauth._access_cache:
+            shellauth._access_cache.close()
+        shellauth._access_cache=None
+        gitastic.config.configuration=self.original_configuration
+        shutil.rmtree(self.temp_dir)
+        super(TestAclVersion, self).tearDown()
+
+    def test_bumps(self):
+        version=database.getAclVersion()
+        self.repo.setAccess(self.repo_user, database.Repository.ACC_VIEW)
+        self.assertEqual(database.getAclVersion(), version+1)
+        self.team.setAccess(self.repo_user, database.Team.ACC_VIEW)
+        self.assertEqual(database.getAclVersion(), version+2)
+        self.user_key.delete()
+        self.assertEqual(database.getAclVersion(), version+3)
+
+    def test_resolve_carries_version(self):
+        self.assertEqual(database.resolveAccess(self.user_key.user_ssh_key_id, self.repo.path).acl_version, database.getAclVersion())
+
+    def test_cache_hit(self):
+        self.repo.setAccess(self.repo_user, database.Repository.ACC_VIEW)
+        shellauth.authorize(self.user_key.user_ssh_key_id, self.command)
+        counter=QueryCounter()
+        install_tracer(counter)
+        try:
+            decision=shellauth.authorize(self.user_key.user_ssh_key_id, self.command)
+        finally:
+            remove_tracer(counter)
+        self.assertTrue(decision["allow"])
+        self.assertEqual(counter.count, 0)
+
+    def test_cache_invalidated(self):
+        self.repo.setAccess(self.repo_user, database.Repository.ACC_VIEW)
+        self.assertTrue(shellauth.authorize(self.user_key.user_ssh_key_id, self.command)["allow"])
+        self.repo.setAccess(self.repo_user, database.Repository.ACC_NONE)
+        shellauth.getAccessCache().setVersion(database.getAclVersion())
+        with self.assertRaises(shellauth.ShellAuthError):
+            shellauth.authorize(self.user_key.user_ssh_key_id, self.command)
+
+    def test_path_taken_over(self):
+        #A decision cached for a path mustn't carry over to another repository that gets the same path
+        push="git-receive-pack 'Tester/test-repo.git'"
+        self.repo.setAccess(self.repo_user, database.Repository.ACC_PUSH)
+        self.assertTrue(shellauth.authorize(self.user_key.user_ssh_key_id, push)["allow"])
+        self.repo.name=u"renamed"
+        self.repo.setPath()
+        database.getStore().commit()
+        new=database.Repository(name=u"test-repo", description=u"Taking over the path", public=False)
+        self.repo_owner.repositories.add(new)
+        new.setPath()
+        new.create()
+        database.getStore().commit()
+        self.assertEqual(new.getAccess(self.repo_user), database.Repository.ACC_NONE)
+        #What the next miss by any key, or refresh-access-cache, does
+        shellauth.getAccessCache().setVersion(database.getAclVersion())
+        with self.assertRaises(shellauth.ShellAuthError):
+            shellauth.authorize(self.user_key.user_ssh_key_id, push)
+
+    def test_rename_bumps(self):
+        version=database.getAclVersion()
+        self.repo_owner.setUsername(u"Renamed")
+        self.team.setName(u"Renamed-team")
+        database.getStore().commit()
+        self.assertEqual(database.getAclVersion(), version+2)
+
+if __name__ == '__main__':
+    unittest.main()
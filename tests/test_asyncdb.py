@@ -0,0 +1,81 @@
+import unittest
+import sys
+import os
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "gitastic"))
+
+from lib import gitastic, database, asyncdb
+from test_models import _ModelTestBase
+
+class TestAsyncDatabase(_ModelTestBase):
+    def setUp(self):
+        super(TestAsyncDatabase, self).setUp()
+        self.user=database.User(username=u"Tester", email=u"tester@example.com", password=u"")
+        self.user.setPassword(u"password")
+        database.getStore().add(self.user)
+        database.getStore().commit()
+        self.repo=database.Repository(name=u"test-repo", description=u"Testing repo", public=False)
+        self.user.repositories.add(self.repo)
+        self.repo.setPath()
+        database.getStore().commit()
+        self.db=asyncdb.AsyncDatabase(workers=2, max_pending=2)
+
+    def tearDown(self):
+        self.db.shutdown()
+        super(TestAsyncDatabase, self).tearDown()
+
+    def test_resolve_access(self):
+        resolved=self.db.resolveAccess(self.user, u"Tester/test-repo.git").result(5)
+        self.assertEqual(resolved.__dict__, database.resolveUserAccess(self.user.user_id, u"Tester/test-repo.git").__dict__)
+        self.assertEqual(resolved.access, database.Repository.ACC_OWNER)
+        self.assertIsNone(self.db.resolveAccess(self.user.user_id+100, u"Tester/test-repo.git").result(5))
+
+    def test_authenticate(self):
+        snapshot=self.db.authenticate(u"Tester", u"password").result(5)
+        self.assertEqual(snapshot.user_id, self.user.user_id)
+        self.assertIsNone(self.db.authenticate(u"Tester", u"wrong").result(5))
+        #Snapshots aren't tied to the worker's store
+        self.assertEqual(self.db.resolveAccess(snapshot, u"Tester/test-repo").result(5).repository_id, self.repo.repository_id)
+
+    def test_find_repository(self):
+        self.assertEqual(self.db.findRepository(u"Tester/test-repo.git").result(5).repository_id, self.repo.repository_id)
+        self.assertIsNone(self.db.findRepository(u"Tester/nothing").result(5))
+
+    def test_releases_stores(self):
+        futures=[self.db.findRepository(u"Tester/test-repo") for i in range(4)]
+        for future in futures:
+            future.result(5)
+        #Only this thread's store is still checked out
+        self.assertEqual(database.getPoolMetrics()["in_use"], 1)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            self.db.resolveAccess(u"nobody", u"Tester/test-repo").result(5)
+        self.assertEqual(self.db.findRepository(u"Tester/test-repo").result(5).repository_id, self.repo.repository_id)
+
+    def test_busy(self):
+        release=threading.Event()
+        blocked=[self.db._submit(release.wait, 5) for i in range(4)]
+        with self.assertRaises(asyncdb.AsyncDatabaseBusy):
+            self.db.findRepository(u"Tester/test-repo").result(5)
+        release.set()
+        for future in blocked:
+            future.result(5)
+        self.assertEqual(self.db.findRepository(u"Tester/test-repo").result(5).repository_id, self.repo.repository_id)
+
+    def test_event_loop(self):
+        if asyncdb.asyncio is None:
+            self.skipTest("Neither asyncio nor trollius is installed")
+        loop=asyncdb.asyncio.new_event_loop()
+        db=asyncdb.AsyncDatabase(workers=2, loop=loop)
+        try:
+            resolved=loop.run_until_complete(db.resolveAccess(self.user, u"Tester/test-repo"))
+            self.assertEqual(resolved.access, database.Repository.ACC_OWNER)
+            results=loop.run_until_complete(asyncdb.asyncio.gather(*[db.authenticate(u"Tester", u"password") for i in range(5)]))
+            self.assertEqual([snapshot.user_id for snapshot in results], [self.user.user_id]*5)
+        finally:
+            db.shutdown()
+            loop.close()
+
+if __name__ == '__main__':
+    unittest.main()
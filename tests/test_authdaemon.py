@@ -0,0 +1,112 @@
+import unittest
+import sys
+import os
+import threading
+import tempfile
+import shutil
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "gitastic"))
+
+from lib import gitastic, database, authclient, authdaemon, shellauth
+from test_models import _ModelTestBase
+
+class TestAuthDaemon(_ModelTestBase):
+    def setUp(self):
+        super(TestAuthDaemon, self).setUp()
+        self.temp_dir=tempfile.mkdtemp()
+        self.socket_path=os.path.join(self.temp_dir, "authd.sock")
+
+        keydata=[]
+        for keyfile in ("TESTING_ONLY_client_rsa.pub", "TESTING_ONLY_client_rsa_2.pub"):
+            with open(os.path.join(os.path.dirname(__file__), "ssh", keyfile), "r") as fp:
+                keydata.append(unicode(fp.readline()))
+        self.owner=database.User(username=u"Tester", email=u"tester@example.com", password=u"")
+        self.other=database.User(username=u"Tester2", email=u"tester2@example.com", password=u"")
+        self.owner_key=database.UserSSHKey(user=self.owner, name=u"owner", key=keydata[0])
+        self.other_key=database.UserSSHKey(user=self.other, name=u"other", key=keydata[1])
+        database.getStore().add(self.owner_key)
+        database.getStore().add(self.other_key)
+        database.getStore().commit()
+        self.repo=database.Repository(name=u"test-repo", description=u"Testing repo", public=False)
+        self.owner.repositories.add(self.repo)
+        self.repo.setPath()
+        database.getStore().commit()
+
+        self.server=authdaemon.AuthDaemon(self.socket_path, workers=2)
+        self.server_thread=threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server_thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+        super(TestAuthDaemon, self).tearDown()
+
+    def test_allow(self):
+        decision=authclient.authorize(self.owner_key.user_ssh_key_id, "git-receive-pack 'Tester/test-repo.git'", path=self.socket_path)
+        self.assertTrue(decision["allow"])
+        self.assertEqual(decision["directory"], self.repo.getRepositoryDir())
+        self.assertEqual(decision["command"], ["git-receive-pack", "Tester/test-repo.git"])
+        self.assertEqual(os.path.basename(decision["program"]), "git-receive-pack")
+
+    def test_deny_relative_path(self):
+        decision=authclient.authorize(self.owner_key.user_ssh_key_id, "git-upload-pack '../Tester/test-repo.git'", path=self.socket_path)
+        self.assertFalse(decision["allow"])
+
+    def test_deny_private(self):
+        decision=authclient.authorize(self.other_key.user_ssh_key_id, "git-upload-pack 'Tester/test-repo.git'", path=self.socket_path)
+        self.assertFalse(decision["allow"])
+        self.assertEqual(decision["message"], "Repository does not exist: Tester/test-repo.git")
+        self.assertEqual(decision["outcome"], "denied")
+
+    def test_deny_unknown_key(self):
+        decision=authclient.authorize(self.other_key.user_ssh_key_id+100, "git-upload-pack 'Tester/test-repo.git'", path=self.socket_path)
+        self.assertFalse(decision["allow"])
+        self.assertEqual(decision["message"], "Your SSH key is not recognized")
+        self.assertEqual(decision["outcome"], "unknown_key")
+
+    def test_sees_new_grants(self):
+        self.repo.setAccess(self.other, database.Repository.ACC_VIEW)
+        decision=authclient.authorize(self.other_key.user_ssh_key_id, "git-upload-pack 'Tester/test-repo.git'", path=self.socket_path)
+        self.assertTrue(decision["allow"])
+
+    def test_daemon_unavailable(self):
+        with self.assertRaises(authclient.DaemonUnavailable):
+            authclient.authorize(self.owner_key.user_ssh_key_id, "git-upload-pack 'Tester/test-repo.git'", path=os.path.join(self.temp_dir, "missing.sock"))
+
+class TestValidateRepositoryDir(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir=tempfile.mkdtemp()
+        self.base=os.path.join(self.temp_dir, "repositories")
+        self.outside=os.path.join(self.temp_dir, "outside")
+        os.makedirs(os.path.join(self.base, "Tester", "test-repo.git"))
+        os.makedirs(os.path.join(self.outside, "secret.git"))
+        os.symlink(os.path.join(self.outside, "secret.git"), os.path.join(self.base, "Tester", "linked.git"))
+        self.original_configuration=gitastic.config.configuration
+        gitastic.config.configuration=gitastic.config._merged(gitastic.config.configuration, {"Repository": {"BaseDirectory": self.base}})
+
+    def tearDown(self):
+        gitastic.config.configuration=self.original_configuration
+        shutil.rmtree(self.temp_dir)
+
+    def test_inside(self):
+        directory=os.path.join(self.base, "Tester", "test-repo.git")
+        self.assertEqual(shellauth.validateRepositoryDir(directory, "Tester/test-repo.git"), os.path.realpath(directory))
+
+    def _assertRejected(self, directory, requested):
+        with self.assertRaises(shellauth.ShellAuthError) as context:
+            shellauth.validateRepositoryDir(directory, requested)
+        #Only what the client asked for goes back to them, never a path on the server
+        self.assertEqual(str(context.exception), "Repository does not exist: %s"%(requested,))
+
+    def test_symlink_outside(self):
+        self._assertRejected(os.path.join(self.base, "Tester", "linked.git"), "Tester/linked.git")
+
+    def test_parent_directory(self):
+        self._assertRejected(os.path.join(self.base, "..", "outside", "secret.git"), "../outside/secret.git")
+
+    def test_base_itself(self):
+        self._assertRejected(self.base, "")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+import sys
+import os
+import glob
+import stat
+import tempfile
+import shutil
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "gitastic"))
+
+from lib import gitastic, database, authkeys, sshkeys
+from test_models import _ModelTestBase
+
+class TestKeyLines(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(os.path.dirname(__file__), "ssh", "TESTING_ONLY_client_rsa.pub"), "r") as fp:
+            self.keydata=fp.readline()
+
+    def test_format(self):
+        line=sshkeys.formatKeyLine(7, self.keydata, "/opt/gitastic-shell")
+        self.assertTrue(line.startswith("command=\"/opt/gitastic-shell 7\",%s "%(sshkeys.DEFAULT_OPTIONS,)))
+        self.assertTrue(line.endswith(" ".join(self.keydata.split()[:3])+"\n"))
+
+    def test_format_invalid(self):
+        with open(os.path.join(os.path.dirname(__file__), "ssh", "TESTING_ONLY_client_rsa"), "r") as fp:
+            self.assertIsNone(sshkeys.formatKeyLine(7, fp.read(), "/opt/gitastic-shell"))
+
+    def test_format_no_injection(self):
+        keyType, keyData, keyComment=self.keydata.split()
+        self.assertIsNone(sshkeys.formatKeyLine(7, "%s %s %s\ncommand=\"/bin/sh\" %s"%(keyType, keyData, keyComment, self.keydata), "/opt/gitastic-shell"))
+        with self.assertRaises(ValueError):
+            sshkeys.formatKeyLine(7, self.keydata, "/opt/gitastic-shell\" /bin/sh")
+
+class TestAuthorizedKeysSync(_ModelTestBase):
+    def setUp(self):
+        super(TestAuthorizedKeysSync, self).setUp()
+        self.temp_dir=tempfile.mkdtemp()
+        self.authorized_keys=os.path.join(self.temp_dir, "authorized_keys")
+        self.user=database.User(username=u"Tester", email=u"tester@example.com", password=u"")
+        database.getStore().add(self.user)
+        for fname in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "ssh", "TESTING_ONLY_client_rsa*"))):
+            with open(fname, "r") as fp:
+                self.user.keys.add(database.UserSSHKey(name=unicode(os.path.basename(fname)), key=unicode(fp.read())))
+        database.getStore().commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        super(TestAuthorizedKeysSync, self).tearDown()
+
+    def _lines(self):
+        with open(self.authorized_keys, "r") as fp:
+            return fp.readlines()
+
+    def test_sync(self):
+        self.assertTrue(authkeys.sync(self.authorized_keys))
+        lines=self._lines()
+        self.assertTrue(lines[0].startswith(authkeys.MARKER_PREFIX))
+        valid=[key for key in self.user.keys if database.UserSSHKey.validateKey(key.key)]
+        self.assertEqual(len(lines)-1, len(valid))
+        for key, line in zip(sorted(valid, key=lambda k: k.user_ssh_key_id), lines[1:]):
+            self.assertIn(" %d\","%(key.user_ssh_key_id,), line)
+        self.assertEqual(stat.S_IMODE(os.stat(self.authorized_keys).st_mode), 0600)
+
+    def test_sync_unchanged(self):
+        self.assertTrue(authkeys.sync(self.authorized_keys))
+        self.assertFalse(authkeys.sync(self.authorized_keys))
+        self.assertTrue(authkeys.sync(self.authorized_keys, force=True))
+
+    def test_sync_changed(self):
+        self.assertTrue(authkeys.sync(self.authorized_keys))
+        count=len(self._lines())
+        with open(os.path.join(os.path.dirname(__file__), "ssh", "TESTING_ONLY_host_rsa.pub"), "r") as fp:
+            key=database.UserSSHKey(name=u"another", key=unicode(fp.read()))
+        self.user.keys.add(key)
+        database.getStore().commit()
+        self.assertTrue(authkeys.sync(self.authorized_keys))
+        self.assertEqual(len(self._lines()), count+1)
+        database.getStore().remove(key)
+        database.getStore().commit()
+        self.assertTrue(authkeys.sync(self.authorized_keys))
+        self.assertEqual(len(self._lines()), count)
+
+    def test_sync_batches(self):
+        self.assertTrue(authkeys.sync(self.authorized_keys, batch_size=1))
+        batched=self._lines()
+        self.assertTrue(authkeys.sync(self.authorized_keys, force=True))
+        self.assertEqual(batched, self._lines())
+
+    def test_lookup(self):
+        for key in self.user.keys:
+            line=authkeys.lookup(key.fingerprint) if key.fingerprint else None
+            self.assertEqual(line, sshkeys.formatKeyLine(key.user_ssh_key_id, key.key, authkeys.getShell()))
+        self.assertIsNone(authkeys.lookup(u"SHA256:nosuchkey"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import unittest
+import sys
+import os
+import struct
+import base64
+import shutil
+import tempfile
+from StringIO import StringIO
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "gitastic"))
+
+from lib import gitastic, database, bulkimport
+from test_models import _ModelTestBase
+
+def makeKey(index):
+    blob="".join(struct.pack(">I", len(part))+part for part in ("ssh-rsa", "\x01\x00\x01", "\x00"+struct.pack(">I", index)+"\x55"*124))
+    return "ssh-rsa %s key-%d"%(base64.b64encode(blob), index)
+
+class TestReaders(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir=tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, name, content):
+        path=os.path.join(self.temp_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as fp:
+            fp.write(content)
+        return path
+
+    def test_authorized_keys(self):
+        path=self._write("authorized_keys", "\n".join([
+            "# gitolite start",
+            'command="/usr/share/gitolite/gl-auth-command alice",no-pty %s'%(makeKey(1),),
+            makeKey(2).replace("key-2", "bob@laptop"),
+            "garbage",
+        ]))
+        records=list(bulkimport.readAuthorizedKeys(path))
+        self.assertEqual([record[0] for record in records], ["alice", "bob", None])
+        self.assertEqual(records[0][3], makeKey(1))
+
+    def test_keydir(self):
+        self._write("keydir/alice.pub", makeKey(1)+"\n")
+        self._write("keydir/laptops/alice@laptop.pub", makeKey(2)+"\n")
+        self._write("keydir/carol@example.com.pub", makeKey(3)+"\n"+makeKey(4)+"\n")
+        self._write("keydir/README", "not a key")
+        records=list(bulkimport.readKeydir(os.path.join(self.temp_dir, "keydir")))
+        self.assertEqual([(record[0], record[2]) for record in records], [
+            ("alice", "alice.pub"), ("carol@example.com", "carol@example.com.pub"), ("carol@example.com", "carol@example.com.pub"), ("alice", "alice@laptop.pub")])
+
+    def test_csv(self):
+        path=self._write("users.csv", "username,email,key\nalice,alice@example.com,%s\n"%(makeKey(1),))
+        self.assertEqual(list(bulkimport.readCSV(path)), [("alice", u"alice@example.com", None, makeKey(1))])
+        with self.assertRaises(bulkimport.BulkImportError):
+            list(bulkimport.readCSV(self._write("bad.csv", "name,value\n")))
+
+    def test_check_record(self):
+        position, row, reason=bulkimport._checkRecord((3, "alice", u"", None, " ".join(makeKey(1).split()[:2])))
+        self.assertEqual(position, 3)
+        self.assertEqual(row[0], u"alice")
+        self.assertEqual(row[3], makeKey(1).replace("key-1", "alice"))
+        self.assertTrue(row[4].startswith("SHA256:"))
+        self.assertEqual(bulkimport._checkRecord((4, "alice", u"", None, "ssh-rsa AAAA x"))[2], "not a valid public key")
+        self.assertEqual(bulkimport._checkRecord((5, None, u"", None, makeKey(1)))[2], "no user name")
+
+class TestBulkImport(_ModelTestBase):
+    def setUp(self):
+        super(TestBulkImport, self).setUp()
+        self.temp_dir=tempfile.mkdtemp()
+        self.existing=database.User(username=u"Alice", email=u"alice@example.com", password=u"")
+        self.existing.keys.add(database.UserSSHKey(name=u"old", key=unicode(makeKey(0))))
+        database.getStore().add(self.existing)
+        database.getStore().commit()
+        self.csv=os.path.join(self.temp_dir, "users.csv")
+        with open(self.csv, "w") as fp:
+            fp.write("username,email,key,name\n")
+            for i in range(25):
+                fp.write("user%d,user%d@example.com,%s,laptop\n"%(i%10, i%10, makeKey(i+1)))
+            #Already stored, a duplicate within the file, a broken key, an existing user in another case and a bad name
+            fp.write("alice,,%s,\n"%(makeKey(0),))
+            fp.write("user1,,%s,\n"%(makeKey(5),))
+            fp.write("user1,,ssh-rsa AAAA broken,\n")
+            fp.write("ALICE,,%s,\n"%(makeKey(100),))
+            fp.write("not valid!,,%s,\n"%(makeKey(101),))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        super(TestBulkImport, self).tearDown()
+
+    def _import(self, **kwargs):
+        kwargs.setdefault("workers", 0)
+        kwargs.setdefault("out", StringIO())
+        kwargs.setdefault("errors", StringIO())
+        return bulkimport.BulkImport("csv", self.csv, **kwargs)
+
+    def _check(self):
+        store=database.getStore()
+        store.rollback()
+        self.assertEqual(store.find(database.User).count(), 11)
+        self.assertEqual(store.find(database.UserSSHKey).count(), 27)
+        self.assertEqual(store.find(database.UserSSHKey, database.UserSSHKey.user_id==self.existing.user_id).count(), 2)
+        user=database.User.findByUsername(u"user3")
+        self.assertEqual(user.email, u"user3@example.com")
+        self.assertEqual(sorted(key.name for key in user.keys), [u"laptop"]*3)
+        #What the shell looks keys up by
+        self.assertEqual(database.UserSSHKey.findByFingerprint(bulkimport._checkRecord((1, "user3", u"", None, makeKey(4)))[1][4]).user_id, user.user_id)
+
+    def test_import(self):
+        out, errors=StringIO(), StringIO()
+        with database.profile() as profile:
+            counts=self._import(batch_size=10, out=out, errors=errors).run()
+        self.assertEqual(counts, dict(records=30, users=10, keys=26, duplicates=2, invalid=2))
+        self._check()
+        self.assertIn("30 records done", out.getvalue())
+        self.assertIn("records/s", out.getvalue())
+        self.assertEqual(errors.getvalue(), "Record 28: not a valid public key\nnot valid!: not a valid user name\n")
+        #Multi-row inserts, a handful of statements per batch rather than per row
+        self.assertTrue(len([statement for statement, params, elapsed in profile.statements if statement.lstrip().upper().startswith("INSERT")])<=6)
+        self.assertFalse(os.path.exists(self.csv+".import-state"))
+        #Running it again adds nothing
+        self.assertEqual(self._import().run()["keys"], 0)
+
+    def test_login_without_password(self):
+        self._import().run()
+        user=database.User.findByUsername(u"user3")
+        self.assertFalse(user.hasPassword())
+        self.assertFalse(user.checkPassword(u""))
+        self.assertIsNone(database.User.authenticate(u"user3", u""))
+        self.assertIsNone(database.User.authenticate(u"user3", u"password"))
+        self.assertIsNone(database.User.authenticateFuture(u"user3", u"password").result(10))
+        #Until one is set
+        user.setPassword(u"password")
+        database.getStore().commit()
+        self.assertEqual(database.User.authenticate(u"user3", u"password").user_id, user.user_id)
+
+    def test_pool(self):
+        self.assertEqual(self._import(batch_size=7, workers=2).run()["keys"], 26)
+        self._check()
+
+    def test_resume(self):
+        importer=self._import(batch_size=10)
+        original=importer._insertBatch
+        def failing(store, batch):
+            if importer.counts["records"]>20:
+                raise RuntimeError("interrupted")
+            original(store, batch)
+        importer._insertBatch=failing
+        with self.assertRaises(RuntimeError):
+            importer.run()
+        self.assertEqual(importer.loadState(), 20)
+        out=StringIO()
+        counts=self._import(batch_size=10, out=out).run()
+        self.assertIn("Resuming %s after 20 records"%(self.csv,), out.getvalue())
+        self.assertEqual(counts["records"], 10)
+        self._check()
+
+    def test_other_state(self):
+        with open(self.csv+".import-state", "w") as fp:
+            fp.write('{"source": "/elsewhere", "format": "csv", "position": 3}')
+        with self.assertRaises(bulkimport.BulkImportError):
+            self._import().run()
+
+if __name__ == '__main__':
+    unittest.main()
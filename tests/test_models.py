@@ -5,15 +5,23 @@ import subprocess
 import shutil
 import glob
 import tempfile
+import time
 from storm.exceptions import IntegrityError
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "gitastic"))
 
-from lib import gitastic, database
+from lib import gitastic, database, passwords
 gitastic.configDir=os.path.join(os.path.dirname(__file__), "config")
 gitastic.init()
+from queryplan import captureStatements
 
 class _ModelTestBase(unittest.TestCase):
     def _drop_tables(self):
+        if database.database.__class__.__name__=="SQLite":
+            #Tests can run against a DatabaseURI of sqlite:/path/to/file too, newest first so foreign keys are dropped first
+            for table in list(database.getStore().execute("select name from sqlite_master where type='table' and name not like 'sqlite_%' order by rowid desc;")):
+                database.getStore().execute("drop table \"%s\";"%(table[0],))
+            database.getStore().commit()
+            return
         database.getStore().execute("SET FOREIGN_KEY_CHECKS = 0;")
         for table in database.getStore().execute("show tables;"):
             database.getStore().execute("drop table %s;"%(table[0],))
@@ -48,6 +56,105 @@ class TestUserModel(_ModelTestBase):
         self.assertIsNotNone(u)
         self.assertEqual(u.username, u"user1")
 
+    def test_find_by_username(self):
+        self.assertEqual(database.User.findByUsername(u"USER1").username, u"user1")
+        #LIKE wildcards are just characters
+        self.assertIsNone(database.User.findByUsername(u"user_"))
+        self.assertIsNone(database.User.findByUsername(u"u%"))
+        self.assertIsNone(database.User.authenticate("user_", "password"))
+        u=database.User.findByUsername(u"user1")
+        u.username=u"Renamed"
+        database.getStore().commit()
+        self.assertEqual(u.username_lower, u"renamed")
+        self.assertEqual(database.User.findByUsername(u"renamed").user_id, u.user_id)
+        self.assertIsNone(database.User.findByUsername(u"user1"))
+        self.assertEqual(database.User.findCachedByUsername(u"RENAMED").user_id, u.user_id)
+
+    def test_username_lower_unique(self):
+        database.getStore().add(database.User(username=u"USER1", email=u"other@example.com", password=u""))
+        with self.assertRaises(IntegrityError):
+            database.getStore().commit()
+        database.getStore().rollback()
+
+    def test_authenticate_future(self):
+        self.assertEqual(database.User.authenticateFuture("user1", "password").result(10).username, u"user1")
+        self.assertIsNone(database.User.authenticateFuture("user1", "nopassword").result(10))
+        self.assertIsNone(database.User.authenticateFuture("nouser", "nopassword").result(10))
+
+    def test_authenticate_cached(self):
+        credentials=passwords.getCredentialCache()
+        hits=credentials.getMetrics()["hits"]
+        self.assertIsNotNone(database.User.authenticate("user1", "password"))
+        self.assertIsNotNone(database.User.authenticate("user1", "password"))
+        self.assertEqual(credentials.getMetrics()["hits"], hits+1)
+        self.assertIsNone(database.User.authenticate("user1", "nopassword"))
+        #The old password stops working as soon as the new hash is stored
+        u=database.User.authenticate("user1", "password")
+        u.setPassword(u"password2")
+        database.getStore().commit()
+        self.assertIsNone(database.User.authenticate("user1", "password"))
+        self.assertIsNotNone(database.User.authenticate("user1", "password2"))
+
+    def test_rehash(self):
+        original_configuration=gitastic.config.configuration
+        rounds=passwords.getRounds(database.User.authenticate("user1", "password").password)
+        gitastic.config.configuration=gitastic.config._merged(gitastic.config.configuration, {"User": {"BcryptRounds": rounds+1}})
+        try:
+            u=database.User.authenticate("user1", "password")
+            self.assertIsNotNone(u)
+            #Stored in its own transaction, even though this store is rolled back
+            database.getStore().rollback()
+            self.assertEqual(passwords.getRounds(u.password), rounds+1)
+            self.assertIsNotNone(database.User.authenticate("user1", "password"))
+            self.assertIsNone(database.User.authenticate("user1", "nopassword"))
+            self.assertEqual(passwords.getRounds(u.password), rounds+1)
+        finally:
+            gitastic.config.configuration=original_configuration
+
+    def test_rehash_pool_exhausted(self):
+        #With every store in use the login goes ahead at once and keeps the old hash
+        original_configuration=gitastic.config.configuration
+        rounds=passwords.getRounds(database.User.authenticate("user1", "password").password)
+        gitastic.config.configuration=gitastic.config._merged(gitastic.config.configuration, {"User": {"BcryptRounds": rounds+1}})
+        pool, size, timeout=database.pool, database.pool.size, database.pool.timeout
+        held=[]
+        try:
+            database.getStore()
+            while pool._idle:
+                held.append(pool.checkout())
+            pool.size, pool.timeout=len(pool._open), 5
+            started=time.time()
+            u=database.User.authenticate("user1", "password")
+            self.assertLess(time.time()-started, 2)
+            self.assertIsNotNone(u)
+            self.assertEqual(passwords.getRounds(u.password), rounds)
+        finally:
+            pool.size, pool.timeout=size, timeout
+            for store in held:
+                pool.checkin(store)
+        try:
+            u=database.User.authenticate("user1", "password")
+            database.getStore().rollback()
+            self.assertEqual(passwords.getRounds(u.password), rounds+1)
+        finally:
+            gitastic.config.configuration=original_configuration
+
+    def test_token(self):
+        original_configuration=gitastic.config.configuration
+        gitastic.config.configuration=gitastic.config._merged(gitastic.config.configuration, {"User": {"TokenSecret": "secret"}})
+        try:
+            u=database.User.authenticate("user1", "password")
+            token=u.issueToken()
+            self.assertEqual(database.User.authenticateToken(token).username, u"user1")
+            self.assertIsNone(database.User.authenticateToken(token[:-1]+("0" if token[-1]!="0" else "1")))
+            self.assertIsNone(database.User.authenticateToken(u.issueToken(ttl=-10)))
+            self.assertIsNone(database.User.authenticateToken("garbage"))
+            u.setPassword(u"password2")
+            database.getStore().commit()
+            self.assertIsNone(database.User.authenticateToken(token))
+        finally:
+            gitastic.config.configuration=original_configuration
+
     def test_password_newhash(self):
         u=database.User()
         u.setPassword("password1")
@@ -98,6 +205,30 @@ class TestUserSSHKeyModel(_ModelTestBase):
         self.assertIsNotNone(u)
         self.assertEqual(u.keys.count(), len(self.pubkeys))
 
+    def test_fingerprint(self):
+        u=database.User(username=u"user", password=u"", email=u"")
+        for keyfile in self.pubkeys:
+            with open(keyfile, "r") as fp:
+                u.keys.add(database.UserSSHKey(name=unicode(keyfile), key=unicode(fp.read())))
+        database.getStore().add(u)
+        database.getStore().commit()
+        for key in u.keys:
+            self.assertTrue(key.fingerprint.startswith(u"SHA256:"))
+            self.assertEqual(database.UserSSHKey.findByFingerprint(key.fingerprint), key)
+        self.assertIsNone(database.UserSSHKey.findByFingerprint(u"SHA256:nosuchkey"))
+
+    def test_fingerprint_unique(self):
+        u=database.User(username=u"user", password=u"", email=u"")
+        with open(self.pubkeys[0], "r") as fp:
+            keydata=unicode(fp.read())
+        u.keys.add(database.UserSSHKey(name=u"first", key=keydata))
+        database.getStore().add(u)
+        database.getStore().commit()
+        with self.assertRaises(IntegrityError):
+            u.keys.add(database.UserSSHKey(name=u"second", key=keydata))
+            database.getStore().commit()
+        database.getStore().rollback()
+
 class TestRepositoryModel(_ModelTestBase):
     def setUp(self):
         super(TestRepositoryModel, self).setUp()
@@ -234,6 +365,255 @@ class TestRepositoryAccessModel(_ModelTestBase):
         with self.assertRaises(database.RepositoryError):
             self.repo.setAccess(self.repo_user, 173)
 
+class TestResolveAccess(_ModelTestBase):
+    def setUp(self):
+        super(TestResolveAccess, self).setUp()
+        keydata=[]
+        for keyfile in ("TESTING_ONLY_client_rsa.pub", "TESTING_ONLY_client_rsa_2.pub"):
+            with open(os.path.join(os.path.dirname(__file__), "ssh", keyfile), "r") as fp:
+                keydata.append(unicode(fp.readline()))
+        self.repo_owner=database.User(username=u"Tester", email=u"tester@example.com", password=u"")
+        self.repo_user=database.User(username=u"Tester2", email=u"tester2@example.com", password=u"")
+        self.owner_key=database.UserSSHKey(user=self.repo_owner, name=u"owner", key=keydata[0])
+        self.user_key=database.UserSSHKey(user=self.repo_user, name=u"user", key=keydata[1])
+        self.team=database.Team(name=u"Test-team")
+        database.getStore().add(self.owner_key)
+        database.getStore().add(self.user_key)
+        database.getStore().add(self.team)
+        database.getStore().commit()
+        self.repo=database.Repository(name=u"test-repo", description=u"Testing repo", public=False)
+        self.repo_owner.repositories.add(self.repo)
+        self.repo.setPath()
+        self.team_repo=database.Repository(name=u"test-team-repo", description=u"Testing repo", public=False)
+        self.team.repositories.add(self.team_repo)
+        database.getStore().commit()
+        self.team_repo.setPath()
+        database.getStore().commit()
+
+    def _assertSameAccess(self, repo, user, key):
+        resolved=database.resolveAccess(key.user_ssh_key_id, repo.path+".git")
+        self.assertEqual(resolved.user_id, user.user_id)
+        self.assertEqual(resolved.repository_id, repo.repository_id)
+        self.assertEqual(resolved.access, repo.getAccess(user))
+        self.assertEqual(resolved.getRepositoryDir(), repo.getRepositoryDir())
+        by_user=database.resolveUserAccess(user.user_id, repo.path+".git")
+        self.assertEqual(by_user.__dict__, resolved.__dict__)
+
+    def test_unknown_key(self):
+        self.assertIsNone(database.resolveAccess(self.user_key.user_ssh_key_id+100, self.repo.path))
+        self.assertIsNone(database.resolveUserAccess(self.repo_user.user_id+100, self.repo.path))
+
+    def test_unknown_repository(self):
+        resolved=database.resolveAccess(self.user_key.user_ssh_key_id, u"Tester/no-such-repo.git")
+        self.assertEqual(resolved.user_id, self.repo_user.user_id)
+        self.assertIsNone(resolved.repository_id)
+
+    def test_owner(self):
+        self._assertSameAccess(self.repo, self.repo_owner, self.owner_key)
+        self.assertEqual(database.resolveAccess(self.owner_key.user_ssh_key_id, self.repo.path).access, database.Repository.ACC_OWNER)
+
+    def test_user_repository(self):
+        for public in (False, True):
+            self.repo.public=public
+            database.getStore().commit()
+            for access in (database.Repository.ACC_NONE, database.Repository.ACC_VIEW, database.Repository.ACC_PUSH, database.Repository.ACC_ADMIN):
+                self.repo.setAccess(self.repo_user, access)
+                self._assertSameAccess(self.repo, self.repo_user, self.user_key)
+
+    def test_team_repository(self):
+        for public in (False, True):
+            self.team_repo.public=public
+            database.getStore().commit()
+            for team_access in (database.Team.ACC_NONE, database.Team.ACC_VIEW, database.Team.ACC_MODERATE, database.Team.ACC_ADMIN, database.Team.ACC_SUPERADMIN):
+                self.team.setAccess(self.repo_user, team_access)
+                for access in (database.Repository.ACC_NONE, database.Repository.ACC_VIEW, database.Repository.ACC_ADMIN):
+                    self.team_repo.setAccess(self.repo_user, access)
+                    self._assertSameAccess(self.team_repo, self.repo_user, self.user_key)
+
+class TestEffectiveAccess(TestResolveAccess):
+    #Every TestResolveAccess case again, answered from effective_access
+    def setUp(self):
+        super(TestEffectiveAccess, self).setUp()
+        self.original_configuration=gitastic.config.configuration
+        gitastic.config.configuration=gitastic.config._merged(gitastic.config.configuration, {"Repository": {"UseEffectiveAccess": True}})
+
+    def tearDown(self):
+        gitastic.config.configuration=self.original_configuration
+        super(TestEffectiveAccess, self).tearDown()
+
+    def _assertSameAccess(self, repo, user, key):
+        super(TestEffectiveAccess, self)._assertSameAccess(repo, user, key)
+        self.assertEqual(repo.getEffectiveAccess(user), repo.getAccess(user))
+
+    def test_set_owner(self):
+        self.team.setAccess(self.repo_user, database.Team.ACC_MODERATE)
+        version=database.getAclVersion()
+        self.repo.setOwner(self.team)
+        self.assertEqual(database.getAclVersion(), version+1)
+        self.assertEqual(self.repo.getEffectiveAccess(self.repo_user), database.Repository.ACC_PUSH)
+        self.assertEqual(self.repo.getEffectiveAccess(self.repo_owner), database.Repository.ACC_NONE)
+        self.repo.setOwner(self.repo_user)
+        self.assertEqual(database.getAclVersion(), version+2)
+        self._assertSameAccess(self.repo, self.repo_user, self.user_key)
+        self._assertSameAccess(self.repo, self.repo_owner, self.owner_key)
+
+    def test_set_public(self):
+        version=database.getAclVersion()
+        self.repo.setPublic(True)
+        self.assertEqual(database.getAclVersion(), version+1)
+        self._assertSameAccess(self.repo, self.repo_user, self.user_key)
+        self.assertEqual(self.repo.getEffectiveAccess(self.repo_user), database.Repository.ACC_VIEW)
+
+    def test_rebuild(self):
+        self.team.setAccess(self.repo_user, database.Team.ACC_ADMIN)
+        self.repo.setAccess(self.repo_user, database.Repository.ACC_PUSH)
+        expected=sorted(database.getStore().find(database.EffectiveAccess).values(
+            database.EffectiveAccess.repository_id, database.EffectiveAccess.user_id, database.EffectiveAccess.access))
+        database.getStore().find(database.EffectiveAccess).remove()
+        database.getStore().commit()
+        database.rebuildEffectiveAccess()
+        self.assertEqual(sorted(database.getStore().find(database.EffectiveAccess).values(
+            database.EffectiveAccess.repository_id, database.EffectiveAccess.user_id, database.EffectiveAccess.access)), expected)
+        self._assertSameAccess(self.team_repo, self.repo_user, self.user_key)
+        self._assertSameAccess(self.repo, self.repo_user, self.user_key)
+
+    def test_migration_rebuild(self):
+        #Schema version 19 fills the table without the models, it must come out the same
+        from schema import migrations
+        self.team.setAccess(self.repo_user, database.Team.ACC_MODERATE)
+        self.team_repo.setAccess(self.repo_owner, database.Repository.ACC_VIEW)
+        self.repo.setAccess(self.repo_user, database.Repository.ACC_ADMIN)
+        expected=sorted(database.getStore().find(database.EffectiveAccess).values(
+            database.EffectiveAccess.repository_id, database.EffectiveAccess.user_id, database.EffectiveAccess.access))
+        self.assertEqual(len(expected), 3)
+        migrations.rebuildEffectiveAccess(database.getStore(), chunk_size=1)
+        database.getStore().commit()
+        self.assertEqual(sorted(database.getStore().find(database.EffectiveAccess).values(
+            database.EffectiveAccess.repository_id, database.EffectiveAccess.user_id, database.EffectiveAccess.access)), expected)
+
+class _ManyUsersTestBase(_ModelTestBase):
+    def setUp(self):
+        super(_ManyUsersTestBase, self).setUp()
+        self.owner=database.User(username=u"Tester", email=u"tester@example.com", password=u"")
+        self.users=[database.User(username=u"Tester%d"%(i,), email=u"tester%d@example.com"%(i,), password=u"") for i in range(6)]
+        self.team=database.Team(name=u"Test-team")
+        for user in [self.owner]+self.users:
+            database.getStore().add(user)
+        database.getStore().add(self.team)
+        database.getStore().commit()
+        self.repos=[]
+        for i, owner in enumerate((self.owner, self.owner, self.team, self.team)):
+            repo=database.Repository(name=u"test-repo%d"%(i,), description=u"Testing repo", public=i%2==1)
+            owner.repositories.add(repo)
+            database.getStore().commit()
+            repo.setPath()
+            self.repos.append(repo)
+        database.getStore().commit()
+
+class TestBulkAccess(_ManyUsersTestBase):
+    def _snapshot(self):
+        store=database.getStore()
+        return (
+            sorted(store.find(database.RepositoryAccess).values(database.RepositoryAccess.repository_id, database.RepositoryAccess.user_id, database.RepositoryAccess.access)),
+            sorted(store.find(database.TeamMembership).values(database.TeamMembership.team_id, database.TeamMembership.user_id, database.TeamMembership.access)),
+            sorted(store.find(database.EffectiveAccess).values(database.EffectiveAccess.repository_id, database.EffectiveAccess.user_id, database.EffectiveAccess.access)),
+            [[repo.getAccess(user) for user in self.users] for repo in self.repos])
+
+    def _reset(self):
+        for table in (database.RepositoryAccess, database.TeamMembership, database.EffectiveAccess):
+            database.getStore().find(table).remove()
+        database.getStore().commit()
+
+    def test_same_as_per_user(self):
+        team_levels=(database.Team.ACC_SUPERADMIN, database.Team.ACC_ADMIN, database.Team.ACC_MODERATE, database.Team.ACC_VIEW, database.Team.ACC_NONE, database.Team.ACC_VIEW)
+        repo_levels=(database.Repository.ACC_ADMIN, database.Repository.ACC_PUSH, database.Repository.ACC_VIEW, database.Repository.ACC_NONE, database.Repository.ACC_VIEW, database.Repository.ACC_PUSH)
+        #Twice, the second round overwrites and revokes what the first one granted
+        rounds=(zip(self.users, team_levels, repo_levels), zip(self.users, reversed(team_levels), reversed(repo_levels)))
+        for changes in rounds:
+            for user, team_level, repo_level in changes:
+                self.team.setAccess(user, team_level)
+                for repo in self.repos:
+                    repo.setAccess(user, repo_level)
+        per_user=self._snapshot()
+
+        self._reset()
+        for changes in rounds:
+            self.team.setAccessMany(dict((user, team_level) for user, team_level, repo_level in changes))
+            self.repos[0].setAccessMany(dict((user, repo_level) for user, team_level, repo_level in changes))
+            database.Repository.setAccessAcross(self.repos[1:], dict((user.user_id, repo_level) for user, team_level, repo_level in changes))
+        self.assertEqual(self._snapshot(), per_user)
+
+    def test_statements(self):
+        #The number of statements doesn't grow with the number of users
+        counts=[]
+        for users in (self.users[:2], self.users):
+            counts.append(len(captureStatements(lambda: database.Repository.setAccessAcross(self.repos, dict((user, database.Repository.ACC_VIEW) for user in users)))))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_validates_first(self):
+        version=database.getAclVersion()
+        with self.assertRaises(database.RepositoryError):
+            self.repos[0].setAccessMany({self.users[0]: database.Repository.ACC_VIEW, self.users[1]: database.Repository.ACC_OWNER})
+        with self.assertRaises(database.RepositoryError):
+            self.team.setAccessMany({self.users[0]: database.Team.ACC_VIEW, self.users[1]: 173})
+        database.getStore().rollback()
+        self.assertEqual(self._snapshot()[:3], ([], [], []))
+        self.assertEqual(database.getAclVersion(), version)
+
+    def test_bumps_once(self):
+        version=database.getAclVersion()
+        database.Repository.setAccessAcross(self.repos, dict((user, database.Repository.ACC_PUSH) for user in self.users))
+        self.assertEqual(database.getAclVersion(), version+1)
+        self.team.setAccessMany(dict((user, database.Team.ACC_VIEW) for user in self.users))
+        self.assertEqual(database.getAclVersion(), version+2)
+
+class TestBatchedAccess(_ManyUsersTestBase):
+    def setUp(self):
+        super(TestBatchedAccess, self).setUp()
+        for i, user in enumerate(self.users):
+            self.team.setAccess(user, (database.Team.ACC_NONE, database.Team.ACC_VIEW, database.Team.ACC_SUPERADMIN)[i%3])
+            self.repos[i%4].setAccess(user, (database.Repository.ACC_VIEW, database.Repository.ACC_ADMIN)[i%2])
+        #Owned by a team that doesn't exist, like getOwner it falls back to the user
+        self.repos[1].owner_team_id=173
+        self.repos[1].owner_user=self.users[5]
+        database.getStore().commit()
+
+    def test_visible_repositories(self):
+        for user in [self.owner]+self.users:
+            expected=[(repo, repo.getAccess(user)) for repo in self.repos if repo.getAccess(user)!=database.Repository.ACC_NONE]
+            self.assertEqual(user.visibleRepositories(), expected)
+
+    def test_visible_repositories_pages(self):
+        user=self.users[2]
+        everything=user.visibleRepositories()
+        self.assertTrue(len(everything)>2)
+        pages=[]
+        after=None
+        while True:
+            page=user.visibleRepositories(after=after, limit=2)
+            if not page:
+                break
+            pages.extend(page)
+            after=page[-1][0].repository_id
+        self.assertEqual(pages, everything)
+        self.assertEqual(user.visibleRepositories(repositories=[self.repos[0], self.repos[3].repository_id]), [item for item in everything if item[0] in (self.repos[0], self.repos[3])])
+        self.assertEqual(user.visibleRepositories(repositories=[]), [])
+
+    def test_get_access_for_users(self):
+        everyone=[self.owner]+self.users
+        for repo in self.repos:
+            expected=dict((user.user_id, repo.getAccess(user)) for user in everyone)
+            self.assertEqual(repo.getAccessForUsers(everyone), expected)
+            self.assertEqual(repo.getAccessForUsers([user.user_id for user in everyone]), expected)
+        self.assertEqual(self.team.getAccessForUsers(everyone), dict((user.user_id, self.team.getAccess(user)) for user in everyone))
+
+    def test_statements(self):
+        #A fixed number of statements however many users or repositories are asked about
+        repo=self.repos[2]
+        repo.getOwner()
+        self.assertEqual(len(captureStatements(lambda: repo.getAccessForUsers(self.users[:1]))), len(captureStatements(lambda: repo.getAccessForUsers(self.users))))
+        self.assertEqual(len(captureStatements(lambda: self.users[2].visibleRepositories())), 1)
+
 class TestTeamModel(_ModelTestBase):
     def test_create_duplicate(self):
         team1=database.Team(name=u"Test-team1")
@@ -0,0 +1,173 @@
+import unittest
+import sys
+import os
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "gitastic"))
+
+from lib import gitastic, database, objectcache
+from test_models import _ModelTestBase
+from queryplan import captureStatements
+
+class TestObjectCache(unittest.TestCase):
+    def setUp(self):
+        self.now=[1000.0]
+        self.cache=objectcache.ObjectCache(size=2, ttl=30, clock=lambda: self.now[0])
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.put("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        metrics=self.cache.getMetrics()
+        self.assertEqual((metrics["hits"], metrics["misses"], metrics["entries"]), (1, 1, 1))
+
+    def test_lru(self):
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        #a was used last, b goes
+        self.cache.get("a")
+        self.cache.put("c", 3)
+        self.assertEqual((self.cache.get("a"), self.cache.get("b"), self.cache.get("c")), (1, None, 3))
+        self.assertEqual(self.cache.getMetrics()["evicted"], 1)
+
+    def test_ttl(self):
+        self.cache.put("a", 1)
+        self.now[0]+=29
+        self.assertEqual(self.cache.get("a"), 1)
+        self.now[0]+=2
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.getMetrics()["expired"], 1)
+        self.assertEqual(self.cache.getMetrics()["entries"], 0)
+
+    def test_invalidate(self):
+        self.cache.put("a", 1)
+        self.cache.invalidate("a")
+        self.cache.invalidate("b")
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.getMetrics()["invalidated"], 1)
+
+    def test_uncounted(self):
+        self.cache.put("a", 1)
+        self.assertEqual(self.cache.get("a", count=False), 1)
+        self.assertIsNone(self.cache.get("b", count=False))
+        metrics=self.cache.getMetrics()
+        self.assertEqual((metrics["hits"], metrics["misses"]), (0, 0))
+
+class TestCachedModels(_ModelTestBase):
+    def setUp(self):
+        super(TestCachedModels, self).setUp()
+        database.objects=objectcache.ObjectCache(size=100, ttl=30)
+        self.user=database.User(username=u"Tester", email=u"tester@example.com", password=u"")
+        database.getStore().add(self.user)
+        database.getStore().commit()
+        self.repo=database.Repository(name=u"test-repo", description=u"Testing repo", public=False)
+        self.user.repositories.add(self.repo)
+        database.getStore().commit()
+        self.repo.setPath()
+        database.getStore().commit()
+
+    def tearDown(self):
+        database.objects=None
+        super(TestCachedModels, self).tearDown()
+
+    def _inThread(self, target):
+        result=[]
+        def run():
+            try:
+                result.append(target())
+            finally:
+                database.releaseStore()
+        thread=threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        return result[0] if result else None
+
+    def test_get_cached(self):
+        snapshot=database.Repository.getCached(self.repo.repository_id)
+        self.assertEqual((snapshot.repository_id, snapshot.path, snapshot.public), (self.repo.repository_id, u"Tester/test-repo", False))
+        self.assertEqual(captureStatements(lambda: database.Repository.getCached(self.repo.repository_id)), [])
+        self.assertIsNone(database.Repository.getCached(173))
+        self.assertIs(snapshot.load(), self.repo)
+
+    def test_shared_between_threads(self):
+        snapshot=self._inThread(lambda: database.User.findCachedByUsername(u"Tester"))
+        self.assertEqual(snapshot.user_id, self.user.user_id)
+        self.assertIs(database.User.findCachedByUsername(u"Tester"), snapshot)
+        self.assertIs(database.User.getCached(self.user.user_id), snapshot)
+        self.assertEqual(database.getCacheMetrics()["hits"], 2)
+
+    def test_find_by_path(self):
+        snapshot=database.Repository.findCachedByPath(u"Tester/test-repo.git")
+        self.assertEqual(snapshot.repository_id, self.repo.repository_id)
+        self.assertEqual(captureStatements(lambda: database.Repository.findCachedByPath(u"Tester/test-repo")), [])
+        self.assertIsNone(database.Repository.findCachedByPath(u"Tester/nothing"))
+
+    def test_set_path(self):
+        database.Repository.findCachedByPath(u"Tester/test-repo")
+        self.repo.name=u"renamed"
+        self.repo.setPath()
+        database.getStore().commit()
+        self.assertIsNone(database.Repository.findCachedByPath(u"Tester/test-repo"))
+        self.assertEqual(database.Repository.findCachedByPath(u"Tester/renamed").repository_id, self.repo.repository_id)
+
+    def test_flush_invalidates(self):
+        database.User.getCached(self.user.user_id)
+        self.user.email=u"changed@example.com"
+        database.getStore().commit()
+        self.assertEqual(database.User.getCached(self.user.user_id).email, u"changed@example.com")
+        database.getStore().remove(self.user)
+        database.getStore().commit()
+        self.assertIsNone(database.User.getCached(self.user.user_id))
+        self.assertIsNone(database.User.findCachedByUsername(u"Tester"))
+
+    def test_not_cached_before_commit(self):
+        repository_id=self.repo.repository_id
+        self.repo.description=u"changed"
+        database.getStore().flush()
+        #Neither this store's uncommitted row nor the old one another thread reads in the meantime outlive the commit
+        self.assertEqual(database.Repository.getCached(repository_id).description, u"changed")
+        self.assertEqual(self._inThread(lambda: database.Repository.getCached(repository_id).description), u"Testing repo")
+        database.getStore().commit()
+        self.assertEqual(self._inThread(lambda: database.Repository.getCached(repository_id).description), u"changed")
+
+    def test_live_lookups(self):
+        user=database.User.findByUsername(u"TESTER")
+        self.assertIs(user, self.user)
+        #Straight from the store from now on
+        self.assertEqual(captureStatements(lambda: database.User.findByUsername(u"tester")), [])
+        self.assertEqual(captureStatements(lambda: database.User.authenticate(u"tester", u"wrong")), [])
+        self.assertIs(database.Repository.findByPath(u"Tester/test-repo.git"), self.repo)
+        self.assertEqual(captureStatements(lambda: database.Repository.findByPath(u"Tester/test-repo")), [])
+        #Renamed without a commit, the old name mustn't find it
+        self.repo.name=u"renamed"
+        self.repo.setPath()
+        self.assertIsNone(database.Repository.findByPath(u"Tester/test-repo"))
+        self.assertIs(database.Repository.findByPath(u"Tester/renamed"), self.repo)
+        self.user.username=u"Other"
+        self.assertIsNone(database.User.findByUsername(u"Tester"))
+        self.assertIs(database.User.findByUsername(u"other"), self.user)
+
+    def test_ambiguous_path(self):
+        self.assertIs(database.Repository.findByPath(u"Tester/test-repo"), self.repo)
+        #A team with the same name as the user, both with a test-repo
+        team=database.Team(name=u"Tester")
+        database.getStore().add(team)
+        other=database.Repository(name=u"test-repo", description=u"Same path", public=False)
+        team.repositories.add(other)
+        database.getStore().commit()
+        other.setPath()
+        database.getStore().commit()
+        self.assertIsNone(database.Repository.findByPath(u"Tester/test-repo"))
+        self.assertIsNone(database.Repository.findCachedByPath(u"Tester/test-repo"))
+
+    def test_read_only(self):
+        snapshot=database.User.getCached(self.user.user_id)
+        with self.assertRaises(database.ModelError):
+            snapshot.email=u"changed@example.com"
+
+    def test_disabled(self):
+        database.objects=None
+        self.assertEqual(database.User.findCachedByUsername(u"Tester").user_id, self.user.user_id)
+        self.assertIsNone(database.getCacheMetrics())
+
+if __name__ == '__main__':
+    unittest.main()
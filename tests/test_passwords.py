@@ -0,0 +1,145 @@
+import unittest
+import sys
+import os
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "gitastic"))
+
+from lib import gitastic, passwords
+gitastic.configDir=os.path.join(os.path.dirname(__file__), "config")
+gitastic.init()
+
+class _HasherTests(object):
+    workers=0
+
+    def setUp(self):
+        self.hasher=passwords.PasswordHasher(workers=self.workers, max_pending=1)
+
+    def tearDown(self):
+        self.hasher.shutdown()
+
+    def test_hash_check(self):
+        hashed=self.hasher.hash(u"password", rounds=4)
+        self.assertTrue(hashed.startswith("$2"))
+        self.assertTrue(self.hasher.check(u"password", hashed))
+        self.assertFalse(self.hasher.check(u"wrong", hashed))
+        self.assertNotEqual(self.hasher.hash(u"password", rounds=4), hashed)
+
+    def test_futures(self):
+        hashed=self.hasher.hashFuture(u"password", rounds=4).result(10)
+        futures=[self.hasher.checkFuture(password, hashed) for password in (u"password", u"wrong")]
+        self.assertEqual([future.result(10) for future in futures], [True, False])
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            self.hasher.check(u"password", u"not a hash")
+
+class TestInline(_HasherTests, unittest.TestCase):
+    workers=0
+
+class TestPool(_HasherTests, unittest.TestCase):
+    workers=2
+
+    def test_busy(self):
+        #Two running, one waiting, the fourth is turned away without waiting
+        sleeping=[self.hasher._submit(time.sleep, 0.5) for i in range(3)]
+        started=time.time()
+        with self.assertRaises(passwords.HashingBusy):
+            self.hasher.check(u"password", u"$2b$04$abcdefghijklmnopqrstuu")
+        self.assertTrue(time.time()-started<0.25)
+        for future in sleeping:
+            future.result(10)
+        hashed=self.hasher.hash(u"password", rounds=4)
+        self.assertTrue(self.hasher.check(u"password", hashed))
+
+class TestCalibration(unittest.TestCase):
+    def test_rounds(self):
+        self.assertEqual(passwords.getRounds(u"$2b$05$abcdefghijklmnopqrstuu"), 5)
+        self.assertIsNone(passwords.getRounds(u"not a hash"))
+        self.assertIsNone(passwords.getRounds(u""))
+        self.assertTrue(passwords.needsRehash(u"$2b$05$abcdefghijklmnopqrstuu", rounds=6))
+        self.assertFalse(passwords.needsRehash(u"$2b$06$abcdefghijklmnopqrstuu", rounds=6))
+        self.assertTrue(passwords.needsRehash(u"", rounds=6))
+
+    def test_calibrate(self):
+        #Every call to the clock moves it on by 0.1s, so each hash takes 0.1s whatever the cost
+        ticks=[0]
+        def clock():
+            ticks[0]+=0.1
+            return ticks[0]
+        results=passwords.calibrate(0.05, min_rounds=4, max_rounds=6, samples=2, clock=clock)
+        self.assertEqual([rounds for rounds, seconds in results], [4])
+        results=passwords.calibrate(1, min_rounds=4, max_rounds=6, samples=2, clock=clock)
+        self.assertEqual([rounds for rounds, seconds in results], [4, 5, 6])
+
+    def test_recommend(self):
+        results=[(4, 0.01), (5, 0.02), (6, 0.04), (7, 0.08)]
+        self.assertEqual(passwords.recommend(results, 0.05), 6)
+        self.assertEqual(passwords.recommend(results, 1), 7)
+        self.assertIsNone(passwords.recommend(results, 0.001))
+
+class TestCredentialCache(unittest.TestCase):
+    def test_check_put(self):
+        credentials=passwords.CredentialCache(size=2, ttl=60)
+        self.assertFalse(credentials.check(u"user", u"password", u"$2b$hash"))
+        credentials.put(u"user", u"password", u"$2b$hash")
+        self.assertTrue(credentials.check(u"user", u"password", u"$2b$hash"))
+        self.assertFalse(credentials.check(u"user", u"wrong", u"$2b$hash"))
+        self.assertFalse(credentials.check(u"other", u"password", u"$2b$hash"))
+        self.assertFalse(credentials.check(u"user", u"password", u"$2b$other"))
+        #Nothing in the cache gives the password away
+        self.assertNotIn("password", repr(credentials._cache._entries))
+
+    def test_forget_hash(self):
+        credentials=passwords.CredentialCache(size=10, ttl=60)
+        credentials.put(u"user", u"password", u"$2b$hash")
+        credentials.put(u"user", u"other", u"$2b$hash")
+        credentials.put(u"user2", u"password", u"$2b$hash2")
+        credentials.forgetHash(u"$2b$hash")
+        self.assertFalse(credentials.check(u"user", u"password", u"$2b$hash"))
+        self.assertFalse(credentials.check(u"user", u"other", u"$2b$hash"))
+        self.assertTrue(credentials.check(u"user2", u"password", u"$2b$hash2"))
+
+    def test_ttl_and_size(self):
+        credentials=passwords.CredentialCache(size=1, ttl=0.1)
+        credentials.put(u"user", u"password", u"$2b$hash")
+        credentials.put(u"user2", u"password", u"$2b$hash2")
+        self.assertFalse(credentials.check(u"user", u"password", u"$2b$hash"))
+        self.assertTrue(credentials.check(u"user2", u"password", u"$2b$hash2"))
+        time.sleep(0.2)
+        self.assertFalse(credentials.check(u"user2", u"password", u"$2b$hash2"))
+
+    def test_disabled(self):
+        credentials=passwords.CredentialCache(size=0)
+        credentials.put(u"user", u"password", u"$2b$hash")
+        self.assertFalse(credentials.check(u"user", u"password", u"$2b$hash"))
+        self.assertIsNone(credentials.getMetrics())
+
+class TestTokens(unittest.TestCase):
+    def setUp(self):
+        self.original_configuration=gitastic.config.configuration
+        gitastic.config.configuration=gitastic.config._merged(gitastic.config.configuration, {"User": {"TokenSecret": "secret"}})
+
+    def tearDown(self):
+        gitastic.config.configuration=self.original_configuration
+
+    def test_token(self):
+        token=passwords.issueToken(7, u"$2b$hash", ttl=60, now=1000)
+        self.assertEqual(passwords.parseToken(token), (7, 1060))
+        self.assertTrue(passwords.checkToken(token, u"$2b$hash", now=1059))
+        self.assertFalse(passwords.checkToken(token, u"$2b$hash", now=1061))
+        self.assertFalse(passwords.checkToken(token, u"$2b$other", now=1000))
+        self.assertFalse(passwords.checkToken(token.replace("7.", "8.", 1), u"$2b$hash", now=1000))
+        self.assertIsNone(passwords.parseToken("not.a.token.at.all"))
+        self.assertFalse(passwords.checkToken("garbage", u"$2b$hash"))
+
+    def test_secret(self):
+        token=passwords.issueToken(7, u"$2b$hash", ttl=60)
+        gitastic.config.configuration=gitastic.config._merged(self.original_configuration, {"User": {"TokenSecret": "other"}})
+        self.assertFalse(passwords.checkToken(token, u"$2b$hash"))
+        gitastic.config.configuration=self.original_configuration
+        self.assertFalse(passwords.checkToken(token, u"$2b$hash"))
+        with self.assertRaises(passwords.TokenError):
+            passwords.issueToken(7, u"$2b$hash")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import unittest
+import sys
+import os
+import time
+import threading
+import tempfile
+import shutil
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "gitastic"))
+
+from lib import gitastic, database
+from test_models import _ModelTestBase
+
+class TestStorePool(_ModelTestBase):
+    def setUp(self):
+        super(TestStorePool, self).setUp()
+        self.pool=database.StorePool(database.database, size=2, timeout=0.2, max_idle=300, check_after=300)
+
+    def tearDown(self):
+        self.pool.close()
+        super(TestStorePool, self).tearDown()
+
+    def _inThread(self, target):
+        result=[]
+        thread=threading.Thread(target=lambda: result.append(target()))
+        thread.start()
+        thread.join()
+        return result[0] if result else None
+
+    def test_reuse(self):
+        with self.pool.connection() as store:
+            store.execute("SELECT 1")
+        with self.pool.connection() as again:
+            self.assertIs(again, store)
+        metrics=self.pool.getMetrics()
+        self.assertEqual((metrics["created"], metrics["checkouts"], metrics["in_use"], metrics["idle"]), (1, 2, 0, 1))
+
+    def test_bounded(self):
+        first=self.pool.checkout()
+        second=self.pool.checkout()
+        self.assertIsNot(first, second)
+        with self.assertRaises(database.DatabaseError):
+            self.pool.checkout()
+        self.assertEqual(self.pool.getMetrics()["timeouts"], 1)
+        self.pool.checkin(second)
+        self.assertIs(self.pool.checkout(), second)
+
+    def test_wait(self):
+        first=self.pool.checkout()
+        self.pool.checkout()
+        self.pool.timeout=5
+        timer=threading.Timer(0.1, self.pool.checkin, (first,))
+        timer.start()
+        self.assertIsNotNone(self.pool.checkout())
+        timer.join()
+        self.assertEqual(self.pool.getMetrics()["timeouts"], 0)
+        self.assertGreater(self.pool.getMetrics()["waits"], 0)
+
+    def test_reap(self):
+        with self.pool.connection():
+            pass
+        self.pool.max_idle=-1
+        self.pool.reap()
+        metrics=self.pool.getMetrics()
+        self.assertEqual((metrics["open"], metrics["reaped"]), (0, 1))
+
+    def test_health_check(self):
+        with self.pool.connection() as store:
+            pass
+        store.close()
+        self.pool.check_after=-1
+        with self.pool.connection() as replacement:
+            self.assertIsNot(replacement, store)
+            replacement.execute("SELECT 1")
+        self.assertEqual(self.pool.getMetrics()["discarded"], 1)
+
+    def test_rollback_on_checkin(self):
+        with self.pool.connection() as store:
+            store.add(database.User(username=u"Tester", email=u"tester@example.com", password=u""))
+            store.flush()
+        with self.pool.connection() as store:
+            self.assertEqual(store.find(database.User).count(), 0)
+
+class TestGetStore(_ModelTestBase):
+    def test_thread_store(self):
+        store=database.getStore()
+        self.assertIs(database.getStore(), store)
+        other=[]
+        thread=threading.Thread(target=lambda: other.append(database.getStore()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], store)
+        #The thread is gone, its store goes back to the pool once the interpreter has cleaned up after it
+        del other[:]
+        for i in range(100):
+            if database.getPoolMetrics()["in_use"]==1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(database.getPoolMetrics()["in_use"], 1)
+
+    def test_release(self):
+        store=database.getStore()
+        in_use=database.getPoolMetrics()["in_use"]
+        database.releaseStore()
+        self.assertEqual(database.getPoolMetrics()["in_use"], in_use-1)
+        database.getStore().execute("SELECT 1")
+
+    def test_disconnect(self):
+        store=database.getStore()
+        database.disconnect()
+        with self.assertRaises(database.DatabaseError):
+            database.getStore()
+        database.connect()
+        self.assertIsNot(database.getStore(), store)
+        database.getStore().execute("SELECT 1")
+
+class TestSQLiteTuning(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir=tempfile.mkdtemp()
+        self.pool=database.StorePool(database._createDatabase("sqlite:%s"%(os.path.join(self.temp_dir, "gitastic.db"),)),
+            on_connect=database._tuneSQLite)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_pragmas(self):
+        with self.pool.connection() as store:
+            self.assertEqual(store.execute("PRAGMA journal_mode").get_one()[0].lower(), "wal")
+            self.assertEqual(store.execute("PRAGMA foreign_keys").get_one()[0], 1)
+            self.assertEqual(store.execute("PRAGMA cache_size").get_one()[0], -64*1024)
+            self.assertEqual(store.execute("PRAGMA busy_timeout").get_one()[0], 5000)
+
+    def test_uri_wins(self):
+        tuned=database._createDatabase("sqlite:%s?timeout=1&journal_mode=DELETE"%(os.path.join(self.temp_dir, "other.db"),))
+        store=database.Store(tuned)
+        try:
+            self.assertEqual(store.execute("PRAGMA journal_mode").get_one()[0].lower(), "delete")
+            self.assertEqual(store.execute("PRAGMA busy_timeout").get_one()[0], 1000)
+        finally:
+            store.close()
+
+if __name__ == '__main__':
+    unittest.main()
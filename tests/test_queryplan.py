@@ -0,0 +1,176 @@
+import unittest
+import sys
+import os
+import tempfile
+import shutil
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "gitastic"))
+
+from lib import gitastic, database, timing
+from test_models import _ModelTestBase
+from queryplan import QueryPlanAssertions, QueryBudgetAssertions, captureStatements
+
+class TestQueryPlans(_ModelTestBase, QueryPlanAssertions, QueryBudgetAssertions):
+    def setUp(self):
+        super(TestQueryPlans, self).setUp()
+        #The statements under test, not whether ObjectCache/Size spares them
+        self.objects, database.objects=database.objects, None
+        with open(os.path.join(os.path.dirname(__file__), "ssh", "TESTING_ONLY_client_rsa.pub"), "r") as fp:
+            keydata=unicode(fp.readline())
+        self.repo_owner=database.User(username=u"Tester", email=u"tester@example.com", password=u"")
+        self.repo_owner.setPassword(u"password")
+        self.repo_user=database.User(username=u"Tester2", email=u"tester2@example.com", password=u"")
+        self.user_key=database.UserSSHKey(user=self.repo_user, name=u"user", key=keydata)
+        self.team=database.Team(name=u"Test-team")
+        database.getStore().add(self.repo_owner)
+        database.getStore().add(self.user_key)
+        database.getStore().add(self.team)
+        database.getStore().commit()
+        self.repo=database.Repository(name=u"test-repo", description=u"Testing repo", public=False)
+        self.repo_owner.repositories.add(self.repo)
+        self.repo.setPath()
+        self.team_repo=database.Repository(name=u"test-team-repo", description=u"Testing repo", public=False)
+        self.team.repositories.add(self.team_repo)
+        database.getStore().commit()
+        self.team_repo.setPath()
+        self.repo.setAccess(self.repo_user, database.Repository.ACC_VIEW)
+        self.team.setAccess(self.repo_user, database.Team.ACC_VIEW)
+        #Nothing comes from storm's cache, every lookup has to go to the database
+        database.getStore().invalidate()
+
+    def tearDown(self):
+        database.objects=self.objects
+        super(TestQueryPlans, self).tearDown()
+
+    def test_captures(self):
+        path=self.repo.path
+        statements=captureStatements(lambda: database.Repository.findByPath(path))
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0][0].lstrip().upper().startswith("SELECT"))
+
+    def test_find_by_path(self):
+        self.assertNoFullScans(lambda: database.Repository.findByPath(self.repo.path+".git"))
+
+    def test_get_access(self):
+        self.assertNoFullScans(lambda: self.repo.getAccess(self.repo_user))
+        self.assertNoFullScans(lambda: self.team_repo.getAccess(self.repo_user))
+
+    def test_repositories(self):
+        self.assertNoFullScans(lambda: list(self.repo_owner.repositories))
+        self.assertNoFullScans(lambda: list(self.team.repositories))
+
+    def test_batched_access(self):
+        self.assertNoFullScans(lambda: self.repo.getAccessForUsers([self.repo_owner, self.repo_user]))
+        self.assertNoFullScans(lambda: self.team_repo.getAccessForUsers([self.repo_owner, self.repo_user]))
+        self.assertNoFullScans(lambda: self.repo_user.visibleRepositories(after=0))
+        self.assertNoFullScans(lambda: self.repo_user.visibleRepositories(repositories=[self.repo, self.team_repo]))
+
+    def test_detects_scan(self):
+        database.getStore().execute("DROP INDEX path_INDEX" if database.database.__class__.__name__=="SQLite" else "ALTER TABLE repository DROP INDEX path_INDEX")
+        try:
+            with self.assertRaises(AssertionError):
+                self.assertNoFullScans(lambda: database.Repository.findByPath(u"Tester/test-repo"))
+        finally:
+            #sqlite keeps the plan of a prepared EXPLAIN even once the index is back, start over with new connections
+            database.disconnect()
+            database.connect()
+
+    def test_authenticate(self):
+        self.assertNoFullScans(lambda: database.User.authenticate(u"Tester", u"password"))
+
+    def test_key_lookup(self):
+        self.assertNoFullScans(lambda: database.getStore().get(database.UserSSHKey, self.user_key.user_ssh_key_id))
+        self.assertNoFullScans(lambda: database.UserSSHKey.findByFingerprint(self.user_key.fingerprint))
+
+    def test_resolve_access(self):
+        self.assertNoFullScans(lambda: database.resolveAccess(self.user_key.user_ssh_key_id, self.repo.path+".git"))
+        self.assertNoFullScans(lambda: database.resolveAccess(self.user_key.user_ssh_key_id, self.team_repo.path+".git"))
+
+    def test_effective_access(self):
+        original_configuration=gitastic.config.configuration
+        gitastic.config.configuration=gitastic.config._merged(gitastic.config.configuration, {"Repository": {"UseEffectiveAccess": True}})
+        try:
+            self.assertNoFullScans(lambda: database.resolveAccess(self.user_key.user_ssh_key_id, self.team_repo.path+".git"))
+            self.assertNoFullScans(lambda: self.team_repo.getEffectiveAccess(self.repo_user))
+        finally:
+            gitastic.config.configuration=original_configuration
+
+    def test_query_budgets(self):
+        #Every object starts out invalidated, the budgets include loading the repository and its owner
+        path=self.repo.path+".git"
+        fingerprint=self.user_key.fingerprint
+        with self.assertMaxQueries(4):
+            self.repo.getAccess(self.repo_user)
+        with self.assertMaxQueries(4):
+            self.team_repo.getAccess(self.repo_user)
+        with self.assertMaxQueries(1):
+            database.resolveAccess(self.user_key.user_ssh_key_id, path)
+        with self.assertMaxQueries(1):
+            database.User.authenticate(u"Tester", u"password")
+        with self.assertMaxQueries(1):
+            database.UserSSHKey.findByFingerprint(fingerprint)
+        with self.assertRaises(AssertionError):
+            with self.assertMaxQueries(1):
+                self.repo.getAccess(self.repo_user)
+                self.team_repo.getAccess(self.repo_user)
+
+class TestProfile(_ModelTestBase, QueryBudgetAssertions):
+    def setUp(self):
+        super(TestProfile, self).setUp()
+        self.objects, database.objects=database.objects, None
+        self.temp_dir=tempfile.mkdtemp()
+        self.user=database.User(username=u"Tester", email=u"tester@example.com", password=u"")
+        self.user.setPassword(u"password")
+        database.getStore().add(self.user)
+        database.getStore().commit()
+
+    def tearDown(self):
+        database.objects=self.objects
+        database.slow_query_log=None
+        shutil.rmtree(self.temp_dir)
+        super(TestProfile, self).tearDown()
+
+    def test_profile(self):
+        with database.profile() as outer:
+            database.User.authenticate(u"Tester", u"password")
+            with database.profile() as inner:
+                database.User.authenticate(u"Tester", u"password")
+                database.User.authenticate(u"Nobody", u"password")
+        self.assertEqual((outer.queries, inner.queries), (3, 2))
+        self.assertTrue(outer.time>0)
+        self.assertEqual([(params, count) for statement, params, count in outer.getDuplicates()], [((u"tester",), 2)])
+        self.assertEqual(inner.getDuplicates(), [])
+        self.assertIn("2x duplicate", outer.report())
+        #Nothing is counted once the block is over
+        database.User.authenticate(u"Tester", u"password")
+        self.assertEqual(outer.queries, 3)
+
+    def test_duplicates(self):
+        with self.assertNoDuplicateQueries():
+            database.User.authenticate(u"Tester", u"password")
+        with self.assertRaises(AssertionError):
+            with self.assertNoDuplicateQueries():
+                database.User.authenticate(u"Tester", u"password")
+                database.User.authenticate(u"Tester", u"password")
+
+    def test_slow_query_log(self):
+        path=os.path.join(self.temp_dir, "slow.log")
+        database.slow_query_log=(path, 60)
+        database.User.authenticate(u"Tester", u"password")
+        self.assertFalse(os.path.exists(path))
+        database.slow_query_log=(path, 0)
+        database.User.authenticate(u"Tester", u"password")
+        with open(path, "r") as fp:
+            lines=fp.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn("WHERE \"user\".username_lower = ? (u'tester',)", lines[0])
+
+    def test_timing(self):
+        timer=timing.PhaseTimer(os.path.join(self.temp_dir, "timing.log"))
+        timer.countQueries()
+        database.User.authenticate(u"Tester", u"password")
+        timer.write("allowed")
+        with open(os.path.join(self.temp_dir, "timing.log"), "r") as fp:
+            self.assertEqual(timing.parseLine(fp.read())[:2], ("allowed", 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,6 +30,12 @@ class TestShell(unittest.TestCase):
         super(TestShell, self).__init__(*args, **kwargs)
 
     def _drop_tables(self):
+        if database.database.__class__.__name__=="SQLite":
+            #Same as test_models, newest first so foreign keys are dropped first
+            for table in list(database.getStore().execute("select name from sqlite_master where type='table' and name not like 'sqlite_%' order by rowid desc;")):
+                database.getStore().execute("drop table \"%s\";"%(table[0],))
+            database.getStore().commit()
+            return
         database.getStore().execute("SET FOREIGN_KEY_CHECKS = 0;")
         for table in database.getStore().execute("show tables;"):
             database.getStore().execute("drop table %s;"%(table[0],))
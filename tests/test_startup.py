@@ -0,0 +1,44 @@
+import unittest
+import sys
+import os
+import json
+import subprocess
+
+#gitastic-shell runs once per ssh session, so the time it takes to get to the point of asking the database anything
+#is paid thousands of times a minute.  Raise the budget with GITASTIC_STARTUP_BUDGET (seconds) on slow machines.
+STARTUP_BUDGET=float(os.environ.get("GITASTIC_STARTUP_BUDGET", 0.5))
+STARTUP_RUNS=3
+#Modules the shell's authorization path has no use for, these must only be loaded when actually needed
+LAZY_MODULES=("bcrypt",)
+
+STARTUP_SCRIPT="""
+import sys, time, json
+start=time.time()
+sys.path.insert(0, %(gitastic_dir)r)
+from lib import gitastic, shellauth
+gitastic.configDir=%(config_dir)r
+gitastic.init()
+elapsed=time.time()-start
+print json.dumps({"elapsed": elapsed, "modules": sorted(sys.modules.keys())})
+"""
+
+class TestShellStartup(unittest.TestCase):
+    def _measure(self):
+        script=STARTUP_SCRIPT%{
+            "gitastic_dir": os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gitastic"),
+            "config_dir": os.path.join(os.path.dirname(os.path.abspath(__file__)), "config"),
+        }
+        return json.loads(subprocess.check_output([sys.executable, "-c", script]))
+
+    def test_lazy_imports(self):
+        modules=self._measure()["modules"]
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, modules, "%s is loaded on the gitastic-shell authorization path"%(module,))
+
+    def test_startup_budget(self):
+        #Best of a few runs so one slow run on a busy machine doesn't fail the build
+        elapsed=min(self._measure()["elapsed"] for i in range(STARTUP_RUNS))
+        self.assertLess(elapsed, STARTUP_BUDGET, "Shell import and init took %.3fs, budget is %.3fs"%(elapsed, STARTUP_BUDGET))
+
+if __name__ == '__main__':
+    unittest.main()
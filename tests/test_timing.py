@@ -0,0 +1,75 @@
+import unittest
+import sys
+import os
+import tempfile
+import shutil
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "gitastic"))
+
+from lib import timing
+
+class TestPhaseTimer(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir=tempfile.mkdtemp()
+        self.log=os.path.join(self.temp_dir, "timing.log")
+        self.original_log=os.environ.pop(timing.ENVIRONMENT, None)
+
+    def tearDown(self):
+        os.environ.pop(timing.ENVIRONMENT, None)
+        if self.original_log is not None:
+            os.environ[timing.ENVIRONMENT]=self.original_log
+        shutil.rmtree(self.temp_dir)
+
+    def test_disabled(self):
+        timer=timing.getTimer()
+        self.assertFalse(timer.enabled)
+        timer.phase("config")
+        timer.write("allowed")
+        self.assertFalse(os.path.exists(self.log))
+
+    def test_write(self):
+        os.environ[timing.ENVIRONMENT]=self.log
+        timer=timing.getTimer()
+        self.assertTrue(timer.enabled)
+        timer.phase("config")
+        timer.queries=2
+        timer.write("allowed")
+        timer=timing.getTimer()
+        timer.phase("config")
+        timer.write("unknown_key")
+        with open(self.log, "r") as fp:
+            lines=fp.readlines()
+        self.assertEqual(len(lines), 2)
+        outcome, queries, phases=timing.parseLine(lines[0])
+        self.assertEqual((outcome, queries), ("allowed", 2))
+        self.assertIn("config", phases)
+        self.assertIn("total", phases)
+        self.assertEqual(timing.parseLine(lines[1])[0], "unknown_key")
+
+    def test_process_age(self):
+        age=timing.getProcessAge()
+        if age is None:
+            self.skipTest("No /proc on this platform")
+        self.assertGreaterEqual(age, 0)
+
+class TestSummary(unittest.TestCase):
+    def test_percentile(self):
+        values=range(1, 101)
+        self.assertEqual(timing.percentile(values, 50), 50)
+        self.assertEqual(timing.percentile(values, 95), 95)
+        self.assertEqual(timing.percentile(values, 99), 99)
+        self.assertEqual(timing.percentile([7], 99), 7)
+        self.assertIsNone(timing.percentile([], 50))
+
+    def test_summarize(self):
+        lines=["1.000 %d %s q=1 config=%d.00 total=%d.00\n"%(i, "allowed" if i%4 else "denied", i, i+1) for i in range(1, 101)]
+        lines.append("not a timing line\n")
+        summary=timing.summarize(lines)
+        self.assertEqual(summary["runs"], 100)
+        self.assertEqual(summary["outcomes"], {"allowed": 75, "denied": 25})
+        self.assertEqual(timing.percentile(summary["phases"]["config"], 95), 95.0)
+        report=timing.formatSummary(summary)
+        self.assertTrue(report.startswith("100 runs: allowed 75, denied 25"))
+        self.assertIn("config", report)
+
+if __name__ == '__main__':
+    unittest.main()
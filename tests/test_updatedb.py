@@ -0,0 +1,146 @@
+import unittest
+import sys
+import os
+import subprocess
+import tempfile
+import shutil
+from storm.locals import create_database, Store
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "gitastic"))
+
+from schema import introspect, sqlite, migrations
+
+UPDATE_DB=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gitastic", "update-db")
+
+#The schema files against sqlite scratch files, whatever DatabaseURI the other tests use
+class TestUpdateDB(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir=tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _uri(self, name):
+        return "sqlite:"+os.path.join(self.temp_dir, name)
+
+    def _run(self, *args):
+        process=subprocess.Popen([UPDATE_DB]+list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output=process.communicate()[0]
+        return process.returncode, output
+
+    def _versions(self, uri):
+        return [row[0] for row in Store(create_database(uri)).execute("SELECT schema_version FROM schema_change ORDER BY schema_version")]
+
+    def test_baseline(self):
+        code, output=self._run(self._uri("new.db"))
+        self.assertEqual(code, 0, output)
+        self.assertIn("Creating baseline schema version %d"%(sqlite.baseline_version,), output)
+        self.assertEqual(self._versions(self._uri("new.db")), [sqlite.baseline_version])
+        code, output=self._run(self._uri("new.db"))
+        self.assertIn("The database is up to date", output)
+
+    def test_incremental(self):
+        code, output=self._run("--incremental", self._uri("new.db"))
+        self.assertEqual(code, 0, output)
+        self.assertNotIn("baseline", output)
+        self.assertEqual(self._versions(self._uri("new.db")), sorted(sqlite.schema))
+
+    def test_verify(self):
+        code, output=self._run("--verify", self._uri("baseline.db"), self._uri("incremental.db"))
+        self.assertEqual(code, 0, output)
+        self.assertIn("The baseline matches replaying every version", output)
+
+    def test_verify_needs_empty(self):
+        self._run(self._uri("used.db"))
+        code, output=self._run("--verify", self._uri("used.db"), self._uri("new.db"))
+        self.assertNotEqual(code, 0)
+        self.assertIn("--verify needs empty databases", output)
+
+    def test_upgrade_before_username_lower(self):
+        #A database as it stood before user.username_lower, with a user owning a repository someone has access to
+        uri=self._uri("old.db")
+        store=Store(create_database(uri))
+        for version in range(21):
+            store.execute(sqlite.schema[version])
+        store.execute("INSERT INTO schema_change (applied_date, schema_version) VALUES ('2015-01-01 00:00:00', 20)")
+        store.execute("INSERT INTO user (username, email, password) VALUES ('Owner', '', ''), ('Other', '', '')")
+        store.execute("INSERT INTO repository (name, path, description, public, owner_user_id) VALUES ('repo', 'Owner/repo', '', 0, 1)")
+        store.execute("INSERT INTO repository_access (repository_id, user_id, access) VALUES (1, 2, 2)")
+        store.commit()
+        #What mysql runs as version 19 has to work against these tables
+        migrations.rebuildEffectiveAccess(store)
+        store.commit()
+        self.assertEqual(list(store.execute("SELECT repository_id, user_id, access FROM effective_access")), [(1, 2, 2)])
+        store.close()
+        code, output=self._run(uri)
+        self.assertEqual(code, 0, output)
+        store=Store(create_database(uri))
+        self.assertEqual(list(store.execute("SELECT username_lower FROM user ORDER BY user_id")), [(u"owner",), (u"other",)])
+        self.assertIn("username_lower_UNIQUE", repr(introspect.describeSQLite(store)["user"]["indexes"]))
+
+    def test_compare(self):
+        self._run(self._uri("new.db"))
+        store=Store(create_database(self._uri("new.db")))
+        before=introspect.describeSQLite(store)
+        self.assertEqual(introspect.compare(before, before), [])
+        self.assertIn("fingerprint_UNIQUE", repr(before["user_ssh_key"]["indexes"]))
+        store.execute("DROP INDEX path_INDEX")
+        store.execute("DELETE FROM acl_version")
+        store.commit()
+        differences=introspect.compare(before, introspect.describeSQLite(store))
+        self.assertEqual([difference.split(":")[0] for difference in differences], ["acl_version rows", "repository indexes"])
+
+class TestChunkedMigration(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir=tempfile.mkdtemp()
+        uri="sqlite:"+os.path.join(self.temp_dir, "chunked.db")
+        subprocess.check_call([UPDATE_DB, uri], stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+        self.store=Store(create_database(uri))
+        for i in range(10):
+            self.store.execute("INSERT INTO team (name, description) VALUES (?, '')", (u"Team%d"%(i,),))
+        self.store.commit()
+        self.batches=[]
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.temp_dir)
+
+    def _lower(self, store, keys):
+        self.batches.append(keys)
+        store.execute("UPDATE team SET description=lower(name) WHERE team_id IN (%s)"%(",".join(str(key) for key in keys),))
+
+    def _descriptions(self):
+        return [row[0] for row in self.store.execute("SELECT description FROM team ORDER BY team_id")]
+
+    def test_batches(self):
+        migration=migrations.ChunkedMigration("lowerTeams", "team", "team_id", self._lower, batch_size=4)
+        migration(self.store)
+        self.assertEqual([len(keys) for keys in self.batches], [4, 4, 2])
+        self.assertEqual(self._descriptions(), [u"team%d"%(i,) for i in range(10)])
+        self.assertEqual(migration.getProgress(self.store), (10, 10))
+        #Nothing left to do the second time around
+        migration(self.store, batch_size=3)
+        self.assertEqual(len(self.batches), 3)
+
+    def test_resume(self):
+        def failing(store, keys):
+            if len(self.batches)==2:
+                raise RuntimeError("interrupted")
+            self._lower(store, keys)
+        with self.assertRaises(RuntimeError):
+            migrations.ChunkedMigration("lowerTeams", "team", "team_id", failing, batch_size=3)(self.store)
+        self.store.rollback()
+        #Both finished batches were committed with their progress
+        self.assertEqual(self._descriptions()[:7], [u"team%d"%(i,) for i in range(6)]+[u""])
+        migrations.ChunkedMigration("lowerTeams", "team", "team_id", self._lower, batch_size=3)(self.store)
+        self.assertEqual(self.batches[2:], [[7, 8, 9], [10]])
+        self.assertEqual(self._descriptions(), [u"team%d"%(i,) for i in range(10)])
+
+    def test_lower_usernames(self):
+        for username in (u"Alice", u"BOB", u"carol"):
+            self.store.execute("INSERT INTO user (username, email, password) VALUES (?, '', '')", (username,))
+        self.store.commit()
+        migrations.ChunkedMigration("lowerUsernames", "user", "user_id", migrations.lowerUsernames, batch_size=2)(self.store)
+        self.assertEqual([row[0] for row in self.store.execute("SELECT username_lower FROM user ORDER BY user_id")], [u"alice", u"bob", u"carol"])
+
+if __name__ == '__main__':
+    unittest.main()